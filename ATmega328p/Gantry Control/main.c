@@ -54,6 +54,27 @@ uint8_t newXADDR, newYADDR;
 uint8_t UART_lastRecievedByte;
 uint8_t overshootMode = 0;
 
+//Framed path protocol (see frame_Receive). Frames from the Pi are sent as FRAME_START followed by the
+//frame body split into nibbles, one per byte (mode 0), so firmware without this handler ignores them.
+//Frames to the Pi are sent as raw bytes: FRAME_START, LEN, SEQ, TYPE, PAYLOAD[LEN], CRC8 (poly 0x07)
+#define FRAME_START			0xF5	//ELSE mode, data 21
+#define FRAME_STOP			0xF6	//ELSE mode, data 22. Stops a running path at the next waypoint
+#define RESEND_DATA			0xE6	//ELSE mode, data 6. Answered once a running path is done
+#define FRAME_PATH			0x01	//Pi -> 328P: waypoints as X, Y, FLAGS
+#define FRAME_ACK			0x02	//328P -> Pi: frame accepted, path starting
+#define FRAME_NAK			0x03	//328P -> Pi: REASON
+#define FRAME_PROGRESS		0x04	//328P -> Pi: WAYPOINTS DONE, X, Y (cumulative)
+#define FRAME_DONE			0x05	//328P -> Pi: WAYPOINTS DONE, X, Y. EM is OFF
+#define FRAME_FLAG_EM_ON	0x01	//Turn EM ON after arriving at the waypoint
+#define FRAME_FLAG_EM_OFF	0x02	//Turn EM OFF after arriving at the waypoint
+#define NAK_BAD_FRAME		1		//CRC, length or timeout error
+#define NAK_INVALID_PATH	2		//Address out of range, or EM ON segment not straight nor diagonal
+#define FRAME_MAX_PAYLOAD	96		//32 waypoints
+#define FRAME_BYTE_TIMEOUT	2000	//x10us between bytes before a frame is dropped
+
+uint8_t frameMode = 0;				//Suppresses ARRIVED + X + Y while a path frame runs
+uint8_t framePayload[FRAME_MAX_PAYLOAD];
+
 
 int main(void){
 	_delay_ms(1000);
@@ -642,6 +663,51 @@ void calibrate(void)
 
 }
 
+/*
+* Function Name : report_arrived
+ * Description: Transmits ARRIVED followed by the current X and Y address.
+ *				Not sent while a path frame runs; PROGRESS frames are sent instead
+ * Input Parameters : NONE
+ * Return value: NONE
+ */
+void report_arrived(void)
+{
+	if (frameMode)
+	{
+		return;
+	}
+	arrived();
+	USART_Transmit(0x20|currentXADDR);
+	_delay_ms(1);
+	USART_Transmit(0x40|currentYADDR);
+	_delay_ms(1);
+}
+
+/*
+* Function Name : report_position
+ * Description: Answers RESEND DATA with ARRIVED, the current X and Y address and the EM state (EM ON or EM OFF
+ *				confirmation byte), so the Pi can resynchronise after a lost or garbled byte
+ * Input Parameters : NONE
+ * Return value: NONE
+ */
+void report_position(void)
+{
+	arrived();
+	USART_Transmit(0x20|currentXADDR);
+	_delay_ms(1);
+	USART_Transmit(0x40|currentYADDR);
+	_delay_ms(1);
+	if (PIND & (1<<ena_EM))
+	{
+		EM_ON_TX();
+	}
+	else
+	{
+		EM_OFF_TX();
+	}
+	_delay_ms(1);
+}
+
 /*
 * Function Name : GO
  * Description : Moves the Gantry to specified position.
@@ -703,22 +769,14 @@ void GO(uint8_t X_addr, uint8_t Y_addr)
 				overshootMode = 2;
 				move_straightY(difference_Y);
 				currentYADDR = Y_addr;
-				arrived();
-				USART_Transmit(0x20|currentXADDR);
-				_delay_ms(1);
-				USART_Transmit(0x40|currentYADDR);
-				_delay_ms(1);
+				report_arrived();
 			}
 			else if (difference_Y == 0)
 			{
 				overshootMode = 1;
 				move_straightX(difference_X);
 				currentXADDR = X_addr;
-				arrived();
-				USART_Transmit(0x20|currentXADDR);
-				_delay_ms(1);
-				USART_Transmit(0x40|currentYADDR);
-				_delay_ms(1);
+				report_arrived();
 			}
 			
 			else if (difference_X == difference_Y) //diagonal
@@ -727,11 +785,7 @@ void GO(uint8_t X_addr, uint8_t Y_addr)
 				move_diagonal(difference_X);
 				currentYADDR = Y_addr;
 				currentXADDR = X_addr;
-				arrived();
-				USART_Transmit(0x20|currentXADDR);
-				_delay_ms(1);
-				USART_Transmit(0x40|currentYADDR);
-				_delay_ms(1);
+				report_arrived();
 			}
 			else
 			{
@@ -749,11 +803,7 @@ void GO(uint8_t X_addr, uint8_t Y_addr)
 				move_straightX(difference_X - difference_Y);
 				currentYADDR = Y_addr;
 				currentXADDR = X_addr;
-				arrived();
-				USART_Transmit(0x20|currentXADDR);
-				_delay_ms(1);
-				USART_Transmit(0x40|currentYADDR);
-				_delay_ms(1);
+				report_arrived();
 			}
 			
 			else if (difference_X < difference_Y)
@@ -762,11 +812,7 @@ void GO(uint8_t X_addr, uint8_t Y_addr)
 				move_straightY(difference_Y -  difference_X);
 				currentYADDR = Y_addr;
 				currentXADDR = X_addr;
-				arrived();
-				USART_Transmit(0x20|currentXADDR);
-				_delay_ms(1);
-				USART_Transmit(0x40|currentYADDR);
-				_delay_ms(1);
+				report_arrived();
 			}
 			
 			else if (difference_X == difference_Y)
@@ -774,11 +820,7 @@ void GO(uint8_t X_addr, uint8_t Y_addr)
 				move_diagonal(difference_X);
 				currentYADDR = Y_addr;
 				currentXADDR = X_addr;
-				arrived();
-				USART_Transmit(0x20|currentXADDR);
-				_delay_ms(1);
-				USART_Transmit(0x40|currentYADDR);
-				_delay_ms(1);
+				report_arrived();
 			}
 			}
 			
@@ -867,6 +909,24 @@ int USART_Receive(void){
 	
 }
 
+/*
+* Function Name : USART_Receive_Timeout
+ * Description: Returns the received byte, or -1 if nothing arrives within FRAME_BYTE_TIMEOUT
+ * Input Parameters : NONE
+ * Return value: 8-bit data received from UART or -1
+ */
+int USART_Receive_Timeout(void){
+	for (uint16_t i = 0; i < FRAME_BYTE_TIMEOUT; i++)
+	{
+		if (UCSR0A & (1<<RXC0))
+		{
+			return UDR0;
+		}
+		_delay_us(10);
+	}
+	return -1;
+}
+
 /*
 * Function Name : get_MODE
  * Description: Returns the value of 3 MSB from input to get the mode. (See UART Protocol)
@@ -894,6 +954,271 @@ uint8_t get_DATA(uint8_t input){
 	return (input&0x1F);
 }
 
+/*
+* Function Name : crc8_update
+ * Description: CRC-8 (polynomial 0x07, initial value 0) over frame LEN, SEQ, TYPE and PAYLOAD
+ * Input Parameters : Running CRC, next byte
+ * Return value: Updated CRC
+ */
+uint8_t crc8_update(uint8_t crc, uint8_t data)
+{
+	crc ^= data;
+	for (uint8_t i = 0; i < 8; i++)
+	{
+		if (crc & 0x80)
+		{
+			crc = (crc << 1) ^ 0x07;
+		}
+		else
+		{
+			crc <<= 1;
+		}
+	}
+	return crc;
+}
+
+/*
+* Function Name : frame_Transmit
+ * Description: Transmits a frame to the raspberry pi
+ * Input Parameters : Sequence number of the frame being answered, frame type, payload and its length
+ * Return value: NONE
+ */
+void frame_Transmit(uint8_t seq, uint8_t type, uint8_t *payload, uint8_t length)
+{
+	uint8_t crc = 0;
+	USART_Transmit(FRAME_START);
+	USART_Transmit(length);
+	crc = crc8_update(crc, length);
+	USART_Transmit(seq);
+	crc = crc8_update(crc, seq);
+	USART_Transmit(type);
+	crc = crc8_update(crc, type);
+	for (uint8_t i = 0; i < length; i++)
+	{
+		USART_Transmit(payload[i]);
+		crc = crc8_update(crc, payload[i]);
+	}
+	USART_Transmit(crc);
+}
+
+/*
+* Function Name : frame_Report
+ * Description: Transmits PROGRESS or DONE with the number of waypoints reached and the current address
+ * Input Parameters : Sequence number, frame type, waypoints done
+ * Return value: NONE
+ */
+void frame_Report(uint8_t seq, uint8_t type, uint8_t done)
+{
+	uint8_t report[3];
+	report[0] = done;
+	report[1] = currentXADDR;
+	report[2] = currentYADDR;
+	frame_Transmit(seq, type, report, 3);
+}
+
+/*
+* Function Name : frame_Receive_Byte
+ * Description: Receives one frame body byte sent as two nibbles (high first)
+ * Input Parameters : NONE
+ * Return value: Body byte, or -1 on timeout or if a byte is not a nibble
+ */
+int frame_Receive_Byte(void)
+{
+	int high, low;
+	high = USART_Receive_Timeout();
+	if (high < 0 || high > 0x0F)
+	{
+		return -1;
+	}
+	low = USART_Receive_Timeout();
+	if (low < 0 || low > 0x0F)
+	{
+		return -1;
+	}
+	return (high << 4) | low;
+}
+
+/*
+* Function Name : frame_Valid_Path
+ * Description: Checks every waypoint is in range and every EM ON segment is straight or diagonal
+ * Input Parameters : Number of waypoints in framePayload
+ * Return value: 1 if GO will accept every waypoint, else 0
+ */
+uint8_t frame_Valid_Path(uint8_t count)
+{
+	uint8_t x = currentXADDR;
+	uint8_t y = currentYADDR;
+	uint8_t emOn = (PIND & (1<<ena_EM)) ? 1 : 0;
+	uint8_t dx, dy;
+	
+	for (uint8_t i = 0; i < count; i++)
+	{
+		uint8_t nextX = framePayload[3*i];
+		uint8_t nextY = framePayload[3*i + 1];
+		uint8_t flags = framePayload[3*i + 2];
+		if (nextX > 24 || nextY > 16)
+		{
+			return 0;
+		}
+		dx = (nextX > x) ? nextX - x : x - nextX;
+		dy = (nextY > y) ? nextY - y : y - nextY;
+		if (emOn && dx != 0 && dy != 0 && dx != dy)
+		{
+			return 0;
+		}
+		if (flags & FRAME_FLAG_EM_ON)
+		{
+			emOn = 1;
+		}
+		if (flags & FRAME_FLAG_EM_OFF)
+		{
+			emOn = 0;
+		}
+		x = nextX;
+		y = nextY;
+	}
+	return 1;
+}
+
+/*
+* Function Name : frame_EM_OFF
+ * Description: Turns the EM off the same way as the EM OFF command so the piece is released
+ * Input Parameters : NONE
+ * Return value: NONE
+ */
+void frame_EM_OFF(void)
+{
+	EM_OFF();
+	_delay_ms(500);
+	EM_ON();
+	_delay_ms(750);
+	EM_OFF();
+}
+
+/*
+* Function Name : frame_Run_Path
+ * Description: Runs every waypoint of a PATH frame with a single upload. Sends PROGRESS after each
+ *				waypoint and DONE at the end. A FRAME_STOP byte stops the path at the next waypoint;
+ *				a RESEND DATA byte is answered after DONE
+ * Input Parameters : Sequence number, number of waypoints in framePayload
+ * Return value: NONE
+ */
+void frame_Run_Path(uint8_t seq, uint8_t count)
+{
+	uint8_t done = 0;
+	uint8_t resendPending = 0;
+	
+	frameMode = 1;
+	for (uint8_t i = 0; i < count; i++)
+	{
+		uint8_t x = framePayload[3*i];
+		uint8_t y = framePayload[3*i + 1];
+		uint8_t flags = framePayload[3*i + 2];
+		
+		GO(x, y);
+		if (currentXADDR != x || currentYADDR != y)
+		{
+			break;		//GO refused the move
+		}
+		if (flags & FRAME_FLAG_EM_ON)
+		{
+			EM_ON();
+			_delay_ms(500);
+		}
+		if (flags & FRAME_FLAG_EM_OFF)
+		{
+			frame_EM_OFF();
+		}
+		done = i + 1;
+		
+		if (UCSR0A & (1<<RXC0))
+		{
+			uint8_t received = UDR0;
+			if (received == FRAME_STOP)
+			{
+				break;
+			}
+			if (received == RESEND_DATA)
+			{
+				resendPending = 1;
+			}
+		}
+		if (done < count)
+		{
+			frame_Report(seq, FRAME_PROGRESS, done);
+		}
+	}
+	
+	if (PIND & (1<<ena_EM))
+	{
+		frame_EM_OFF();
+	}
+	frameMode = 0;
+	frame_Report(seq, FRAME_DONE, done);
+	if (resendPending)
+	{
+		report_position();		//The Pi lost a report and is resynchronising
+	}
+}
+
+/*
+* Function Name : frame_Receive
+ * Description: Receives the rest of a frame after FRAME_START, checks it and carries it out
+ *				Answers ACK before running a PATH frame, or NAK with the reason
+ * Input Parameters : NONE
+ * Return value: NONE
+ */
+void frame_Receive(void)
+{
+	int length, seq, type, data, crcReceived;
+	uint8_t crc = 0;
+	uint8_t reason;
+	
+	length = frame_Receive_Byte();
+	seq = frame_Receive_Byte();
+	type = frame_Receive_Byte();
+	if (length < 0 || seq < 0 || type < 0 || length > FRAME_MAX_PAYLOAD)
+	{
+		reason = NAK_BAD_FRAME;
+		frame_Transmit(seq < 0 ? 0 : seq, FRAME_NAK, &reason, 1);
+		return;
+	}
+	crc = crc8_update(crc, length);
+	crc = crc8_update(crc, seq);
+	crc = crc8_update(crc, type);
+	
+	for (uint8_t i = 0; i < length; i++)
+	{
+		data = frame_Receive_Byte();
+		if (data < 0)
+		{
+			reason = NAK_BAD_FRAME;
+			frame_Transmit(seq, FRAME_NAK, &reason, 1);
+			return;
+		}
+		framePayload[i] = data;
+		crc = crc8_update(crc, data);
+	}
+	
+	crcReceived = frame_Receive_Byte();
+	if (crcReceived != crc)
+	{
+		reason = NAK_BAD_FRAME;
+		frame_Transmit(seq, FRAME_NAK, &reason, 1);
+		return;
+	}
+	
+	if (type != FRAME_PATH || length % 3 != 0 || !frame_Valid_Path(length / 3))
+	{
+		reason = NAK_INVALID_PATH;
+		frame_Transmit(seq, FRAME_NAK, &reason, 1);
+		return;
+	}
+	
+	frame_Transmit(seq, FRAME_ACK, 0, 0);
+	frame_Run_Path(seq, length / 3);
+}
+
 /*
 * Function Name : UART_decode_Command
  * Description: Decodes UART command and carry out the command
@@ -985,7 +1310,11 @@ void UART_decode_Command(uint8_t UART_lastRecievedByte){
 				//CASE1 NO RFID
 					
 				case 6:	//RESEND DATA
-				//USART_Transmit(UART_lastSentByte);
+				report_position();
+				break;
+				
+				case 21: //FRAME START
+				frame_Receive();
 				break;
 					
 				default:
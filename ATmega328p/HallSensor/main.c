@@ -33,6 +33,9 @@
 #define SS_RF   2
 #define RST_RF  1
 
+// Change line to the Pi (PB1): high while the board differs from the last column bytes the Pi read
+#define CHANGE  1
+
 
 
 uint8_t FSMode = 0;
@@ -218,6 +221,40 @@ uint8_t GatherMuxDataD(uint8_t Mux)
 	
 }
 
+// Column byte for board column 0-7 (same multiplexer inputs as SPI commands 0-7)
+uint8_t GatherColumn(uint8_t column)
+{
+	if (column < 4) {
+		return GatherMuxDataD(5 - column);
+	}
+	return GatherMuxDataC(7 - column);
+}
+
+// Column bytes last read by the Pi, compared against by the idle scan
+uint8_t SentData[8];
+
+// Sends a column byte over SPI and records it as read; the line drops once the Pi has read every change
+void SendColumn(uint8_t column, uint8_t data)
+{
+	SentData[column] = data;
+	PORTB &= ~(1<<CHANGE);
+	SPI_masterTxRx(data);
+}
+
+// Scans the board between SPI commands and raises the change line if a column differs from what the Pi
+// last read. Stops at the next column boundary once a command byte is in, so the reply is not held up
+void IdleScan(void)
+{
+	for (uint8_t column = 0; column < 8; column++) {
+		if (SPSR & (1<<SPIF)) {
+			return;
+		}
+		if (GatherColumn(column) != SentData[column]) {
+			PORTB |= (1<<CHANGE);
+		}
+	}
+}
+
 void SendData(uint8_t Byte1, uint8_t Byte2)
 {
 	SPI_masterTxRx(Byte2);
@@ -377,54 +414,68 @@ int main(void)
 	
 	SPI_SlaveInit();
 	MuxInit();
+	DDRB |= (1<<CHANGE);
+	PORTB &= ~(1<<CHANGE);
 	uint8_t SPI_RXData;
 	USART_init();
 	//USART_interrupt_ENA();
 	
 	while(1){	
 		
+		// keep scanning until the Pi sends a command, so it can sleep until the change line goes high
+		while (!(SPSR & (1<<SPIF))) {
+			IdleScan();
+		}
 		SPI_RXData = SPI_SlaveReceive();
 		
 		switch (SPI_RXData)
 		{
 			case 0:			
 				MD0 = GatherMuxDataD(5);
-				SPI_masterTxRx(MD0);
+				SendColumn(0, MD0);
 			break;
 			
 			case 1:
 				MD1 = GatherMuxDataD(4);
-				SPI_masterTxRx(MD1);
+				SendColumn(1, MD1);
 			break;
 			
 			case 2:
 				MD2 = GatherMuxDataD(3);
-				SPI_masterTxRx(MD2);
+				SendColumn(2, MD2);
 			break;
 			
 			case 3:
 				MD3 = GatherMuxDataD(2);
-				SPI_masterTxRx(MD3);
+				SendColumn(3, MD3);
 			break;
 			
 			case 4:
 				MD4 = GatherMuxDataC(3);
-				SPI_masterTxRx(MD4);
+				SendColumn(4, MD4);
 			break;
 			
 			case 5:
 				MD5 = GatherMuxDataC(2);
-				SPI_masterTxRx(MD5);
+				SendColumn(5, MD5);
 			break;
 			
 			case 6:
 				MD6 = GatherMuxDataC(1);
-				SPI_masterTxRx(MD6);
+				SendColumn(6, MD6);
 			break;
 			
 			case 7:
 				MD7 = GatherMuxDataC(0);	
-				SPI_masterTxRx(MD7);
+				SendColumn(7, MD7);
+			break;
+			
+			case 8:
+				// burst: the master clocks out all 8 columns in the same transfer as the command, leaving a gap
+				// between bytes to read each column into SPDR just before it is shifted out
+				for (uint8_t column = 0; column < 8; column++) {
+					SendColumn(column, GatherColumn(column));
+				}
 			break;
 			
 // 			case 48:
@@ -107,6 +107,8 @@ def init_chessboard(challengerName, gamestate):
                 # check if mouse hovering button
                 button = check_buttons(screen, mouse, gamestate)
                 if button == "resign" and not replay:
+                    # stop the gantry at its next waypoint
+                    gamestate.cancel_gantry()
                     # user has resigned the game
                     if gameover(("resign", gamestate.get_opponentcolor()), gamestate):
                         draw = False
@@ -114,6 +116,8 @@ def init_chessboard(challengerName, gamestate):
                         time.sleep(3)
                         break
                 if button == "abort" and not replay:
+                    # stop the gantry at its next waypoint
+                    gamestate.cancel_gantry()
                     # user has aborted the game
                     if gameover(("abort", gamestate.get_opponentcolor()), gamestate):
                         draw = False
@@ -437,6 +441,9 @@ def gameover(reason, gamestate):
 
     display_alert(gamestate.message)
 
+    # reset the physical board while the user picks the next game
+    gamestate.start_board_reset()
+
 """
 updating and drawing gamestate on screen
 """
@@ -19,16 +19,51 @@ from Engine import chessboard, audio, gui_pages as pages
 from Engine.lichess import lichessInterface_new as interface
 
 from Engine.x328p_interface import x328p_gantry_interface as gantry_interface
+from Engine.x328p_interface import x328p_gantry_planner as gantry_planner
+from Engine.x328p_interface import x328p_gantry_driver as gantry_driver
 from Engine.x328p_interface import x328p_fs_interface as fs_interface
 
 
 isSoundOn = False
 wGantry = True
+# keep planned gantry paths on disk between sessions
+persistGantryPaths = True
+
+# scan the squares each gantry move touched and correct misplaced pieces, at most this many times per move
+gantryCorrections = 2
 
 fastscanning = False
 
 fastscanQueue = mp.Queue()
 
+if persistGantryPaths:
+    gantry_interface.enable_path_cache_persistence()
+
+# travel times fitted by the last gantry calibration (x328p_gantry_calibrate.py); fixed estimates otherwise
+gantry_interface.load_motion_model()
+
+# runs gantry moves on its own thread so the GUI keeps drawing while pieces move
+gantryDriver = gantry_driver.GantryDriver(gantry_interface.ser)
+
+# starting board state by user color; the board is drawn (and laid out on the gantry) from the user's side
+startBoards = {
+    'w': [["bR", "bH", "bB", "bQ", "bK", "bB", "bH", "bR"],
+          ["bP", "bP", "bP", "bP", "bP", "bP", "bP", "bP"],
+          ["--", "--", "--", "--", "--", "--", "--", "--"],
+          ["--", "--", "--", "--", "--", "--", "--", "--"],
+          ["--", "--", "--", "--", "--", "--", "--", "--"],
+          ["--", "--", "--", "--", "--", "--", "--", "--"],
+          ["wP", "wP", "wP", "wP", "wP", "wP", "wP", "wP"],
+          ["wR", "wH", "wB", "wQ", "wK", "wB", "wH", "wR"]],
+    'b': [["wR", "wH", "wB", "wK", "wQ", "wB", "wH", "wR"],
+          ["wP", "wP", "wP", "wP", "wP", "wP", "wP", "wP"],
+          ["--", "--", "--", "--", "--", "--", "--", "--"],
+          ["--", "--", "--", "--", "--", "--", "--", "--"],
+          ["--", "--", "--", "--", "--", "--", "--", "--"],
+          ["--", "--", "--", "--", "--", "--", "--", "--"],
+          ["bP", "bP", "bP", "bP", "bP", "bP", "bP", "bP"],
+          ["bR", "bH", "bB", "bK", "bQ", "bB", "bH", "bR"]]}
+
 """
 -------------------------------
 GameState Class
@@ -83,15 +118,7 @@ class GameState():
             self.number_to_x = {'1':7, '2':6, '3':5, '4':4, '5':3, '6':2, '7':1, '8':0}
 
             # board state
-            self.board = [
-                ["bR", "bH", "bB", "bQ", "bK", "bB", "bH", "bR"],
-                ["bP", "bP", "bP", "bP", "bP", "bP", "bP", "bP"],
-                ["--", "--", "--", "--", "--", "--", "--", "--"],
-                ["--", "--", "--", "--", "--", "--", "--", "--"],
-                ["--", "--", "--", "--", "--", "--", "--", "--"],
-                ["--", "--", "--", "--", "--", "--", "--", "--"],
-                ["wP", "wP", "wP", "wP", "wP", "wP", "wP", "wP"],
-                ["wR", "wH", "wB", "wQ", "wK", "wB", "wH", "wR"]]
+            self.board = [row[:] for row in startBoards['w']]
 
             self.userMove = True
 
@@ -102,19 +129,32 @@ class GameState():
             self.number_to_x = {'1':0, '2':1, '3':2, '4':3, '5':4, '6':5, '7':6, '8':7}
 
             # board state
-            self.board = [
-                ["wR", "wH", "wB", "wK", "wQ", "wB", "wH", "wR"],
-                ["wP", "wP", "wP", "wP", "wP", "wP", "wP", "wP"],
-                ["--", "--", "--", "--", "--", "--", "--", "--"],
-                ["--", "--", "--", "--", "--", "--", "--", "--"],
-                ["--", "--", "--", "--", "--", "--", "--", "--"],
-                ["--", "--", "--", "--", "--", "--", "--", "--"],
-                ["bP", "bP", "bP", "bP", "bP", "bP", "bP", "bP"],
-                ["bR", "bH", "bB", "bK", "bQ", "bB", "bH", "bR"]]
+            self.board = [row[:] for row in startBoards['b']]
 
             self.userMove = False
 
         self.defaultState = self.board        
+        # per-colour occupancy bitboards in the bit order of a fast scan; kept in step by set_board_cell
+        self.wOccupancy = fs_interface.board_occupancy(self.board, 'w')
+        self.bOccupancy = fs_interface.board_occupancy(self.board, 'b')
+
+        # buffer slots whose piece is staged beside the promotion rank: (color, row, column) -> staging cell
+        self.stagedSlots = {}
+        # 17x25 gantry position grid; built once here, then updated with each board/buffer change
+        self.posGrid = gantry_planner.position_grid_from_gamestate(self)
+        # free/filled capture buffer slots, shared with the gantry planner
+        self.bufferAllocator = gantry_planner.buffer_allocator_from_gamestate(self)
+        # futures of gantry jobs submitted to gantryDriver that have not been checked yet
+        self.gantryJobs = []
+        # idle parking job; cancelled when a real gantry job starts
+        self.parkingJob = None
+        # gantry job -> (board columns it touched, corrections made so far); checked once the gantry is idle
+        self.gantryChecks = {}
+        self.pendingChecks = []
+        # message shown once the running gantry jobs are done (i.e a promoted piece to swap in by hand)
+        self.gantryNote = ""
+        # where the user puts the piece they just captured, shown once their move is made
+        self.intakeNote = ""
 
         # indicates how many turns have occurred
         self.turn = 0
@@ -136,6 +176,13 @@ class GameState():
         # indicates if game is over
         self.gameOver = False
 
+        # finish the reset of the last game's board towards this game's layout before anything else moves
+        if wGantry:
+            resetJob = gantry_interface.boardReset.resume(gantryDriver, self.posGrid)
+            if resetJob is not None:
+                self.message = "Gantry moving: setting up the board"
+                self.gantryJobs.append(resetJob)
+
 
     """ get user color """
     def get_usercolor(self):
@@ -173,10 +220,41 @@ class GameState():
     """ move piece to destination """
     def replace_piece_onboard(self, move, piece):
         # set original cell to empty and place piece on destination cell
-        self.board[self.number_to_x[move[1]]][self.letter_to_y[move[0]]] = "--"
-        self.board[self.number_to_x[move[3]]][self.letter_to_y[move[2]]] = piece
+        self.set_board_cell(self.number_to_x[move[1]], self.letter_to_y[move[0]], "--")
+        self.set_board_cell(self.number_to_x[move[3]], self.letter_to_y[move[2]], piece)
         return
 
+    """ write a board cell and apply the same delta to the gantry position grid and occupancy bitboards """
+    def set_board_cell(self, x, y, piece):
+        bit = fs_interface.board_bit(x, y)
+        self.wOccupancy &= ~bit
+        self.bOccupancy &= ~bit
+        if piece[0] == 'w':
+            self.wOccupancy |= bit
+        elif piece[0] == 'b':
+            self.bOccupancy |= bit
+        self.board[x][y] = piece
+        self.posGrid.set_piece(gantry_planner.board_to_grid(x, y), piece)
+
+    """ write a capture buffer slot and apply the same delta to the gantry position grid """
+    def set_buffer_cell(self, color, row, column, piece):
+        if color == 'w':
+            self.wBuffer[row][column] = piece
+        else:
+            self.bBuffer[row][column] = piece
+        staged = self.stagedSlots.pop((color, row, column), None)
+        if staged is not None:
+            # the staged piece is taken from its staging cell
+            self.posGrid.set_piece(staged, None)
+        self.posGrid.set_piece(gantry_planner.buffer_to_grid(color, row, column), piece)
+        self.bufferAllocator.set_slot(color, row, column, piece)
+
+    """ move the piece in a buffer slot out to a staging cell; the slot keeps it until it is used """
+    def stage_buffer_cell(self, color, row, column, cell):
+        self.stagedSlots[(color, row, column)] = [cell[0], cell[1]]
+        self.posGrid.move_piece(gantry_planner.buffer_to_grid(color, row, column), cell)
+        self.bufferAllocator.stage(color, row, column, cell)
+
     def reset_coloredcells(self):
         self.coloredCells.clear()
         self.coloredCells = [(-1,-1),(-1,-1)]
@@ -185,13 +263,134 @@ class GameState():
 #   GAMESTATE MOVES AND CONDITIONS
 # ---------------------------------------------------------------------------
 
+    """ pseudo-legal moves for color ('w' or 'b') as move strings (i.e 'e7e5'); checks, castling rights
+        and en passant are not considered. Captures come first, most valuable victim first """
+    def candidate_moves(self, color):
+        pieceValues = {'P':1, 'H':3, 'B':3, 'R':5, 'Q':9, 'K':0}
+        # board contents by (file, rank); file 0-7 is a-h, rank 1-8
+        squares = {}
+        for letter in self.letter_to_y:
+            for number in self.number_to_x:
+                squares[(ord(letter) - ord('a'), int(number))] = self.board[self.number_to_x[number]][self.letter_to_y[letter]]
+
+        def square_name(file, rank):
+            return chr(ord('a') + file) + str(rank)
+
+        captures = []
+        quietMoves = []
+        def add_move(start, end, suffix=''):
+            move = square_name(start[0], start[1]) + square_name(end[0], end[1]) + suffix
+            if squares[end] == "--":
+                quietMoves.append(move)
+            else:
+                captures.append((pieceValues[squares[end][1]], move))
+
+        rookSteps = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+        bishopSteps = [(1, 1), (1, -1), (-1, 1), (-1, -1)]
+        knightSteps = [(1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2)]
+        for start, piece in squares.items():
+            if piece[0] != color:
+                continue
+            file, rank = start
+            if piece[1] == 'P':
+                forward = 1 if color == 'w' else -1
+                suffix = 'q' if rank + forward in (1, 8) else ''
+                if squares.get((file, rank + forward)) == "--":
+                    add_move(start, (file, rank + forward), suffix)
+                    if rank == (2 if color == 'w' else 7) and squares.get((file, rank + 2 * forward)) == "--":
+                        add_move(start, (file, rank + 2 * forward))
+                for side in (-1, 1):
+                    target = squares.get((file + side, rank + forward))
+                    if target is not None and target != "--" and target[0] != color:
+                        add_move(start, (file + side, rank + forward), suffix)
+                continue
+
+            if piece[1] == 'H' or piece[1] == 'K':
+                steps = knightSteps if piece[1] == 'H' else rookSteps + bishopSteps
+                slide = False
+            else:
+                steps = {'B': bishopSteps, 'R': rookSteps, 'Q': rookSteps + bishopSteps}[piece[1]]
+                slide = True
+            for fileStep, rankStep in steps:
+                end = (file + fileStep, rank + rankStep)
+                while end in squares and (squares[end] == "--" or squares[end][0] != color):
+                    add_move(start, end)
+                    if squares[end] != "--" or not slide:
+                        break
+                    end = (end[0] + fileStep, end[1] + rankStep)
+
+            # castling when the king and rook are home and the squares between are empty
+            homeRank = 1 if color == 'w' else 8
+            if piece[1] == 'K' and start == (4, homeRank):
+                if squares[(7, homeRank)] == color + 'R' and squares[(5, homeRank)] == squares[(6, homeRank)] == "--":
+                    add_move(start, (6, homeRank))
+                if squares[(0, homeRank)] == color + 'R' and \
+                        squares[(1, homeRank)] == squares[(2, homeRank)] == squares[(3, homeRank)] == "--":
+                    add_move(start, (2, homeRank))
+
+        captures.sort(key=lambda capture: -capture[0])
+        return [move for _, move in captures] + quietMoves
+
+    """ plan the gantry moves for the opponent's candidate replies in the background """
+    def start_preplanning(self, replies):
+        gantry_interface.prePlanner.start(PlanningSnapshot(self), replies)
+
+    """ park the gantry head where the opponent's next pickup is expected while the user thinks """
+    def start_parking(self, replies):
+        # every candidate reply starts with a pickup: the captured piece for captures, else the moving piece
+        pickups = {}
+        for reply in replies:
+            if self.get_piece_fromboard(reply[2], reply[3])[0] != "--":
+                pickup = tuple(gantry_planner.square_to_grid(reply[2:4], self.userColor))
+            else:
+                pickup = tuple(gantry_planner.square_to_grid(reply[0:2], self.userColor))
+            pickups[pickup] = pickups.get(pickup, 0) + 1
+        parkingCell = gantry_planner.parking_cell(pickups)
+        if parkingCell is not None:
+            self.parkingJob = gantryDriver.submit(gantryDriver.park(parkingCell))
+
+    """ run deferred gantry jobs (i.e buffering pieces the user captured) while waiting on the opponent """
+    def start_housekeeping(self):
+        gantry_interface.housekeeping.start(gantryDriver, self.posGrid)
+
+    """ stage the likeliest promotion piece beside the file of each opponent pawn on its seventh rank while the
+        user thinks, so the promotion is one short leg; warn now if the buffer has nothing left to promote to """
+    def start_promotion_staging(self):
+        color = 'b' if self.userColor == 'w' else 'w'
+        seventh, last = ('7', '8') if color == 'w' else ('2', '1')
+        promotionRow = gantry_planner.square_to_grid('a' + last, self.userColor)[0]
+        pawnColumns = [gantry_planner.square_to_grid(file + seventh, self.userColor)[1] for file in "abcdefgh"
+                       if self.get_piece_fromboard(file, seventh)[0] == color + 'P']
+        staging, unstaged = gantry_interface.plan_promotion_staging(self.posGrid, self.bufferAllocator, color,
+                                                                    promotionRow, pawnColumns)
+        if len(unstaged) != 0:
+            self.message += " (no spare piece in the buffer to promote to: have one ready)"
+        legs = []
+        for slot, cell, piece in staging:
+            routed = gantry_interface.plan_leg(self.posGrid, gantry_planner.buffer_to_grid(color, slot[0], slot[1]),
+                                               cell, verbose=False)
+            if routed == -1:
+                continue
+            legs += routed
+            self.stage_buffer_cell(color, slot[0], slot[1], cell)
+        if len(legs) != 0:
+            # queued behind the opponent's move; checked like any gantry job before the user's move is scanned
+            self.gantryJobs.append(gantryDriver.submit(gantryDriver.run_legs(legs)))
+
+    """ stop parking so a real move can start """
+    def cancel_parking(self):
+        if self.parkingJob is not None:
+            self.parkingJob.cancel()
+            self.parkingJob = None
+
     """ make a move on local gamestate """
     def move_piece(self, move, castling = False):
 
         # return: '1' = ok, '0' = wrong scan, '-1' = hardware error
-        if wGantry:
+        # the gantry plan for a castling king move already moves the rook
+        if wGantry and not castling:
             if not self.userMove or self.replay:
-                gantry_interface.make_physical_move(self, move)
+                self.start_gantry_move(move)
 
         # length of move string (normally 4, pawn promotion 5)
         moveLength = len(move)
@@ -210,7 +409,8 @@ class GameState():
         if not castling:
             # capturing condition
             if destpiece != "--":
-                self.capture_piece(destpiece)
+                # the grid cell the gantry plans the capture from, so both pick the same buffer slot
+                self.capture_piece(destpiece, gantry_planner.square_to_grid(move[2:4], self.userColor))
             else:
                 # check for pawn movement
                 if startpiece[1] == 'P':
@@ -243,41 +443,139 @@ class GameState():
         return
 
 
-    """ capture piece and move to buffer """
-    def capture_piece(self, piece):
-        pieceColor = piece[0]
-        # if captured piece is black
-        if pieceColor == 'b':
-            # check if captured piece is pawn
-            if piece[1] == 'P':
-                for row in range(4):
-                    for column in range(2):
-                        if self.bBuffer[row][column] == '--':
-                            self.bBuffer[row][column] = piece
-                            return
-            # all pieces other than pawn; bishop, knight, rook, queen
+    """ plan the physical move on the current state and hand it to the gantry driver """
+    def start_gantry_move(self, move):
+        self.cancel_parking()
+        # housekeeping stops after the job it is on; this move is queued right behind it
+        gantry_interface.housekeeping.stop()
+        # planned while the user was thinking if the opponent played a candidate move
+        legs = gantry_interface.prePlanner.take(self.posGrid, move)
+        if legs is not None:
+            job = gantryDriver.run_legs(legs, self.gantry_progress)
+        else:
+            # stream the plan so the head sets off while the rest is routed; planned on a copy, as this
+            # gamestate changes as soon as the move is applied below
+            snapshot = PlanningSnapshot(self)
+            plan = gantry_interface.stream_physical_move(snapshot, move, posGrid=snapshot.posGrid, verbose=False)
+            job = gantryDriver.run_stream(plan, self.gantry_progress)
+        job = gantryDriver.submit(job)
+        self.gantryJobs.append(job)
+        self.gantryChecks[job] = (self.move_columns(move), 0)
+
+    """ board columns a move picks pieces up from or puts them down in """
+    def move_columns(self, move):
+        columns = {self.letter_to_y[move[0]], self.letter_to_y[move[2]]}
+        # castling: the rook starts in the corner and lands beside the king (en passant stays on the end file)
+        if self.get_piece_fromboard(move[0], move[1])[0][1] == 'K' and abs(ord(move[0]) - ord(move[2])) == 2:
+            columns.add(self.letter_to_y['h' if move[2] > move[0] else 'a'])
+            columns.add(self.letter_to_y[chr((ord(move[0]) + ord(move[2])) // 2)])
+        return columns
+
+    """ progress callback for gantry jobs; runs on the gantry driver thread """
+    def gantry_progress(self, waypoint, waypointCount, pos):
+        self.message = "Gantry moving: waypoint " + str(waypoint) + "/" + str(waypointCount)
+
+    """ check on submitted gantry jobs; True while the gantry is still moving """
+    def gantry_busy(self):
+        while len(self.gantryJobs) != 0:
+            job = self.gantryJobs[0]
+            if not job.done():
+                return True
+            self.gantryJobs.pop(0)
+            check = self.gantryChecks.pop(job, None)
+            if not job.cancelled() and job.result() == -1:
+                self.message = "Gantry error: check the board"
             else:
-                for column in range(2):
-                    if self.bBuffer[self.bufferMap[piece[1]]][column] == '--':
-                        self.bBuffer[self.bufferMap[piece[1]]][column] = piece
-                        return
-
-        # if captured piece is white
-        elif pieceColor == 'w':
-            # check if captured piece is pawn, bishop, knight, rook, or queen and place into buffer accordingly
-            if piece[1] == 'P':
-                for row in range(4):
-                    for column in range(2):
-                        if self.wBuffer[row][column] == '--':
-                            self.wBuffer[row][column] = piece
-                            return
-            # all pieces other than pawn; bishop, knight, rook, queen
+                if self.message.startswith("Gantry moving"):
+                    self.message = self.gantryNote
+                if check is not None and not job.cancelled():
+                    self.pendingChecks.append(check)
+        self.gantryNote = ""
+        # scanned once every job is done, so no reading is taken with the head moving
+        while len(self.pendingChecks) != 0:
+            if self.verify_gantry_move(*self.pendingChecks.pop(0)):
+                return True
+        return False
+
+    """ scan the columns a gantry move touched; run corrective drags if a piece is not where it should be
+        returns True if a correction was started """
+    def verify_gantry_move(self, columns, corrections):
+        response = fs_interface.verify_columns(self, columns)
+        if response[0] == 0:
+            return False
+        cells = response[1]
+        print("Gantry move check: incongruent cells", cells)
+        if corrections == gantryCorrections:
+            self.message = "Gantry error: check highlighted cells"
+            self.coloredCells = cells
+            return False
+
+        missing = []
+        extra = []
+        for x, y in cells:
+            if self.board[x][y] != "--":
+                missing.append(gantry_planner.board_to_grid(x, y))
             else:
-                for column in range(2):
-                    if self.wBuffer[self.bufferMap[piece[1]]][column] == '--':
-                        self.wBuffer[self.bufferMap[piece[1]]][column] = piece
-                        return
-        return
+                extra.append(gantry_planner.board_to_grid(x, y))
+        legs, unresolved = gantry_interface.plan_correction(self.posGrid, missing, extra)
+        if len(legs) == 0:
+            self.message = "Gantry error: check highlighted cells"
+            self.coloredCells = cells
+            return False
+        if len(unresolved) != 0:
+            print("Gantry move check: can't correct", unresolved)
+        self.message = "Gantry moving: correcting the last move"
+        job = gantryDriver.submit(gantryDriver.run_legs(legs, self.gantry_progress))
+        self.gantryJobs.append(job)
+        self.gantryChecks[job] = (columns, corrections + 1)
+        return True
+
+    """ stop the gantry at its next waypoint and drop the piece (i.e user resigned mid move) """
+    def cancel_gantry(self):
+        self.cancel_parking()
+        for job in self.gantryJobs:
+            job.cancel()
+
+    """ put the pieces back in the starting layout in the background once the game is over """
+    def start_board_reset(self):
+        if not wGantry:
+            return
+        # paths planned this game that haven't been written out yet
+        gantry_interface.pathCache.save()
+        self.cancel_parking()
+        gantry_interface.prePlanner.discard()
+        # the reset takes pieces still on the intake cells from there, once the housekeeping job ahead of it is done
+        gantry_interface.housekeeping.stop()
+        layout = PlanningSnapshot(self)
+        layout.board = startBoards[self.userColor]
+        layout.wBuffer = [["--", "--"] for _ in range(len(self.wBuffer))]
+        layout.bBuffer = [["--", "--"] for _ in range(len(self.bBuffer))]
+        layout.stagedSlots = {}
+        # queued behind the gantry jobs of the game (i.e the mating move and toppling the king)
+        gantry_interface.boardReset.start(gantryDriver, self.posGrid, gantry_planner.position_grid_from_gamestate(layout))
+
+    """ capture piece and move to buffer; cell is the grid position it was captured at. Returns the buffer slot """
+    def capture_piece(self, piece, cell=None):
+        # the slot closest to the capture square (the gantry planned its capture leg to the same slot)
+        slot = self.bufferAllocator.choose(piece[0], piece[1], cell)
+        if slot is None:
+            print("Capture buffer full:", piece)
+            return
+        self.set_buffer_cell(piece[0], slot[0], slot[1], piece)
+        # the user lifted it off the board and puts it on an intake cell; the gantry takes it to its slot
+        # while the opponent thinks
+        if wGantry and self.userMove and not self.replay:
+            self.intakeNote = "Put the captured piece " + self.queue_intake(piece, slot)
+        return slot
+
+    """ queue the drag of a piece put by the buffers by hand into its slot; returns where it should be put """
+    def queue_intake(self, piece, slot):
+        intake = gantry_interface.housekeeping.intake_cell(piece[0])
+        if intake is None:
+            # every intake cell still holds a piece the gantry hasn't buffered yet
+            return "in buffer row " + str(slot[0] + 1) + ", column " + str(slot[1] + 1)
+        gantry_interface.housekeeping.add(intake, gantry_planner.buffer_to_grid(piece[0], slot[0], slot[1]))
+        return "on the " + ("near" if intake[0] == 0 else "far") + " intake cell by the buffers"
 
 
     """ handles castling: returns corresponding rook if castling, else returns '' """
@@ -309,48 +607,31 @@ class GameState():
         # 5th element of string indicates promotion piece; (b, k, r, q) -> (B, H, R, Q)
         promotionPiece = pieceDict[move[4]]
 
-        # check for user or opponent promotion
-        if self.userMove:
-
-            # put pawn in capture buffer and put return piece on board
-            self.capture_piece(pawn)
-            # find if piece is in return buffer
-            if pawn[0] == 'w':
-                for i in range(2):
-                    if self.wBuffer[self.bufferMap[pieceDict[move[4]]]][i] != '--':
-                        # remove promotion piece from white buffer and return it
-                        self.wBuffer[self.bufferMap[pieceDict[move[4]]]][i] = '--'
-                        return 'w' + promotionPiece
-
-            else:
-                for i in range(2):
-                    if self.bBuffer[self.bufferMap[pieceDict[move[4]]]][i] != '--':
-                        # remove promotion piece from black buffer and return it
-                        self.bBuffer[self.bufferMap[pieceDict[move[4]]]][i] = '--'
-                        return 'b' + promotionPiece
-
-        # opponent promotion
-        else:
-            
-            # put pawn in capture buffer
-            self.capture_piece(pawn)
-            # find if piece is in return buffer
-            if pawn[0] == 'w':
-                for i in range(2):
-                    if self.wBuffer[self.bufferMap[promotionPiece]][i] != '--':
-                        # remove promotion piece from white buffer and return it
-                        self.wBuffer[self.bufferMap[promotionPiece]][i] = '--'
-                        return 'w' + promotionPiece
-
-            else:
-                 for i in range(2):
-                    if self.bBuffer[self.bufferMap[promotionPiece]][i] != '--':
-                        # remove promotion piece from black buffer and return it
-                        self.bBuffer[self.bufferMap[promotionPiece]][i] = '--'
-                        return 'b' + promotionPiece
-            
-            print("Piece not in capture zone!")
-            self.promotion(pawn, move)
+        # put pawn in capture buffer and take the promotion piece from the slot closest to the promotion square
+        promotionCell = gantry_planner.square_to_grid(move[2:4], self.userColor)
+        pawnSlot = self.capture_piece(pawn, promotionCell)
+        # staged beside the promotion rank while the pawn was on the seventh (the gantry plans the same leg)
+        staged = gantry_interface.staged_piece(self.posGrid, pawn[0] + promotionPiece, promotionCell)
+        slot = None if staged is None else self.bufferAllocator.staged_slot(pawn[0], staged)
+        if slot is None:
+            slot = self.bufferAllocator.retrieve(pawn[0], promotionPiece, promotionCell)
+        if slot is not None:
+            # remove promotion piece from buffer and return it
+            self.set_buffer_cell(pawn[0], slot[0], slot[1], '--')
+            return pawn[0] + promotionPiece
+
+        # no spare piece: the board takes the promoted piece and one is swapped in by hand
+        print("Piece not in capture zone!")
+        if not self.userMove:
+            # the gantry leaves the pawn on the promotion square; the user swaps it and puts it by the buffers
+            where = "by the buffers"
+            if wGantry and not self.replay and pawnSlot is not None:
+                where = self.queue_intake(pawn, pawnSlot)
+            # kept once the gantry moving messages clear
+            self.gantryNote = "Opponent promoted on " + move[2:4] + ": swap the pawn for a " + promotionPiece + \
+                              ", put the pawn " + where
+            self.message = self.gantryNote
+        return pawn[0] + promotionPiece
 
 
     """ handles en passant move by pawns """
@@ -361,10 +642,10 @@ class GameState():
             if destpiece == '--': 
                 # en passant; find captured piece (i.e move=a2b3, capturedPiece=b2)
                 capturedPawn = self.board[self.number_to_x[move[1]]][self.letter_to_y[move[2]]]
-                self.capture_piece(capturedPawn)
+                self.capture_piece(capturedPawn, gantry_planner.square_to_grid(move[2] + move[1], self.userColor))
 
                 # empty cell occupied by captured pawn
-                self.board[self.number_to_x[move[1]]][self.letter_to_y[move[2]]] = '--'
+                self.set_board_cell(self.number_to_x[move[1]], self.letter_to_y[move[2]], '--')
 
         return
 
@@ -378,6 +659,10 @@ class GameState():
 
         # tk.Tk().wm_withdraw()
         # tk.messagebox.askquestion('Move Resolution', 'Was this your intended move?')
+        # let the gantry finish the last move before taking the next one; the GUI keeps drawing meanwhile
+        if self.gantry_busy():
+            return 'ok'
+
         if self.replay:
             if self.replay_move():
                 return 'ok'
@@ -395,6 +680,16 @@ class GameState():
                     self.move_piece(move)
                     self.userMove = False
                     self.message = "Opponent's Turn..."
+                    if wGantry:
+                        if self.intakeNote != "":
+                            self.message = "Opponent's Turn... " + self.intakeNote
+                            self.intakeNote = ""
+                        opponentColor = 'b' if self.userColor == 'w' else 'w'
+                        replies = self.candidate_moves(opponentColor)
+                        self.start_preplanning(replies)
+                        # queued ahead of parking, which skips itself while housekeeping runs
+                        self.start_housekeeping()
+                        self.start_parking(replies)
                     return "ok"
 
             # opponent's move
@@ -411,12 +706,16 @@ class GameState():
                     # move piece on local gamestate board
                     self.move_piece(move)
                     self.userMove = True
+                    if wGantry:
+                        self.start_promotion_staging()
 
                     return "ok"
                 # other responses (i.e resgination, checkmate, abort) 
                 else:
                     if move[0] == "mate":
                         self.move_piece(move[2])
+                        # send topple king message to gantry; queued behind the mating move
+                        topple_king(self, move[1])
                     return move
 
 
@@ -541,8 +840,6 @@ class GameState():
                         # check if the move caused mate
                         if event["status"] == "mate":
                             self.gameOver = True
-                            # send topple king message to gantry
-                            topple_king(self, event['winner'])
                             return ('mate', event['winner'], move)
                         else:
                             return move
@@ -571,11 +868,21 @@ class GameState():
         self.board = self.defaultState
         self.wBuffer = self.defaultBuffer
         self.bBuffer = self.defaultBuffer
+        self.wOccupancy = fs_interface.board_occupancy(self.board, 'w')
+        self.bOccupancy = fs_interface.board_occupancy(self.board, 'b')
         self.turns = 0
         self.coloredCells = [(-1, -1), (-1, -1)]
         self.gameover = False
         self.message = ""
         self.previousMovesEvent = None
+        self.stagedSlots = {}
+        self.posGrid = gantry_planner.position_grid_from_gamestate(self)
+        self.bufferAllocator = gantry_planner.buffer_allocator_from_gamestate(self)
+        gantry_interface.prePlanner.discard()
+        gantry_interface.housekeeping.discard()
+        self.gantryChecks = {}
+        self.pendingChecks = []
+        self.intakeNote = ""
 
     """ print board """
     def __str__(self):
@@ -584,6 +891,18 @@ class GameState():
 
         return ''
 
+""" PlanningSnapshot: copy of the parts of a gamestate the gantry planner reads, for planning on another thread
+"""
+class PlanningSnapshot():
+    def __init__(self, gamestate):
+        self.userColor = gamestate.userColor
+        self.posGrid = gamestate.posGrid.copy()
+        self.wBuffer = [row[:] for row in gamestate.wBuffer]
+        self.bBuffer = [row[:] for row in gamestate.bBuffer]
+        self.stagedSlots = dict(gamestate.stagedSlots)
+        self.bufferMap = gamestate.bufferMap
+        self.bufferAllocator = gamestate.bufferAllocator.copy()
+
 """ check_responses: check for responses sent by 328ps
     params: gamestate, rtype (type of response), response (response message)
     return:
@@ -644,24 +963,12 @@ def topple_king(gamestate, winner):
     else:
         king = "wK"
 
-    # mapping from board indices to chessboard coords
-    if gamestate.get_usercolor == "white":
-        row2number = {0:"8", 1:"7", 2:"6", 3:"5", 4:"4", 5:"3", 6:"2", 7:"1"}
-        col2letter = {0:"a", 1:"b", 2:"c", 3:"d", 4:"e", 5:"f", 6:"g", 7:"h"}
-    else:
-        row2number = {0:"1", 1:"2", 2:"3", 3:"4", 4:"5", 5:"6", 6:"7", 7:"8"}
-        col2letter = {0:"h", 1:"g", 2:"f", 3:"e", 4:"d", 5:"c", 6:"b", 7:"a"}
-
-    for row in gamestate.board:
-        for col in row:
-            cell = board[row][col]
-            if cell == king:
-                coords = col2letter[col] + row2number[row]
-                # send the coordinates of losing king to gantry and check response
-                if check_response(gamestate, 'topking_check', gantry_interface.topple_king(coords)) == 0: return
-                else:
-                    print("Error in toppling king")
+    kingPos = gamestate.posGrid.find(king)
+    if kingPos is None:
+        print("Error in toppling king: king not found")
+        return
 
-                return
+    # runs after any gantry job already submitted (i.e the mating move)
+    gamestate.gantryJobs.append(gantryDriver.submit(gantryDriver.topple_king(kingPos)))
 
     return
\ No newline at end of file
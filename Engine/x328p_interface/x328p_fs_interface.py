@@ -1,9 +1,9 @@
 # Module and helper functions for interfacing with fast scanning 328P via I2C Authors: Weishan Li, Jack DeGuglielmo Date: 2020-11-01
-import numpy as np
 from datetime import datetime
 import time
 import serial
 import spidev
+from Engine.x328p_interface import x328p_gantry_interface as gantry_interface
 spi = spidev.SpiDev()
 bus = 0
 device = 0
@@ -13,6 +13,28 @@ spi.open(bus, device)
 spi.max_speed_hz = 5000
 spi.mode = 0b00
 
+# Burst scan: SPI command 8 followed by 8 dummy bytes, clocked out as one transfer; the 328P answers with the
+# column bytes 0-7 in the dummy bytes. Set burstScan False for HallSensor firmware without the command
+burstScan = True
+BURST_COMMAND = 8
+BURST_SPEED_HZ = 250000
+BURST_BYTE_DELAY_US = 50    # gap after each byte for the 328P to read the next column into SPDR
+# Byte value -> same byte with its bits reversed: the 328P sends sensor row 0 in bit 0, gamestate bytes have
+# rank 8 in bit 7
+REVERSED_BITS = bytes(int('{:08b}'.format(value)[::-1], 2) for value in range(256))
+
+# Change line from the HallSensor 328P (PB1) on a Pi GPIO input: high while the board differs from the last
+# column bytes read. Without RPi.GPIO (i.e off the Pi) the fast scan polls every SCAN_POLL_SECONDS instead
+CHANGE_PIN = 25             # BCM numbering
+CHANGE_TIMEOUT = 0.5        # longest wait on the line before a frame is read anyway (i.e a missed edge)
+SCAN_POLL_SECONDS = 0.005   # scan period without the line, and while the scan filter has a change pending
+try:
+    import RPi.GPIO as GPIO
+    GPIO.setmode(GPIO.BCM)
+    GPIO.setup(CHANGE_PIN, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+except (ImportError, RuntimeError):
+    GPIO = None
+
 ser = serial.Serial("/dev/ttyS0", 9600)  # Open port with baud rate
 letterToColumn = {'a': 0, 'b': 1, 'c': 2, 'd': 3, 'e': 4, 'f': 5,'g': 6,'h': 7}  # To translate cell to posMap location
 columnToLetter = {0: 'a', 1: 'b', 2: 'c', 3: 'd', 4: 'e', 5: 'f', 6: 'g', 7: 'h'}
@@ -59,164 +81,179 @@ class gamestateMessage():
         print("Cell:",cell)
         return cell
     """
-def resolve_chess_move(gs, messageArray):
-    #print("Resolving Move...")
-    #print("GS: ", gs)
-    #print("Sam's Message Array:", messageArray)
-    start_found = False
-    dest_found = False
-
-    start_pos = ""
-    dest_pos = ""
-
-    # loop through each column
-    for c in range(len(gs)):
-        # convert column to byte form to compare with fast scan byte (i.e 0b11000011)
-        column = column_to_byte(get_column_byIndex(gs, c))
-        #print("column:",column)
-        fs_column = messageArray[c].data
-        #print("fs_column:",bin(fs_column))
-        # loop through each cell of column
-        for i in range(len(gs)):
-            # bit shift to find value of current cell
-            cell = (column >> i) & 1
-            cell_fs = (fs_column >> i) & 1
-
-            # check for start location; once found, turn bool off
-            if cell_fs == 0 and cell == 1 and not start_found: 
-                start_cell_letter = columnToLetter[c]    
-                start_cell_number = i+1
-
-                # convert to chess coordinates and concatenate (i.e a2)
-                start_pos = start_cell_letter + str(start_cell_number)
-                start_found = True
-            
-            # check for destination location; once found, turn bool off
-            if cell_fs == 1 and cell == 0 and not dest_found:
-                dest_cell_letter = columnToLetter[c]
-                dest_cell_number = i+1
-
-                # convert to chess coordinates and concatenate (i.e b4)
-                dest_pos = dest_cell_letter + str(dest_cell_number)
-                dest_found = True
-    return start_pos + dest_pos
-
-
-def find_start_cell(gs, messageArray):
-    start_pos = ""
-
-    # loop through each column
-    for c in range(len(gs)):
-        # convert column to byte form to compare with fast scan byte (i.e 0b11000011)
-        column = column_to_byte(get_column_byIndex(gs, c))
-        # print("init column:", bin(column))
-        # print("column:",column)
-        fs_column = messageArray[c].data
-        # print("fs_column:",bin(fs_column))
-        # loop through each cell of column
-        for i in range(len(gs)):
-            # bit shift to find value of current cell
-            # print("Evaluating:", gs[7-i][c])
-            cell = (column >> i) & 1
-            cell_fs = (fs_column >> i) & 1
-
-            # check for start location; once found, turn bool off
-            if cell_fs == 0 and cell == 1:
-                start_cell_letter = columnToLetter[c]
-                start_cell_number = i + 1
-
-                # convert to chess coordinates and concatenate (i.e a2)
-                start_pos = start_cell_letter + str(start_cell_number)
-                # print("Column before:", gs[c-1])
-                # print("Column after:", gs[c + 1])
-                # print("GS[c]:",gs[c])
-                # print("cell at:",gs[c+1][7-i])
-                # print("cell before:", gs[c+1][6 - i])
-                # print("cell after:", gs[c+1][8 - i])
-
-                return [start_pos, gs[7-i][c]]
-
-    return -1
-
-def resolve_chess_move_v2(gs, statePrev, stateNext):
-    # print("Resolving Move...")
-    # print("GS: ", gs)
-    # print("Sam's Message Array:", messageArray)
-    if compare_message_lists(statePrev, stateNext):
-        print("Same state transmitted")
-        return 1
-
-    cell = ""
-
-    # loop through each column
-    for c in range(8):
-        fs_columnPrev = statePrev[c].data
-        fs_columnNext = stateNext[c].data
-        # print("fs_column:",bin(fs_column))
-        # loop through each cell of column
-        for i in range(8):
-            # bit shift to find value of current cell
-            cellBitPrev = (fs_columnPrev >> i) & 1
-            cellBitNext = (fs_columnNext >> i) & 1
-
-            # check for start location; once found, turn bool off
-            if cellBitPrev == 0 and cellBitNext == 1:
-                start_cell_letter = columnToLetter[c]
-                start_cell_number = i + 1
-
-                # convert to chess coordinates and concatenate (i.e a2)
-                cell = start_cell_letter + str(start_cell_number)
-                return [cell, gs[c][7-i]]
-
-            elif cellBitPrev == 1 and cellBitNext == 0:
-                start_cell_letter = columnToLetter[c]
-                start_cell_number = i + 1
-
-                # convert to chess coordinates and concatenate (i.e a2)
-                cell = start_cell_letter + str(start_cell_number)
-                return [cell, gs[c][7-i]]
-    return -1
-
-def resolve_chess_move_v3(gs, statePrev, stateNext):
-    # print("Resolving Move...")
-    # print("GS: ", gs)
-    # print("Sam's Message Array:", messageArray)
-    #if compare_message_lists(statePrev, stateNext):
-    #    print("Same state transmitted")
-    #    return 1
-
-    cell = ""
-
-    # loop through each column
-    for c in range(8):
-        fs_columnPrev = statePrev[c].data
-        fs_columnNext = stateNext[c].data
-        # print("fs_column:",bin(fs_column))
-        # loop through each cell of column
-        for i in range(8):
-            # bit shift to find value of current cell
-            cellBitPrev = (fs_columnPrev >> i) & 1
-            cellBitNext = (fs_columnNext >> i) & 1
-
-            # check for start location; once found, turn bool off
-            if cellBitPrev == 0 and cellBitNext == 1:
-                start_cell_letter = columnToLetter[c]
-                start_cell_number = i + 1
-
-                # convert to chess coordinates and concatenate (i.e a2)
-                cell = start_cell_letter + str(start_cell_number)
-                #print(gs[7-i])
-                return [cell, gs[7-i][c]]
-
-            elif cellBitPrev == 1 and cellBitNext == 0:
-                start_cell_letter = columnToLetter[c]
-                start_cell_number = i + 1
-
-                # convert to chess coordinates and concatenate (i.e a2)
-                cell = start_cell_letter + str(start_cell_number)
-                return [cell, gs[7-i][c]]
-    return -1
-
+# Number of set bits (int.bit_count is Python 3.10+)
+def popcount(bits):
+    return bin(bits).count('1')
+
+# Resolves the user's move from fast scans as packed occupancies (see board_bit). Each scan is compared with
+# the occupancy at the start of the move: own pieces up, empty squares now filled, and opponent squares that
+# were lifted at some point (everLifted) and have a piece on them again, i.e the capturing piece. Every
+# transition reduces to one of these shapes, with a fixed number of bit operations per scan:
+#   lift          own pieces up, nothing put down yet
+#   capture-lift  an opponent piece up (before or after the capturing piece is lifted)
+#   drop          a piece put down with no own piece up (i.e a piece put back is no change at all)
+#   move          one own piece up, one empty square filled
+#   capture       one own piece up, a lifted opponent square filled again
+#   en passant    own pawn up, the opponent pawn beside it up, the empty square diagonally ahead filled
+#   castling      king and rook up, the two squares next to the king on the rook's side filled
+#   invalid       anything else; scanning goes on, as the user may still be putting pieces right
+class MoveResolver():
+    def __init__(self, gs):
+        color = gs.userColor
+        self.own = gs.wOccupancy if color == 'w' else gs.bOccupancy
+        self.opponent = gs.bOccupancy if color == 'w' else gs.wOccupancy
+        self.start = self.own | self.opponent
+        self.everLifted = 0
+        self.state = 'none'
+        # side-to-move pieces the bit patterns depend on
+        self.pawns = 0
+        self.rooks = 0
+        self.kings = 0
+        # single bit -> square name (i.e 'e2')
+        self.squareNames = {}
+        yToLetter = {y: letter for letter, y in gs.letter_to_y.items()}
+        xToNumber = {x: number for number, x in gs.number_to_x.items()}
+        for x in range(8):
+            for y in range(8):
+                bit = board_bit(x, y)
+                self.squareNames[bit] = yToLetter[y] + xToNumber[x]
+                if gs.board[x][y] == color + 'P':
+                    self.pawns |= bit
+                elif gs.board[x][y] == color + 'R':
+                    self.rooks |= bit
+                elif gs.board[x][y] == color + 'K':
+                    self.kings |= bit
+
+    # Classifies a scan into self.state; returns the move (i.e 'e2e4', or the king move when castling) once
+    # one is complete, else None
+    def update(self, occupancy):
+        self.everLifted |= self.start & ~occupancy
+        lifted = self.own & ~occupancy
+        filled = occupancy & ~self.start
+        retaken = self.opponent & self.everLifted & occupancy
+        captured = self.opponent & ~occupancy
+        liftedCount = popcount(lifted)
+
+        if liftedCount == 0:
+            if filled != 0:
+                self.state = 'drop'
+            else:
+                self.state = 'capture-lift' if captured != 0 else 'none'
+            return None
+
+        if liftedCount == 1:
+            if filled == 0 and retaken == 0:
+                self.state = 'capture-lift' if captured != 0 else 'lift'
+                return None
+            if popcount(filled | retaken) != 1:
+                self.state = 'invalid'
+                return None
+            if retaken != 0 and captured == 0:
+                self.state = 'capture'
+                return self.squareNames[lifted] + self.squareNames[retaken]
+            if captured == 0:
+                # the king two files over is castling and a pawn on another file is en passant, both half done
+                if lifted & self.kings != 0 and filled in (self.shift(lifted, 16), self.shift(lifted, -16)) or \
+                        lifted & self.pawns != 0 and self.file_of(lifted) != self.file_of(filled):
+                    self.state = 'lift'
+                    return None
+                self.state = 'move'
+                return self.squareNames[lifted] + self.squareNames[filled]
+            # the pawn taken en passant stands on the start rank (same bits in the byte) of the end file
+            if lifted & self.pawns != 0 and retaken == 0 and \
+                    captured == self.same_rank(filled, lifted):
+                self.state = 'en passant'
+                return self.squareNames[lifted] + self.squareNames[filled]
+            self.state = 'invalid'
+            return None
+
+        king = lifted & self.kings
+        if liftedCount == 2 and king != 0 and captured == 0 and retaken == 0:
+            rook = lifted & ~king & self.rooks
+            for step in (8, -8):
+                kingEnd = self.shift(king, 2 * step)
+                rookEnd = self.shift(king, step)
+                if rook in (self.shift(king, 3 * step), self.shift(king, 4 * step)):
+                    if filled == kingEnd | rookEnd:
+                        self.state = 'castling'
+                        return self.squareNames[king] + self.squareNames[kingEnd]
+                    if filled & ~(kingEnd | rookEnd) == 0:
+                        self.state = 'lift'
+                        return None
+        self.state = 'invalid'
+        return None
+
+    # bit moved by count bits (8 per file), towards bit 63 if count is positive
+    def shift(self, bit, count):
+        return bit << count if count > 0 else bit >> -count
+
+    # column (gamestate board y) of a single bit
+    def file_of(self, bit):
+        return (bit.bit_length() - 1) // 8
+
+    # bit of the square on the file of fileBit and the rank of rankBit
+    def same_rank(self, fileBit, rankBit):
+        fileBits = 0xFF << (8 * self.file_of(fileBit))
+        rankBits = 0x0101010101010101 << ((rankBit.bit_length() - 1) % 8)
+        return fileBits & rankBits
+
+
+# A cell change has to last this long, over at least this many scans, before move resolution sees it; shorter
+# changes are a piece carried over the cell or a flickering sensor
+SCAN_FILTER_DWELL = 0.08
+SCAN_FILTER_FRAMES = 3
+
+# Debounces packed scans cell by cell: a cell takes a new reading once the reading has held for dwell seconds and
+# frames scans in a row. Only cells whose reading changed or is pending are looked at, so a quiet board costs two
+# XORs per scan. transitions counts raw cell changes, accepted the ones let through
+class ScanFilter():
+    def __init__(self, occupancy, dwell=SCAN_FILTER_DWELL, frames=SCAN_FILTER_FRAMES):
+        self.dwell = dwell
+        self.frames = frames
+        self.raw = occupancy
+        self.filtered = occupancy
+        self.frame = 0
+        # per cell bit index: time and scan number of its last raw change
+        self.changedAt = [0.0] * 64
+        self.changedFrame = [0] * 64
+        self.transitions = 0
+        self.accepted = 0
+
+    # Filtered occupancy after the scan occupancy taken at time now (time.monotonic() by default)
+    def update(self, occupancy, now=None):
+        if now is None:
+            now = time.monotonic()
+        self.frame += 1
+        changed = occupancy ^ self.raw
+        self.raw = occupancy
+        while changed != 0:
+            lowest = changed & -changed
+            bit = lowest.bit_length() - 1
+            self.changedAt[bit] = now
+            self.changedFrame[bit] = self.frame
+            self.transitions += 1
+            changed ^= lowest
+
+        pending = occupancy ^ self.filtered
+        settled = 0
+        while pending != 0:
+            lowest = pending & -pending
+            bit = lowest.bit_length() - 1
+            if now - self.changedAt[bit] >= self.dwell and self.frame - self.changedFrame[bit] + 1 >= self.frames:
+                settled |= lowest
+            pending ^= lowest
+        if settled != 0:
+            self.filtered ^= settled
+            self.accepted += popcount(settled)
+        return self.filtered
+
+    # True while a cell's reading differs from the filtered one
+    def pending(self):
+        return self.raw != self.filtered
+
+    # raw cell changes that were undone before they settled (a flicker on and off is two)
+    def suppressed(self):
+        return self.transitions - self.accepted - popcount(self.raw ^ self.filtered)
 
 
 def compare_message_lists(stateA, stateB):
@@ -273,17 +310,47 @@ def column_to_byte(column):
     #print(bin(columnInt))
     return columnInt
 
+# Occupancy bit of gamestate board[x][y]: column y in bits 8y to 8y+7, rank 8 (x = 0) in the top bit, as
+# receive_occupancy packs a scan
+def board_bit(x, y):
+    return 1 << (y * 8 + 7 - x)
+
+# Packed occupancy of the pieces on board (a gamestate board) whose name starts with color
+def board_occupancy(board, color):
+    occupancy = 0
+    for x in range(8):
+        for y in range(8):
+            if board[x][y][0] == color:
+                occupancy |= board_bit(x, y)
+    return occupancy
+
+# Same check as compare_chess_states on packed occupancies: (0, None), or (5, incongruent gamestate cells)
+def compare_occupancy(boardOccupancy, occupancy):
+    difference = boardOccupancy ^ occupancy
+    if difference == 0:
+        return (0, None)
+    incongruentCells = []
+    while difference != 0:
+        lowest = difference & -difference
+        bit = lowest.bit_length() - 1
+        incongruentCells.append((7 - bit % 8, bit // 8))
+        difference ^= lowest
+    return (5, incongruentCells)
+
+# Post-move check: reads only the columns a gantry move touched and compares them with the gamestate
+def verify_columns(gs, columns):
+    mask = 0
+    for column in columns:
+        mask |= 0xFF << (8 * column)
+    return compare_occupancy((gs.wOccupancy | gs.bOccupancy) & mask, receive_board_occupancy(columns) & mask)
+
 def initial_error_check(gs):
-    newGs = np.array(gs.board)
     print("Starting initial check...")
     #send_to_328p(0b00101000,"Initial Check Data")
-    samInitialState = receive_chess_state()
-    print_gamestate_list(samInitialState)
-    if samInitialState == -1:
-        print("Error in reading Sam State")
-        return [-1, None]
+    occupancy = receive_board_occupancy()
+    print_gamestate_list(occupancy_messages(occupancy))
     # Check congruency
-    return compare_chess_states(newGs, samInitialState)
+    return compare_occupancy(gs.wOccupancy | gs.bOccupancy, occupancy)
 
 
 # Receive message from 328P via UART
@@ -296,41 +363,88 @@ def recv_from_328p(timeout):
         x = ser.read()
 """
 
+# Seconds the head has to be still before hall readings are trusted again
+SCAN_SETTLE_SECONDS = 0.05
+
+# Blocks until the gantry head has been still for SCAN_SETTLE_SECONDS; returns the head motion count it saw
+def wait_for_still_head():
+    while True:
+        gantry_interface.headStill.wait()
+        motions = gantry_interface.headMotions
+        settle = gantry_interface.headStoppedAt + SCAN_SETTLE_SECONDS - time.monotonic()
+        if settle > 0:
+            time.sleep(settle)
+        if gantry_interface.headStill.is_set() and motions == gantry_interface.headMotions:
+            return motions
+
 def receive_chess_state():
     # print("Waiting for Sam's Chess State...")
-    samState = []
-    for i in range(8):
-        # Serial receive 2 bytes from Sam
-        # ser.flush()
-        # rawRecByte0 = ser.read()
-        send_to_328p(i, "Requesting Column "+ str(i))
-        rawRecByte0 = spi.readbytes(1)
-        #time.sleep(0.003)
-        # Maybe add a delay here
-        # rawRecByte1 = ser.read()
-
-        #rawRecByte1 = ser.readbytes(1)
-        now = datetime.now()
-        #recByte0 = int.from_bytes(rawRecByte0, 'little')
-        # print("Byte 0 Received:", format(recByte0, '#010b'))
-        recByte0Mirror = int.from_bytes(rawRecByte0, 'little')
-        recByte0 = int('{:08b}'.format(recByte0Mirror)[::-1], 2)
-        # print("Byte 1 Received:", format(recByte1, '#010b'))
-        # recByte0 = 0b11110010
-        # recByte1 = 0b11000011
-        #messageType = (recByte0 >> 3)
-        messageType = 0
-        #messageCol = recByte0 & 0b00000111
-        messageCol = i
-        currentMessage = gamestateMessage(messageType, messageCol, recByte0)
-        currentMessage.timestamp = now
-        #time.sleep(0.03)
-        #print(currentMessage)
-        # Figure out message type
-        # messageTypeStr = message_types[messageType]
-
-        samState.append(currentMessage)
-    return samState
+    return receive_chess_columns(range(8))
+
+def receive_chess_columns(columns):
+    return occupancy_messages(receive_board_occupancy(columns), columns)
+
+# Reads the given columns with the gantry head still, packed as receive_occupancy packs them (a burst reads
+# the other columns too); a read the head started moving during is thrown away
+def receive_board_occupancy(columns=range(8)):
+    while True:
+        motions = wait_for_still_head()
+        if burstScan:
+            occupancy = receive_occupancy()
+        else:
+            occupancy = 0
+            for i in columns:
+                occupancy |= receive_chess_column(i).data << (8 * i)
+        if gantry_interface.headStill.is_set() and motions == gantry_interface.headMotions:
+            return occupancy
+
+# Reads the whole board in one SPI transfer; returns the occupancy packed into 64 bits, column i in bits
+# 8i to 8i+7 in the bit order of gamestateMessage.data
+def receive_occupancy():
+    reply = spi.xfer([BURST_COMMAND] + [0] * 8, BURST_SPEED_HZ, BURST_BYTE_DELAY_US)
+    # the byte clocked in with the command is whatever was left in SPDR
+    return int.from_bytes(bytes(reply[1:]).translate(REVERSED_BITS), 'little')
+
+# Column messages for a packed occupancy, as receive_chess_column returns them
+def occupancy_messages(occupancy, columns=range(8)):
+    now = datetime.now()
+    messages = []
+    for i in columns:
+        message = gamestateMessage(0, i, (occupancy >> (8 * i)) & 0xFF)
+        message.timestamp = now
+        messages.append(message)
+    return messages
+
+def receive_chess_column(i):
+    # Serial receive 2 bytes from Sam
+    # ser.flush()
+    # rawRecByte0 = ser.read()
+    send_to_328p(i, "Requesting Column "+ str(i))
+    rawRecByte0 = spi.readbytes(1)
+    #time.sleep(0.003)
+    # Maybe add a delay here
+    # rawRecByte1 = ser.read()
+
+    #rawRecByte1 = ser.readbytes(1)
+    now = datetime.now()
+    #recByte0 = int.from_bytes(rawRecByte0, 'little')
+    # print("Byte 0 Received:", format(recByte0, '#010b'))
+    recByte0Mirror = int.from_bytes(rawRecByte0, 'little')
+    recByte0 = REVERSED_BITS[recByte0Mirror]
+    # print("Byte 1 Received:", format(recByte1, '#010b'))
+    # recByte0 = 0b11110010
+    # recByte1 = 0b11000011
+    #messageType = (recByte0 >> 3)
+    messageType = 0
+    #messageCol = recByte0 & 0b00000111
+    messageCol = i
+    currentMessage = gamestateMessage(messageType, messageCol, recByte0)
+    currentMessage.timestamp = now
+    #time.sleep(0.03)
+    #print(currentMessage)
+    # Figure out message type
+    # messageTypeStr = message_types[messageType]
+    return currentMessage
 
 def print_gamestate_list(messageArray):
     for message in messageArray:
@@ -351,105 +465,35 @@ def send_to_328p(data, messageType):
     #ser.write(data.to_bytes(1, 'little'))  # transmit data serially
     spi.writebytes([data])
 
+# Blocks until the 328P raises the change line or timeout passes; True if the line is high
+def wait_for_board_change(timeout=CHANGE_TIMEOUT):
+    if GPIO is None:
+        time.sleep(SCAN_POLL_SECONDS)
+        return True
+    if GPIO.input(CHANGE_PIN):
+        return True
+    return GPIO.wait_for_edge(CHANGE_PIN, GPIO.RISING, timeout=int(1000 * timeout)) is not None
+
 def start_fast_scan(gs):
-    newGs = np.array(gs.board)
-    #print("newGs",newGs)
-    # Serial write start message to Sam
-    #transmission_byte0 = 0b00100111
-    #transmission_byte1 = 0b00110111  # Second byte doesn't matter for start
-    #send_to_328p(transmission_byte0, "Dump All Sensor Data")
-    # Transmit again
-
-    isMoveNotFound = True
-    samState = None
-    prevSamState = None
-    startCell = None
-    destCell = None
-    isOpponentRemoved = False
-    isChangeMade = False
-    previousChangedState = None
-    while isMoveNotFound:
-        while isChangeMade == False:
-            samState = receive_chess_state()
-            if startCell is None:
-                 response = compare_chess_states(newGs, samState)
-            else:
-                 response = compare_message_lists(prevSamState, samState)
-            if response[0] == 5:
-                 #previousChangedState = samState
-                 print_gamestate_list(samState)
-                 if startCell is not None:
-                     print("\nBefore breaking the previous sam state\n")
-                     print_gamestate_list(prevSamState)
-                 break
-        isChangeMade = False
-        # First one is compared to local gs
-        #print("startCell before entering if", startCell)
-        if startCell is None or startCell == -1:  # Check this OR condition
-            if not isOpponentRemoved:
-                startCell = find_start_cell(newGs, samState)
-            else:
-                startCell = resolve_chess_move_v3(newGs, prevSamState, samState)
-            if startCell != -1 and startCell[1][0] != gs.userColor:
-                print("User has lifted opponent's piece. Start Cell has not been resolved.", startCell)
-                #newGs[5][4] = '--'
-                #samState2 = receive_chess_state()
-                startCell = -1
-                isOpponentRemoved = True
-            else:
-                print("Start Cell Resolved:",startCell)
+    resolver = MoveResolver(gs)
+    scanFilter = ScanFilter(resolver.start)
+    state = resolver.state
+    while True:
+        # sleeps through the user's think time; a change the filter hasn't settled yet is scanned on regardless
+        if scanFilter.pending():
+            time.sleep(SCAN_POLL_SECONDS)
         else:
-            # Finesse for testing the move resolution
-            # samState2[7].data = 0b11000101
-            destCell = resolve_chess_move_v3(newGs, samState, prevSamState)
-            # unsure about a check here
-            print("Dest Cell Resolved:", destCell)
-            if destCell != -1:
-                if destCell != -1 and destCell[0] == startCell[0]: # User changed move
-                    print("User placed piece back. Continue making move.")
-                    startCell = -1
-                    destCell = -1
-
-                if destCell != -1 and destCell[0] != startCell[0]:
-                    # Transmit Stop
-                    if destCell[1][0] == gs.get_opponentcolor()[0] and not isOpponentRemoved: 
-                         destCell = -1
-                         isOpponentRemoved = True
-                    else:
-                         isMoveNotFound = True
-                         print("Destination Cell Resolved:", destCell)
-                         # Serial write stop message to Sam
-                         transmission_byte0 = 0b00111000
-                         send_to_328p(transmission_byte0, "Stop Fast Scan")
-                         print("Stop FS sent")
-                         return startCell[0] + destCell[0]
-                         #print(startCell[0] + destCell[0])
-
-
-        prevSamState = samState.copy()
-    return -1
-
-
-    #move = resolve_chess_move(newGs, samState)
-    #print("Resolved Move:", move)
-
-
-    # Step 1: Transmit start message to sam
-
-    # Sam waits for completion of move (aka piece placed down or button)
-    # Step 2: Sam transmits current state (column by column).
-    # Wait for 8 messages. Store in array
-
-    # Step 3: Loop through objects. Resolve physical user move.
-    # Should make function to compare 8 messages to current (use for error checking later)
-
-
-
-    # Jack generates message from Sam
-    #print(get_column(newGs, 'a'))
-
-    # return move
-    return 0
+            wait_for_board_change()
+        move = resolver.update(scanFilter.update(receive_board_occupancy()))
+        if resolver.state != state:
+            state = resolver.state
+            print("Fast scan:", state)
+        if move is not None:
+            print("Move resolved:", move, "| cell changes:", scanFilter.transitions, "suppressed:",
+                  scanFilter.suppressed())
+            # Serial write stop message to Sam
+            send_to_328p(0b00111000, "Stop Fast Scan")
+            return move
 
 
 def stop_fast_scan():
@@ -0,0 +1,453 @@
+# Asyncio driver for the gantry 328P
+# Owns the UART and runs gantry jobs on an event loop in a daemon thread, so the pygame loop keeps
+# drawing and handling clicks while pieces are moving
+
+import asyncio
+import threading
+import time
+from Engine.x328p_interface import x328p_gantry_interface as gantry_interface
+from Engine.x328p_interface import x328p_gantry_planner as planner
+
+MESSAGE_TIMEOUT = 10        # seconds allowed for any single reply from the 328P, on top of travel time
+POLL_INTERVAL = 0.01        # seconds between checks of the UART input buffer
+MESSAGE_GAP = 0.03          # pause between address bytes so the 328P can decode each one
+EM_SETTLE_SECONDS = 0.5     # magnet pull-in time before dragging a piece
+FRAME_ACK_TIMEOUT = 0.5     # seconds to wait for a frame ACK before assuming firmware without frame support
+FRAME_RETRIES = 3           # uploads of a frame the 328P received corrupted
+PARK_DELAY = 1.0            # seconds of idle time before the head starts moving to its parking cell
+RESYNC_TIMEOUT = 0.5        # seconds past the estimated travel time before asking the 328P where the head is
+RESYNC_RETRIES = 3          # resends of a GO, EM command or the rest of a path after a communication fault
+
+
+class GantryDriver():
+    def __init__(self, ser):
+        self.ser = ser
+        self.ser.timeout = gantry_interface.SERIAL_READ_TIMEOUT
+        self.loop = asyncio.new_event_loop()
+        self.thread = None
+        self.lock = None                # created on the loop; serialises jobs in submit order
+        self.position = list(gantry_interface.currentGantryPos)
+        self.pendingTarget = None       # GO sent but ARRIVED not yet read
+        self.magnetOn = False
+        self.framed = True              # cleared once the 328P doesn't answer a frame
+        self.frameSeq = 0
+        self.frameDecoder = gantry_interface.FrameDecoder()
+        self.frames = []                # decoded frames not yet consumed
+        self.frameAcked = False         # a frame was acknowledged, so a missing ACK is a lost byte
+        self.resyncs = 0
+
+    # Starts the event loop thread on first use
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.loop.run_forever, name="gantry", daemon=True)
+            self.thread.start()
+
+    # Schedules a driver coroutine from any thread; returns a concurrent.futures.Future
+    # future.cancel() cancels the job, which stops at the next waypoint and turns the EM off
+    def submit(self, coroutine):
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    # Runs the legs planned by gantry_interface.plan_physical_move one after another
+    # progress(waypoint, waypointCount, pos) is called on the driver thread after every arrival
+    async def run_legs(self, legs, progress=None):
+        async with self.job_lock():
+            for leg in legs:
+                if await self.move(leg, progress) == -1:
+                    return -1
+        return 0
+
+    # Runs a plan streamed by gantry_interface.stream_physical_move while it is still being made: the stream is
+    # iterated on a planning thread, so the head starts its approach GO as soon as the first leg is picked
+    # and drags each leg as soon as it is routed. The stream starts planning even while an earlier job runs
+    async def run_stream(self, plan, progress=None):
+        items = asyncio.Queue()
+
+        # None ends a fully planned stream; -1 one whose planning failed, so the job fails with it
+        def produce():
+            try:
+                for item in plan:
+                    self.loop.call_soon_threadsafe(items.put_nowait, item)
+            except Exception as error:
+                print("ERROR: Planning the gantry move failed:", repr(error))
+                self.loop.call_soon_threadsafe(items.put_nowait, -1)
+            else:
+                self.loop.call_soon_threadsafe(items.put_nowait, None)
+        threading.Thread(target=produce, name="stream planner", daemon=True).start()
+
+        async with self.job_lock():
+            while True:
+                item = await items.get()
+                if item is None:
+                    return 0
+                if item == -1:
+                    return -1
+                kind, value = item
+                if kind == 'approach':
+                    result = await self.approach(value)
+                else:
+                    result = await self.move(value, progress)
+                if result == -1:
+                    return -1
+
+    # Runs a gantry_interface.BoardReset: plans on a worker thread, then drags one piece at a time until the
+    # reset is stopped through stopEvent. A cancelled job drops its piece at the head position, which the reset
+    # is told about
+    async def run_reset(self, reset, stopEvent):
+        async with self.job_lock():
+            if stopEvent.is_set():
+                return 0
+            moves = await self.loop.run_in_executor(None, reset.plan, list(self.position))
+            for startPos, endPos, waypoints in moves:
+                if stopEvent.is_set():
+                    return 0
+                try:
+                    result = await self.move(waypoints)
+                except asyncio.CancelledError:
+                    if self.position != startPos:
+                        reset.moved(startPos, list(self.position))
+                    raise
+                if result == -1:
+                    return -1
+                reset.moved(startPos, endPos)
+            return 0
+
+    # Runs gantry_interface.Housekeeping jobs on grid (the physical layout) until they are done or preempted
+    # Preempted between jobs only: the legs of one job may move blockers aside that the last leg puts back
+    async def run_housekeeping(self, housekeeping, grid):
+        async with self.job_lock():
+            while housekeeping.pending() and not housekeeping.stopEvent.is_set():
+                job = housekeeping.jobs[0]
+                legs = await self.loop.run_in_executor(None, housekeeping.plan, grid, job)
+                if legs == -1:
+                    print("Housekeeping: no path for", job)
+                    if job in housekeeping.jobs:
+                        housekeeping.jobs.remove(job)
+                    continue
+                for leg in legs:
+                    if await self.move(leg) == -1:
+                        return -1
+                housekeeping.finished(grid, job)
+            return 0
+
+    def job_lock(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        return self.lock
+
+    # Drags a piece along path [(pos, direction), ...]: EM-off GO to path[0], EM on, GO through the rest
+    # Uploads the whole path in one frame when the firmware supports it, else one X/Y/GO exchange per waypoint
+    # Returns 0, or -1 if the 328P stopped answering. The EM is always turned off before returning
+    async def move(self, path, progress=None):
+        if self.framed and len(path) <= gantry_interface.FRAME_MAX_WAYPOINTS:
+            result = await self.move_framed(path, progress)
+            if result is not None:
+                return result
+            print("No frame ACK from the gantry; using the byte protocol")
+            self.framed = False
+        return await self.move_waypoints(path, progress)
+
+    # Returns None if the 328P never acknowledged the frame
+    # A lost or garbled reply doesn't end the move: the head position is resynchronised and the rest of the path,
+    # from the last waypoint the head reached, goes up in a new frame
+    async def move_framed(self, path, progress=None):
+        gantry_interface.head_moving(True)
+        try:
+            start = 0
+            for attempt in range(RESYNC_RETRIES + 1):
+                result = await self.run_frame(path, start, progress)
+                if result != -2:
+                    return result
+                if await self.resync(MESSAGE_TIMEOUT + planner.estimate_path_seconds(path[start:])) == -1:
+                    return -1
+                start = self.resume_index(path, start)
+                if start == -1:
+                    print("ERROR: Gantry stopped at", self.position, "off its path")
+                    return -1
+                if start == len(path) - 1:
+                    # only DONE was lost; the 328P turns the EM off at the end of every path
+                    if progress is not None:
+                        progress(len(path), len(path), self.position)
+                    return 0
+                print("Resuming path from waypoint", start + 1, "of", len(path))
+            return -1
+        finally:
+            gantry_interface.head_moving(False)
+
+    # Index of the waypoint of path the head is at after a resync, searching from start on; -1 if it is off the
+    # path. A head off the path of a frame that never started is fine, as nothing has been picked up yet
+    def resume_index(self, path, start):
+        for index in range(len(path) - 1, start - 1, -1):
+            if path[index][0] == self.position:
+                return index
+        if start == 0 and not self.magnetOn:
+            return 0
+        return -1
+
+    # Uploads path[start:] and follows it; returns 0, -1 on failure, None if the 328P doesn't support frames,
+    # or -2 if a reply was lost and the head has to be resynchronised
+    async def run_frame(self, path, start, progress):
+        self.frameSeq = (self.frameSeq + 1) & 0xFF
+        seq = self.frameSeq
+        frame = gantry_interface.frame_encode(seq, gantry_interface.FRAME_PATH,
+                                              gantry_interface.path_frame_payload(path[start:]))
+        for attempt in range(FRAME_RETRIES):
+            self.ser.write(frame)
+            reply = await self.receive_frame(seq, FRAME_ACK_TIMEOUT + len(frame) * 0.002)
+            if reply is None:
+                return -2 if self.frameAcked else None
+            frameType, payload = reply
+            if frameType == gantry_interface.FRAME_ACK:
+                self.frameAcked = True
+                break
+            if frameType in (gantry_interface.FRAME_PROGRESS, gantry_interface.FRAME_DONE):
+                # the ACK was lost but the path is running; handle this report below
+                self.frames.insert(0, (seq, frameType, payload))
+                self.frameAcked = True
+                break
+            if frameType != gantry_interface.FRAME_NAK or payload[0] != gantry_interface.NAK_BAD_FRAME:
+                print("Gantry rejected path:", payload)
+                return -1
+        else:
+            return -1
+
+        # the 328P runs the whole path on its own; PROGRESS counts are cumulative so only the latest matters
+        done = start
+        reported = None
+        try:
+            while True:
+                timeout = RESYNC_TIMEOUT + planner.estimate_path_seconds(path[done:]) + \
+                          planner.estimate_transit_seconds(self.position, path[done][0])
+                reply = await self.receive_frame(seq, timeout)
+                if reply is None:
+                    return -2
+                frameType, payload = reply
+                if frameType not in (gantry_interface.FRAME_PROGRESS, gantry_interface.FRAME_DONE):
+                    continue
+                # back-to-back PROGRESS reports time one GO; the first includes EM ON and DONE includes EM OFF
+                if frameType == gantry_interface.FRAME_PROGRESS and done != start and start + payload[0] == done + 1:
+                    gantry_interface.record_go(path[done - 1][0], path[done][0], time.monotonic() - reported)
+                reported = time.monotonic()
+                done = start + payload[0]
+                self.position = [payload[2], payload[1]]
+                gantry_interface.currentGantryPos = self.position
+                self.magnetOn = frameType == gantry_interface.FRAME_PROGRESS
+                if progress is not None and done != 0:
+                    progress(done, len(path), self.position)
+                if frameType == gantry_interface.FRAME_DONE:
+                    return 0 if done == len(path) else -1
+        except asyncio.CancelledError:
+            # the 328P stops at its next waypoint, turns the EM off and reports DONE
+            self.ser.write(bytes([gantry_interface.FRAME_STOP]))
+            while True:
+                reply = await self.receive_frame(seq, MESSAGE_TIMEOUT)
+                if reply is None or reply[0] == gantry_interface.FRAME_DONE:
+                    break
+            if reply is not None:
+                self.position = [reply[1][2], reply[1][1]]
+                gantry_interface.currentGantryPos = self.position
+                self.magnetOn = False
+            raise
+
+    # Waits for the next frame answering seq; returns (type, payload) or None on timeout
+    async def receive_frame(self, seq, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            while len(self.frames) != 0:
+                frameSeq, frameType, payload = self.frames.pop(0)
+                if frameSeq == seq:
+                    return frameType, payload
+            if time.monotonic() >= deadline:
+                return None
+            if self.ser.in_waiting == 0:
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+            self.frames += self.frameDecoder.feed(self.ser.read(self.ser.in_waiting))
+
+    async def move_waypoints(self, path, progress=None):
+        try:
+            # already there after a streamed approach
+            if self.position != path[0][0] and await self.go(path[0][0]) == -1:
+                return -1
+            if progress is not None:
+                progress(1, len(path), path[0][0])
+
+            if await self.set_magnet(True) == -1:
+                return -1
+            await asyncio.sleep(EM_SETTLE_SECONDS)
+
+            for index in range(1, len(path)):
+                if await self.go(path[index][0]) == -1:
+                    return -1
+                if progress is not None:
+                    progress(index + 1, len(path), path[index][0])
+            return 0
+        finally:
+            await self.stop()
+
+    # EM-off GO to the next piece, made before its path is planned; the caller holds the job lock
+    async def approach(self, pos):
+        if self.position == [pos[0], pos[1]]:
+            return 0
+        try:
+            return await self.go(pos)
+        finally:
+            await self.stop()
+
+    # Moves the head (EM off) to pos while the gantry is idle; cancel it as soon as a real job comes in
+    # Skipped if another job is waiting. Cancelling during the GO lets the head finish that GO first
+    async def park(self, pos):
+        await asyncio.sleep(PARK_DELAY)
+        if self.job_lock().locked() or self.position == [pos[0], pos[1]]:
+            return 0
+        async with self.job_lock():
+            try:
+                return await self.go(pos)
+            finally:
+                await self.stop()
+
+    # Moves the head (EM off) through targets one GO at a time, so every GO is timed for calibration
+    async def calibration_sweep(self, targets):
+        async with self.job_lock():
+            try:
+                for pos in targets:
+                    if await self.go(pos) == -1:
+                        return -1
+                return 0
+            finally:
+                await self.stop()
+
+    # Moves the head over the king and flips the EM to knock it over
+    async def topple_king(self, kingPos):
+        async with self.job_lock():
+            try:
+                if await self.go(kingPos) == -1:
+                    return -1
+                await self.send(gantry_interface.message_encode(0b01010, "EM"))
+                await self.receive("EM", MESSAGE_TIMEOUT)
+                return 0
+            finally:
+                await self.stop()
+
+    # Leaves the gantry idle: lets a GO in flight finish so the piece lands on a waypoint, then EM off
+    # Runs to completion even when the job that called it is being cancelled
+    async def stop(self):
+        if self.pendingTarget is not None:
+            await self.receive_arrived(self.pendingTarget)
+        if self.magnetOn:
+            await self.set_magnet(False)
+
+    # GO to pos; a lost GO (or one the 328P refused after a garbled address) is sent again from where a resync
+    # found the head, so a fault costs a resync instead of the rest of the move
+    async def go(self, pos):
+        fromPos = self.position
+        for attempt in range(RESYNC_RETRIES + 1):
+            await self.send(gantry_interface.message_encode(pos[1], "XADDRESS"))
+            await asyncio.sleep(MESSAGE_GAP)
+            await self.send(gantry_interface.message_encode(pos[0], "YADDRESS"))
+            await asyncio.sleep(MESSAGE_GAP)
+            gantry_interface.head_moving(True)
+            await self.send(gantry_interface.message_encode(0b11111, "GO"))
+            sent = time.monotonic()
+            self.pendingTarget = pos
+            if await self.receive_arrived(pos) == -1:
+                return -1
+            if self.position == [pos[0], pos[1]]:
+                if attempt == 0:
+                    gantry_interface.record_go(fromPos, pos, time.monotonic() - sent)
+                return 0
+            if self.magnetOn and self.position != fromPos:
+                print("ERROR: Gantry dragged a piece to", self.position, "expected", pos)
+                return -1
+        return -1
+
+    async def set_magnet(self, on):
+        # magnetOn is set first so stop() turns the EM off even if its confirmation never comes
+        self.magnetOn = on
+        switchSeconds = planner.motionModel.emOnSeconds if on else planner.motionModel.emOffSeconds
+        for attempt in range(RESYNC_RETRIES + 1):
+            await self.send(gantry_interface.message_encode(0b11111 if on else 0b00000, "EM"))
+            if await self.receive("EM", RESYNC_TIMEOUT + switchSeconds) != -1:
+                self.magnetOn = on
+                return 0
+            if await self.resync() == -1:
+                return -1
+            if self.magnetOn == on:
+                return 0
+        return -1
+
+    # ARRIVED is followed by the X and Y address the 328P stopped at. A missing or garbled reply is followed by a
+    # resync; returns 0 with position confirmed (pos, or wherever the head turned out to be) or -1
+    async def receive_arrived(self, pos):
+        timeout = RESYNC_TIMEOUT + planner.estimate_transit_seconds(self.position, pos)
+        arrived = await self.receive("ARRIVED", timeout)
+        xAddress = -1
+        yAddress = -1
+        if arrived != -1:
+            xAddress = await self.receive("XADDRESS", RESYNC_TIMEOUT)
+        if xAddress != -1:
+            yAddress = await self.receive("YADDRESS", RESYNC_TIMEOUT)
+        self.pendingTarget = None
+        gantry_interface.head_moving(False)
+        if yAddress == -1:
+            return await self.resync()
+        self.position = [yAddress & 0b00011111, xAddress & 0b00011111]
+        gantry_interface.currentGantryPos = self.position
+        if self.position != [pos[0], pos[1]]:
+            print("ERROR: Gantry stopped at", self.position, "expected", pos)
+        return 0
+
+    # Asks the 328P where the head is (RESEND DATA) after a lost or garbled byte. The answer, ARRIVED, X, Y and
+    # the EM state, comes once a GO or path in flight is done. Returns 0 with position and magnetOn confirmed,
+    # or -1 if the 328P doesn't answer within timeout (default MESSAGE_TIMEOUT)
+    async def resync(self, timeout=None):
+        self.resyncs += 1
+        print("Resynchronising gantry position")
+        await self.send(gantry_interface.RESEND)
+        deadline = time.monotonic() + (MESSAGE_TIMEOUT if timeout is None else timeout)
+        answer = None
+        while True:
+            intMessage = await self.receive_byte(deadline)
+            if intMessage == -1:
+                print("Timed out waiting for gantry position")
+                return -1
+            recType = gantry_interface.find_message_type(intMessage)
+            if recType == "ARRIVED":
+                answer = []
+            elif answer is not None:
+                answer.append((recType, intMessage & 0b00011111))
+                if [recType for recType, _ in answer] == ["XADDRESS", "YADDRESS", "EM"]:
+                    break
+                if len(answer) == 3:
+                    answer = None
+        self.position = [answer[1][1], answer[0][1]]
+        gantry_interface.currentGantryPos = self.position
+        self.magnetOn = answer[2][1] == 0b11111
+        print("Gantry at", self.position, "EM", "on" if self.magnetOn else "off")
+        return 0
+
+    async def send(self, data):
+        print("Message sent (" + hex(data) + ")", "(Header:", (data & 0b11100000), "Payload:", (data & 0b00011111), ')')
+        self.ser.write(data.to_bytes(1, 'little'))
+
+    # Waits for a message of messageType without blocking the loop; returns the raw byte, or -1 on timeout or on
+    # any other message (a garbled byte), so the caller can resync straight away
+    async def receive(self, messageType, timeout):
+        intMessage = await self.receive_byte(time.monotonic() + timeout)
+        if intMessage == -1:
+            print("Timed out waiting for message:", messageType)
+            return -1
+        recType = gantry_interface.find_message_type(intMessage)
+        if recType != messageType:
+            print("WARNING: Recieved message:", recType, "; expected:", messageType)
+            return -1
+        return intMessage
+
+    # Returns the next byte from the 328P, or -1 once deadline (time.monotonic()) has passed
+    async def receive_byte(self, deadline):
+        while time.monotonic() < deadline:
+            if self.ser.in_waiting == 0:
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+            return int.from_bytes(self.ser.read(), 'little')
+        return -1
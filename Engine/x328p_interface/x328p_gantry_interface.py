@@ -8,10 +8,18 @@ import serial
 import numpy
 import time
 import sys
-letterToColumn = {'a':5, 'b':7,'c':9,'d':11,'e':13,'f':15,'g':17,'h':19}  # To translate cell to posMap location
+import os
+import json
+import hashlib
+import threading
+import atexit
+from collections import OrderedDict
+from Engine.x328p_interface import x328p_gantry_planner as planner
+letterToColumn = planner.letterToColumn  # To translate cell to posMap location
 pieceToBuffer = {'wP':[15,0], 'bP': [15, 24], 'bP': [15, 22]}
 # easy translation from number to row ((number * 2) + 1)
-ser = serial.Serial("/dev/ttyS0", 9600)  # Open port with baud rate
+SERIAL_READ_TIMEOUT = 0.05  # seconds a single read may block; lets receivers check deadlines and cancellation
+ser = serial.Serial("/dev/ttyS0", 9600, timeout=SERIAL_READ_TIMEOUT)  # Open port with baud rate
 
 # self.letter_to_x = {'a':0, 'b':1, 'c':2, 'd':3, 'e':4, 'f':5, 'g':6, 'h':7}
 # self.number_to_y = {'1':7, '2':6, '3':5, '4':4, '5':3, '6':2, '7':1, '8':0}
@@ -19,6 +27,22 @@ message_types = {'XADDRESS':0b00111111, 'YADDRESS':0b01011111, 'RFID':0b01111111
 
 currentGantryPos=[0,0]
 
+# Cleared while the gantry head is moving; the magnet and the moving carriage make hall sensor readings
+# meaningless, so fast scans wait on it. headMotions counts moves started, so a scan can tell one overlapped it
+headStill = threading.Event()
+headStill.set()
+headMotions = 0
+headStoppedAt = 0.0         # time.monotonic() of the last stop
+
+PATH_CACHE_SIZE = 512       # max planned paths kept in memory
+PATH_CACHE_MARGIN = 2       # cells around the start/end bounding box that a cached path may touch
+PATH_CACHE_FILE = "gantry_path_cache.json"
+PATH_CACHE_SAVE_EVERY = 32  # new paths between saves; the rest are saved at game over and exit
+
+MOTION_MODEL_FILE = "gantry_motion_model.json"
+MOTION_SAMPLES_MAX = 500    # most recent GO timings kept for calibration
+MOTION_SAMPLES_MIN = 12     # fewest GO timings worth fitting the 7 model parameters to
+
 class Node:
     def __init__(self, state='. ', parent=None, pos=[0, 0]):
         self.state = state      # Value
@@ -76,36 +100,11 @@ class Node:
     def __str__(self):
         return self.state
 
-def next_buffer_pos(gamestate, piece):
-    pieceColor = piece[0]
-    # if captured piece is black
-    if pieceColor == 'b':
-        # check if captured piece is pawn
-        if piece[1] == 'P':
-            for row in range(4):
-                for column in range(2):
-                    if gamestate.bBuffer[row][column] == '--':
-                        return [row, column]
-        # all pieces other than pawn; bishop, knight, rook, queen
-        else:
-            for column in range(2):
-                if gamestate.bBuffer[gamestate.bufferMap[piece[1]]][column] == '--':
-                    return [gamestate.bufferMap[piece[1]], column]
-    # if captured piece is white
-    elif pieceColor == 'w':
-        # check if captured piece is pawn, bishop, knight, rook, or queen and place into buffer accordingly
-        if piece[1] == 'P':
-            for row in range(4):
-                for column in range(2):
-                    if gamestate.wBuffer[row][column] == '--':
-                        return [row, column]
-        # all pieces other than pawn; bishop, knight, rook, queen
-        else:
-            for column in range(2):
-                if gamestate.wBuffer[gamestate.bufferMap[piece[1]]][column] == '--':
-                    return [gamestate.bufferMap[piece[1]], column]
+# Buffer slot [row, column] for piece captured at grid position fromPos; the same slot GameState.capture_piece fills
+def next_buffer_pos(gamestate, piece, fromPos=None):
+    return gamestate.bufferAllocator.choose(piece[0], piece[1], fromPos)
 
-# Translates an 8x8 gamestate to a 24x24 piece position map
+# Translates an 8x8 gamestate to a 24x24 piece position map (legacy Node map, planning uses gamestate.posGrid)
 def gamestate_to_position_map(gamestate):
     posMap = [[Node() for _ in range(25)] for _ in range(17)]
     for i in range(len(posMap)):
@@ -163,7 +162,7 @@ def sl_compression(solution):
     compressed_path.append(solution[len(solution)-1])
     return compressed_path
 
-# Returns the Astar path of
+# Legacy greedy walker, kept for benchmarking against planner.astar
 def greedy(heurMap, startNode):
     solution = []
     frontier = []
@@ -215,24 +214,113 @@ def message_encode(value, type):
 
 
 
+# Framed path protocol, handled by frame_Receive in the gantry firmware
+# Pi -> 328P: FRAME_START, then LEN, SEQ, TYPE, PAYLOAD[LEN], CRC8 each split into two nibble bytes (high first)
+#   Nibble bytes are mode 0, which firmware without frame support ignores, so a missing ACK means fall back
+# 328P -> Pi: FRAME_START, LEN, SEQ, TYPE, PAYLOAD[LEN], CRC8 as raw bytes; CRC8 (poly 0x07) covers LEN..PAYLOAD
+FRAME_START = 0xF5          # ELSE mode, data 21
+FRAME_STOP = 0xF6           # ELSE mode, data 22; stops a running path at its next waypoint
+FRAME_PATH = 0x01           # waypoints as x, y, flags
+FRAME_ACK = 0x02
+FRAME_NAK = 0x03            # payload: reason
+FRAME_PROGRESS = 0x04       # payload: waypoints done (cumulative), x, y
+FRAME_DONE = 0x05           # payload: waypoints done, x, y; the EM is off
+FRAME_FLAG_EM_ON = 0x01     # turn the EM on after arriving at the waypoint
+FRAME_FLAG_EM_OFF = 0x02    # turn the EM off after arriving at the waypoint
+NAK_BAD_FRAME = 1
+NAK_INVALID_PATH = 2
+FRAME_MAX_WAYPOINTS = 32    # FRAME_MAX_PAYLOAD in the firmware / 3
+FRAME_MAX_REPLY = 3         # largest 328P -> Pi payload (PROGRESS, DONE)
+
+# ELSE mode, data 6 (RESEND DATA): the 328P answers ARRIVED, X, Y and EM ON/OFF, once a GO in flight is done
+RESEND = 0xE6
+
+
+def crc8(data):
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            if crc & 0x80:
+                crc = ((crc << 1) ^ 0x07) & 0xFF
+            else:
+                crc = (crc << 1) & 0xFF
+    return crc
+
+
+# Encodes a frame for the 328P
+def frame_encode(seq, frameType, payload):
+    body = bytes([len(payload), seq & 0xFF, frameType]) + bytes(payload)
+    body += bytes([crc8(body)])
+    frame = [FRAME_START]
+    for byte in body:
+        frame.append(byte >> 4)
+        frame.append(byte & 0x0F)
+    return bytes(frame)
+
+
+# PATH payload for a transmit_path style path: EM on after reaching path[0], EM off at the last waypoint
+def path_frame_payload(path):
+    payload = []
+    for i in range(len(path)):
+        pos = path[i][0]
+        flags = 0
+        if i == 0:
+            flags |= FRAME_FLAG_EM_ON
+        if i == len(path) - 1:
+            flags |= FRAME_FLAG_EM_OFF
+        payload += [pos[1], pos[0], flags]
+    return payload
+
+
+# Splits the raw byte stream from the 328P into frames; bytes that don't start a valid frame are skipped
+class FrameDecoder():
+    def __init__(self):
+        self.buffer = bytearray()
+
+    # Returns the complete frames in data (plus anything buffered) as [(seq, type, payload), ...]
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        while True:
+            start = self.buffer.find(FRAME_START)
+            if start == -1:
+                self.buffer.clear()
+                return frames
+            del self.buffer[:start]
+            if len(self.buffer) < 2:
+                return frames
+            length = self.buffer[1]
+            if length > FRAME_MAX_REPLY:
+                del self.buffer[0]      # a stray start byte; waiting on its length would hold back real frames
+                continue
+            if len(self.buffer) < length + 5:
+                return frames
+            body = bytes(self.buffer[1:length + 4])
+            if crc8(body) != self.buffer[length + 4]:
+                del self.buffer[0]      # not a frame start after all; resync on the next one
+                continue
+            frames.append((body[1], body[2], list(body[3:])))
+            del self.buffer[:length + 5]
+
+
+# Called around every GO or PATH frame, by the driver and the blocking transmit functions
+def head_moving(moving):
+    global headMotions, headStoppedAt
+    if moving:
+        headMotions += 1
+        headStill.clear()
+    else:
+        headStoppedAt = time.monotonic()
+        headStill.set()
+
+
 # 328P UART conversation for controlling EM
 def transmit_path(path):
-    # ADD X (path[0])
-    node = path[0][0]
+    # GO to path[0] with the EM off, unless a streamed approach already went there
+    pos = path[0][0]
     global currentGantryPos
-    currentGantryPos = node.pos
-    #print("XADD Message: ",format(message_encode(node.pos[1],"XADDRESS"), '#010b'))
-    send_to_328p(message_encode(node.pos[1],"XADDRESS"))
-    # ADD Y
-    #print("YADD Message: ",format(message_encode(node.pos[0],"YADDRESS"), '#010b'))
-    send_to_328p(message_encode(node.pos[0],"YADDRESS"))
-    # GO
-    #print("GO Message: ",format(message_encode(0b11111,"GO"), '#010b'))
-    send_to_328p(message_encode(0b11111,"GO"))
-    # Wait for ARRIVED
-    #print("Wait for ARRIVED and gantry position (Mocking with sleep for now)")
-    resp = recv_from_328p("ARRIVED", 10)
-    if resp == -1:
+    if currentGantryPos != pos and transmit_go(pos) == -1:
         return -1
     # Request RFID
     #print("RFID Req: ",format(message_encode(0b11010,"RFID"), '#010b'))
@@ -249,25 +337,30 @@ def transmit_path(path):
 
     # Loop path[1] and on:
     time.sleep(.5)
+    head_moving(True)
     for i in path[1:len(path)]:
-        node = i[0]
-        currentGantryPos = node.pos
-        #print("XADD Message: ", format(message_encode(node.pos[1], "XADDRESS"), '#010b'))
-        send_to_328p(message_encode(node.pos[1], "XADDRESS"))
+        fromPos = pos
+        pos = i[0]
+        currentGantryPos = pos
+        #print("XADD Message: ", format(message_encode(pos[1], "XADDRESS"), '#010b'))
+        send_to_328p(message_encode(pos[1], "XADDRESS"))
         time.sleep(.03)
-        #print("YADD Message: ", format(message_encode(node.pos[0], "YADDRESS"), '#010b'))
-        send_to_328p(message_encode(node.pos[0], "YADDRESS"))
+        #print("YADD Message: ", format(message_encode(pos[0], "YADDRESS"), '#010b'))
+        send_to_328p(message_encode(pos[0], "YADDRESS"))
         time.sleep(.03)
-        #print("GO Message: ", format(message_encode(node.pos[0], "GO"), '#010b'))
-        send_to_328p(message_encode(node.pos[0], "GO"))
+        #print("GO Message: ", format(message_encode(pos[0], "GO"), '#010b'))
+        send_to_328p(message_encode(pos[0], "GO"))
+        sent = time.monotonic()
         #print("Wait for ARRIVED and gantry position (Mocking with sleep for now)")
-        recv_from_328p("ARRIVED", 10)
+        if recv_from_328p("ARRIVED", 10) != -1:
+            record_go(fromPos, pos, time.monotonic() - sent)
         #time.sleep(1)
     # EM OFF
     #print("EM Message: ",format(message_encode(0b00000,"EM"), '#010b'))
     send_to_328p(message_encode(0b00000,"EM"))
     # Wait for EM OFF?
     recv_from_328p("EM", 10)
+    head_moving(False)
 
     #time.sleep(.5)
 
@@ -276,6 +369,26 @@ def transmit_path(path):
     return
 
 
+# EM-off GO to pos (i.e the approach to a piece whose path is still being planned)
+def transmit_go(pos):
+    global currentGantryPos
+    fromPos = currentGantryPos
+    currentGantryPos = pos
+    send_to_328p(message_encode(pos[1], "XADDRESS"))
+    time.sleep(.03)
+    send_to_328p(message_encode(pos[0], "YADDRESS"))
+    time.sleep(.03)
+    head_moving(True)
+    send_to_328p(message_encode(0b11111, "GO"))
+    sent = time.monotonic()
+    arrived = recv_from_328p("ARRIVED", 10)
+    head_moving(False)
+    if arrived == -1:
+        return -1
+    record_go(fromPos, pos, time.monotonic() - sent)
+    return 0
+
+
 def find_message_type(message):
     for key in message_types:
         if (message&0b11100000) == (message_types[key]&0b11100000):
@@ -287,10 +400,13 @@ def find_message_type(message):
 def recv_from_328p(messageType, timeout):
     print("\nWaiting for message:", messageType)
 
-    while True:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
         ser.flush()
         #time.sleep(0.03)
-        x = ser.read()
+        x = ser.read()  # returns empty after SERIAL_READ_TIMEOUT so the deadline is checked
+        if len(x) == 0:
+            continue
         intMessage = int.from_bytes(x, 'little')
         recType = find_message_type(intMessage)
         print(recType, "message recieved", format(intMessage, '#010b'))
@@ -336,6 +452,7 @@ def recv_from_328p(messageType, timeout):
             print("Received unsupported message type:",recType,"expected:",messageType)
             time.sleep(.3)
 
+    print("Timed out waiting for message:", messageType)
     return -1 # timeout or error
 
 
@@ -348,71 +465,56 @@ def send_to_328p(data):
 
     return 0
 
-def print_posMap(map, path=None):
+def print_posMap(grid, path=None):
+    pathCells = set()
     if (path != None):
         for i in range(len(path)):
-            solNode = path[i][0]
-            map[solNode.pos[0]][solNode.pos[1]].state = u"\u26AA"
+            pathCells.add((path[i][0][0], path[i][0][1]))
+
+    def cell_str(i, j):
+        if (i, j) in pathCells:
+            return u"\u26AA"
+        piece = grid.piece_at([i, j])
+        return '. ' if piece is None else piece
+
     print("\033[1m\tWhite \t\t\t\t\t\t\tBoard \t\t\t\t\t\tBlack")
     for i in range(16, -1, -1):
         for j in range(4):
-            print(map[i][j], end=' ')
+            print(cell_str(i, j), end=' ')
         print("\t", end = '')
         for x in range(17):
-            print(map[i][4 + x], end=' ')
+            print(cell_str(i, 4 + x), end=' ')
         print("\t", end = '')
         for j in range(4):
-            print(map[i][21 + j], end=' ')
+            print(cell_str(i, 21 + j), end=' ')
         print("\t")
 
 
 
 def make_physical_state_congruent(gs, nextGs):
-    posMapA = gamestate_to_position_map(gs)
-    posMapB = gamestate_to_position_map(nextGs)
-    print_posMap(posMapA)
-    print_posMap(posMapB)
-    takenFrom = []
-    for posB_row in posMapB:
-        for posB in posB_row:
-            if posB.state != '. ':
-                #print(posB.state)
-                if posMapA[posB.pos[0]][posB.pos[1]].state == posB.state:   # Already in correct pos
-                    #print("Pass")
-                    pass
-                else:
-                    foundReplacement = False
-                    for posA_row in posMapA:
-                        for posA in posA_row:
-                            #print("Checking state, pos", posA.state,posA.pos)
-                            if posA.state == posB.state and posA.pos not in takenFrom and posA.state != posMapB[posA.pos[0]][posA.pos[1]].state:
-                                #print("posA:", posA.pos)
-                                takenFrom.append(posB.pos)
-                                #print("Start:", posA.pos)
-                                #print("Dest:", posB.pos)
-                                make_physical_move(gs, None, startOverride=posA.pos, destOveride=posB.pos)
-                                foundReplacement = True
-                                break;
-                        if foundReplacement:
-                            posMapA[posB.pos[0]][posB.pos[1]].state = posB.state
-                            posMapA[posA.pos[0]][posA.pos[1]].state = ". "
-                            print_posMap(posMapA)
-                            break;
+    posGridA = gs.posGrid
+    posGridB = nextGs.posGrid
+    print_posMap(posGridA)
+    print_posMap(posGridB)
+    moves, seconds, unresolved = planner.plan_reconciliation(posGridA, posGridB, currentGantryPos)
+    print("Reconciliation:", len(moves), "moves, est", round(seconds, 1), "s")
+    for startPos, endPos, waypoints in moves:
+        print("Moving", startPos, "->", endPos)
+        if transmit_path(waypoints) == -1:
+            return -1
 
+    if len(unresolved) != 0:
+        print("Could not reconcile:", unresolved)
+        return -1
     return 0 # Should be congruent
 
 
 def topple_king(gs, king):
-    posMap = gamestate_to_position_map(gs)
-    kingPos = [0,0]
-    for row in posMap:
-        print("Row", row)
-        for node in row:
-            print("Node", node.state)
-            if node.state == king:
-                kingPos = node.pos
-                print("Found king position:", node.pos)
-                break
+    kingPos = gs.posGrid.find(king)
+    if kingPos is None:
+        print("King not found:", king)
+        return -1
+    print("Found king position:", kingPos)
 
     print("Sending position")
     send_to_328p(message_encode(kingPos[1], "XADDRESS"))
@@ -424,46 +526,631 @@ def topple_king(gs, king):
     send_to_328p(message_encode(0b01010,"EM"))
     return 0
 
-# External function used to interface with GUI and game execution. Takes current gamestate and string move (ie 'e4e5')
-def make_physical_move(gamestate, move, startOverride=None, destOveride=None):
-    # TODO Extract and interpret move as start and end pos
-    posMap = gamestate_to_position_map(gamestate)  # convert 8x8 to position map
-
-    startPos = [0,0]
-    endPos = [0, 0]
+# Promotion suffix of a move string to piece type (same mapping as GameState.promotion)
+promotionPieces = {'b':'B', 'k':'H', 'r':'R', 'q':'Q'}
+
+# Promotion pieces staged for an opponent pawn on its seventh rank, likeliest first
+STAGING_ORDER = ['Q', 'R', 'B', 'H']
+
+# Edge-row cells a promotion piece is staged on for the file at grid column fileColumn: beyond the promotion
+# rank (grid row promotionRow) and beside the file, one diagonal step from the promotion square
+def staging_cells(promotionRow, fileColumn):
+    edgeRow = 0 if promotionRow == 1 else planner.MAP_ROWS - 1
+    return [[edgeRow, fileColumn + 1], [edgeRow, fileColumn - 1]]
+
+# Staged piece closest to the promotion square toPos, or None. Pieces only stand on the edge row between the
+# board files when they were staged there
+def staged_piece(posGrid, piece, toPos):
+    edgeRow = 0 if toPos[0] == 1 else planner.MAP_ROWS - 1
+    cells = [[edgeRow, column] for column in range(4, 21, 2) if posGrid.piece_at([edgeRow, column]) == piece]
+    if len(cells) == 0:
+        return None
+    return min(cells, key=lambda cell: planner.octile_distance(cell, toPos))
+
+# Buffer pieces to stage for pawns of color on their seventh rank: pawnColumns are their grid columns and
+# promotionRow the grid row they promote on. The likeliest promotion piece left is staged beside each file that
+# doesn't have one staged nearby already. Returns ([(buffer slot, staging cell, piece), ...], grid columns of
+# the pawns with no piece left to promote to)
+def plan_promotion_staging(posGrid, allocator, color, promotionRow, pawnColumns):
+    allocator = allocator.copy()
+    grid = posGrid.copy()
+    staging = []
+    unstaged = []
+    for column in pawnColumns:
+        cells = staging_cells(promotionRow, column)
+        if any(grid.piece_at(cell) is not None and grid.piece_at(cell)[0] == color for cell in cells):
+            continue
+        square = [promotionRow, column]
+        slot = None
+        for pieceType in STAGING_ORDER:
+            # staged for another file; still one short leg away
+            if staged_piece(grid, color + pieceType, square) is not None:
+                break
+            slot = allocator.retrieve(color, pieceType, square)
+            if slot is not None:
+                break
+        else:
+            unstaged.append(column)
+            continue
+        free = [cell for cell in cells if grid.is_empty(cell[0], cell[1])]
+        if slot is None or len(free) == 0:
+            continue
+        allocator.stage(color, slot[0], slot[1], free[0])
+        grid.move_piece(planner.buffer_to_grid(color, slot[0], slot[1]), free[0])
+        staging.append((slot, free[0], color + pieceType))
+    return staging, unstaged
+
+# Physical legs [(startPos, endPos), ...] of one move, in no particular order: captured (or en passant) piece
+# to its buffer slot, the rook when castling, and for a promotion the pawn to the buffer and the promoted piece
+# from its staging cell or the buffer to the promotion square. Buffer slots are the ones GameState fills for the
+# same move
+def move_legs(gamestate, posGrid, startPos, endPos, promotion=None):
+    allocator = gamestate.bufferAllocator.copy()
+    piece = posGrid.piece_at(startPos)
+    destPiece = posGrid.piece_at(endPos)
+    legs = []
+
+    # (grid position, piece, position its buffer slot is chosen from)
+    toBuffer = []
+    if destPiece is not None:
+        toBuffer.append((endPos, destPiece, endPos))
+    elif piece is not None and piece[1] == 'P' and startPos[1] != endPos[1]:
+        # en passant: the captured pawn is beside the start square
+        capturedPos = [startPos[0], endPos[1]]
+        if posGrid.piece_at(capturedPos) is not None:
+            toBuffer.append((capturedPos, posGrid.piece_at(capturedPos), capturedPos))
+    if promotion is not None and piece is not None:
+        toBuffer.append((startPos, piece, endPos))
+
+    for pos, bufferPiece, slotFrom in toBuffer:
+        slot = allocator.choose(bufferPiece[0], bufferPiece[1], slotFrom)
+        if slot is None:
+            print("No free buffer slot for", bufferPiece)
+            return -1
+        allocator.set_slot(bufferPiece[0], slot[0], slot[1], bufferPiece)
+        legs.append((pos, planner.buffer_to_grid(bufferPiece[0], slot[0], slot[1])))
+
+    if promotion is not None and piece is not None:
+        # staged beside the promotion rank while the pawn was on the seventh
+        staged = staged_piece(posGrid, piece[0] + promotion, endPos)
+        if staged is not None:
+            legs.append((staged, endPos))
+            return legs
+        slot = allocator.retrieve(piece[0], promotion, endPos)
+        if slot is not None:
+            legs.append((planner.buffer_to_grid(piece[0], slot[0], slot[1]), endPos))
+            return legs
+        # promoted piece not in the buffer: the pawn goes to the promotion square to be swapped by hand
+        print("No", piece[0] + promotion, "in the capture buffer")
+        legs.pop()
+
+    legs.append((startPos, endPos))
+    if piece is not None and piece[1] == 'K' and abs(endPos[1] - startPos[1]) == 4:
+        # castling: the rook lands on the square the king crossed
+        rookColumn = 19 if endPos[1] > startPos[1] else 5
+        legs.append(([startPos[0], rookColumn], [startPos[0], (startPos[1] + endPos[1]) // 2]))
+    return legs
+
+# Waypoint lists for a single piece move on posGrid: one path, or the blocker moves around it when the piece
+# is walled in. Returns -1 if there is no way through
+def plan_leg(posGrid, startPos, endPos, verbose=True):
+    compressedPath = pathCache.get(posGrid, startPos, endPos)
+    if compressedPath is not None:
+        if verbose:
+            print("Path cache hit:", pathCache.stats())
+        return [compressedPath]
+
+    compressedPath = planner.fastest_path(posGrid, startPos, endPos)
+    if compressedPath == -1:
+        # walled in: move the blockers aside, route the piece, then put the blockers back
+        relocation = planner.plan_with_blockers(posGrid, startPos, endPos, currentGantryPos)
+        if relocation == -1:
+            print("No lane path from", startPos, "to", endPos)
+            return -1
+        moves, seconds = relocation
+        if verbose:
+            print("Relocating", (len(moves) - 1) // 2, "blockers for", startPos, "->", endPos,
+                  "est", round(seconds, 1), "s")
+        return [waypoints for _, _, waypoints in moves]
+
+    if verbose:
+        print("\nMinimum-time path: ")
+        print_posMap(posGrid, compressedPath)
+        print("Waypoints:", len(compressedPath), "est", round(planner.estimate_path_seconds(compressedPath), 1), "s")
+    # segments run straight between waypoints, so the waypoints bound every cell the path touches
+    pathCache.put(posGrid, startPos, endPos, compressedPath, compressedPath)
+    return [compressedPath]
+
+# Corrective drags after a post-move scan: missing are grid squares that should hold a piece but read empty,
+# extra are squares that read occupied but should be empty. A missing piece that turned up on an extra square
+# (the nearest one) is dragged back; one that turned up nowhere is nudged, as it is most likely off-centre
+# over its own square. Returns (waypoint lists, positions that couldn't be corrected)
+def plan_correction(posGrid, missing, extra):
+    grid = posGrid.copy()
+    extra = list(extra)
+    legs = []
+    unresolved = []
+    for pos in missing:
+        if len(extra) != 0:
+            found = min(extra, key=lambda cell: planner.octile_distance(pos, cell))
+            extra.remove(found)
+            # plan on the layout as it was read
+            grid.move_piece(pos, found)
+            routed = plan_leg(grid, found, pos, verbose=False)
+            if routed == -1:
+                unresolved.append(pos)
+                continue
+            grid.move_piece(found, pos)
+            legs += routed
+        else:
+            nudge = planner.nudge_path(grid, pos)
+            if nudge == -1:
+                unresolved.append(pos)
+                continue
+            legs.append(nudge)
+    # a piece where none should be can't be told apart from one that was never there to move
+    return legs, unresolved + extra
+
+# Plans the legs (waypoint lists for transmit_path) of a move without talking to the gantry
+# Every physical leg of the move (capture, castling rook, promotion swap) goes into one plan, in the order and
+# with the empty transits that take the least time from the current head position. posGrid defaults to the
+# gamestate's grid and is not modified. Returns -1 if a leg has no lane path
+def plan_physical_move(gamestate, move, startOverride=None, destOveride=None, posGrid=None, verbose=True):
+    if posGrid is None:
+        posGrid = gamestate.posGrid
+
+    promotion = None
     if move is not None:
-        startPos[0] = (int(move[1]) * 2) - 1
-        startPos[1] = letterToColumn[move[0]]
-
-        endPos[0] = (int(move[3:len(move)]) * 2) - 1
-        endPos[1] = letterToColumn[move[2]]
+        startPos = planner.square_to_grid(move[0:2], gamestate.userColor)
+        endPos = planner.square_to_grid(move[2:4], gamestate.userColor)
+        if len(move) == 5:
+            promotion = promotionPieces.get(move[4])
     else:
         startPos = startOverride
         endPos = destOveride
 
-    destNode = posMap[endPos[0]][endPos[1]]
-
-    if destNode.state != '. ':
-        capturedPos = destNode.pos
-        bufferPos = next_buffer_pos(gamestate, destNode.state)
-        if destNode.state[0] == 'b':
-            bufferPosMap = [(15 - (int(bufferPos[0]) * 2)), (int(bufferPos[1]) * 2) + 22]
-        else:
-            bufferPosMap = [(15-(int(bufferPos[0])*2)), int(bufferPos[1])*2]
-        make_physical_move(gamestate, None, capturedPos, bufferPosMap)
+    legs = move_legs(gamestate, posGrid, startPos, endPos, promotion)
+    if legs == -1:
+        return -1
+    plan = planner.schedule_legs(posGrid, legs, currentGantryPos,
+                                 lambda grid, legStart, legEnd: plan_leg(grid, legStart, legEnd, verbose))
+    if plan == -1:
+        print("No plan for", startPos, "->", endPos)
+        return -1
+    waypointLists, seconds = plan
+    if verbose and len(legs) > 1:
+        print("Scheduled", len(legs), "legs in", len(waypointLists), "paths, est", round(seconds, 1), "s")
+    return waypointLists
+
+# Streams the plan of a move while it is being made, so the gantry starts moving before planning is done:
+# ('approach', pos) as soon as the first leg is picked, for the EM-off GO to the first piece, then
+# ('leg', waypoints) for every leg as soon as it is routed. Yields -1 and stops if a leg has no lane path.
+# Legs are ordered on straight-line time estimates; routing every order first is the wait this avoids
+def stream_physical_move(gamestate, move, posGrid=None, verbose=True):
+    if posGrid is None:
+        posGrid = gamestate.posGrid
+    startPos = planner.square_to_grid(move[0:2], gamestate.userColor)
+    endPos = planner.square_to_grid(move[2:4], gamestate.userColor)
+    promotion = promotionPieces.get(move[4]) if len(move) == 5 else None
+
+    legs = move_legs(gamestate, posGrid, startPos, endPos, promotion)
+    if legs == -1:
+        yield -1
+        return
+    order = planner.schedule_legs(posGrid, legs, currentGantryPos,
+                                  lambda grid, legStart, legEnd: [[(legStart, ''), (legEnd, '')]])
+    if order == -1:
+        yield -1
+        return
+    yield ('approach', order[0][0][0][0])
+
+    workGrid = posGrid.copy()
+    for straightLine in order[0]:
+        legStart = straightLine[0][0]
+        legEnd = straightLine[-1][0]
+        waypointLists = plan_leg(workGrid, legStart, legEnd, verbose)
+        if waypointLists == -1:
+            yield -1
+            return
+        for waypoints in waypointLists:
+            yield ('leg', waypoints)
+        workGrid.move_piece(legStart, legEnd)
 
-    heurMap = create_heuristic_map(posMap, endPos)
+# External function used to interface with GUI and game execution. Takes current gamestate and string move (ie 'e4e5')
+# Blocks until the gantry is done; GameState hands the streamed plan to the gantry driver instead
+def make_physical_move(gamestate, move, startOverride=None, destOveride=None, posGrid=None):
+    if move is None:
+        legs = plan_physical_move(gamestate, move, startOverride, destOveride, posGrid)
+        if legs == -1:
+            return -1
+        plan = [('leg', leg) for leg in legs]
+    else:
+        plan = stream_physical_move(gamestate, move, posGrid)
 
-    solution = greedy(heurMap, heurMap[startPos[0]][startPos[1]])
-    print("\nBefore Straightline Path Compression: ")
-    print_posMap(heurMap, solution)
-    resp = transmit_path(sl_compression(solution))
+    for item in plan:
+        if item == -1:
+            return -1
+        kind, value = item
+        if kind == 'approach':
+            if transmit_go(value) == -1:
+                return -1
+        else:
+            resp = transmit_path(value)
 
     #if resp == -1:
     #    make_physical_move(gamestate, move, startOverride, destOveride)
 
     return 0
 
+# Bounded LRU cache of compressed gantry paths keyed by (start, end, local occupancy)
+class PathCache():
+    def __init__(self, maxSize=PATH_CACHE_SIZE, margin=PATH_CACHE_MARGIN, cacheFile=None):
+        self.entries = OrderedDict()
+        self.maxSize = maxSize
+        self.margin = margin
+        self.cacheFile = cacheFile  # None keeps the cache in memory only
+        self.hits = 0
+        self.misses = 0
+        # paths are planned on the GUI, stream planner, preplanner and housekeeping threads
+        self.lock = threading.Lock()
+        self.unsaved = 0            # paths added since the last save
+
+    # Rows/columns a cached path between startPos and endPos is allowed to touch
+    def region(self, startPos, endPos):
+        rowLow = max(min(startPos[0], endPos[0]) - self.margin, 0)
+        rowHigh = min(max(startPos[0], endPos[0]) + self.margin, planner.MAP_ROWS - 1)
+        columnLow = max(min(startPos[1], endPos[1]) - self.margin, 0)
+        columnHigh = min(max(startPos[1], endPos[1]) + self.margin, planner.MAP_COLUMNS - 1)
+        return rowLow, rowHigh, columnLow, columnHigh
+
+    # Occupancy (not piece identity) of the region is what decides the path, so only that is hashed
+    def key(self, posGrid, startPos, endPos):
+        rowLow, rowHigh, columnLow, columnHigh = self.region(startPos, endPos)
+        # start/end occupancy differs between moves and captures, but never changes the lane path
+        endpoints = ((startPos[0], startPos[1]), (endPos[0], endPos[1]))
+        occupancy = bytearray()
+        for row in range(rowLow, rowHigh + 1):
+            for column in range(columnLow, columnHigh + 1):
+                if (row, column) in endpoints or posGrid.is_empty(row, column):
+                    occupancy.append(0)
+                else:
+                    occupancy.append(1)
+        digest = hashlib.blake2b(bytes(occupancy), digest_size=8).hexdigest()
+        return "{},{}>{},{}:{}".format(startPos[0], startPos[1], endPos[0], endPos[1], digest)
+
+    def get(self, posGrid, startPos, endPos):
+        key = self.key(posGrid, startPos, endPos)
+        with self.lock:
+            path = self.entries.get(key)
+            if path is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return [([pos[0], pos[1]], direction) for pos, direction in path]
+
+    # Only paths that stay inside the hashed region can be reused safely
+    def put(self, posGrid, startPos, endPos, compressedPath, solution):
+        rowLow, rowHigh, columnLow, columnHigh = self.region(startPos, endPos)
+        for pos, _ in solution:
+            if not (rowLow <= pos[0] <= rowHigh and columnLow <= pos[1] <= columnHigh):
+                return
+        key = self.key(posGrid, startPos, endPos)
+        path = [([pos[0], pos[1]], direction) for pos, direction in compressedPath]
+        with self.lock:
+            self.entries[key] = path
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+            self.unsaved += 1
+            saveNow = self.unsaved >= PATH_CACHE_SAVE_EVERY
+        if saveNow:
+            self.save()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hitRate = self.hits / lookups if lookups else 0
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'hitRate': hitRate}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.unsaved += 1
+
+    # Writes the cache file if paths changed since the last save (no-op for an in-memory cache)
+    def save(self):
+        with self.lock:
+            if self.cacheFile is None or self.unsaved == 0:
+                return
+            tmpFile = self.cacheFile + ".tmp"
+            with open(tmpFile, 'w') as f:
+                json.dump(list(self.entries.items()), f)
+            os.replace(tmpFile, self.cacheFile)
+            self.unsaved = 0
+
+    def load(self):
+        if self.cacheFile is None or not os.path.exists(self.cacheFile):
+            return
+        try:
+            with open(self.cacheFile, 'r') as f:
+                for key, path in json.load(f):
+                    self.entries[key] = [(pos, direction) for pos, direction in path]
+        except (ValueError, OSError):
+            print("Ignoring unreadable path cache:", self.cacheFile)
+            self.entries.clear()
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+
+pathCache = PathCache()
+
+
+# Plans the opponent's candidate replies in the background while the user is thinking
+# Plans are keyed by the full move string (an under-promotion is not the queen promotion that was planned) and
+# only used while the position grid still has the version they were planned on
+class PrePlanner():
+    def __init__(self):
+        self.plans = {}
+        self.planSeconds = {}   # planning time of each plan; what a hit saves
+        self.gridVersion = None
+        self.thread = None
+        self.stopEvent = threading.Event()
+        self.hits = 0
+        self.misses = 0
+        self.savedSeconds = 0
+
+    # snapshot needs posGrid, wBuffer, bBuffer and bufferMap, and must not be changed while planning runs
+    def start(self, snapshot, moves):
+        self.discard()
+        self.gridVersion = snapshot.posGrid.version
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.run, args=(snapshot, moves), name="preplanner", daemon=True)
+        self.thread.start()
+
+    def run(self, snapshot, moves):
+        for move in moves:
+            if self.stopEvent.is_set():
+                return
+            t0 = time.perf_counter()
+            legs = plan_physical_move(snapshot, move, posGrid=snapshot.posGrid, verbose=False)
+            if legs != -1:
+                self.plans[move] = legs
+                self.planSeconds[move] = time.perf_counter() - t0
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopEvent.set()
+            self.thread.join()
+            self.thread = None
+
+    # Returns the legs planned for move on posGrid, or None. Ends the current pre-planning round
+    def take(self, posGrid, move):
+        self.stop()
+        if self.gridVersion is None:
+            return None
+        legs = None
+        if posGrid.version == self.gridVersion and move in self.plans:
+            legs = self.plans[move]
+            self.hits += 1
+            self.savedSeconds += self.planSeconds[move]
+        else:
+            self.misses += 1
+        self.discard()
+        print("Pre-planner:", self.stats())
+        return legs
+
+    # Drops every plan (i.e the gamestate was reset)
+    def discard(self):
+        self.stop()
+        self.plans = {}
+        self.planSeconds = {}
+        self.gridVersion = None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hitRate = self.hits / lookups if lookups else 0
+        return {'hits': self.hits, 'misses': self.misses, 'hitRate': hitRate,
+                'savedMs': round(1000 * self.savedSeconds, 1)}
+
+
+prePlanner = PrePlanner()
+
+
+# Puts every piece, buffers included, back in a starting layout once a game is over, while the user is in the
+# menus. Runs as one gantry job that drags a piece at a time; stop() ends it between pieces, so grid always
+# matches the board and resume() carries on from there towards the layout of the game that was started
+# Nothing waits on a job to stop: the driver runs jobs in submit order, so a job submitted after it takes grid
+# as the stopped job left it
+class BoardReset():
+    def __init__(self):
+        self.grid = None            # board layout as of the last finished drag; None until the first reset
+        self.startGrid = None       # layout a game ended in, taken up once its reset job plans
+        self.targetGrid = None
+        self.job = None
+        self.stopEvent = threading.Event()
+        self.moves = 0
+        self.unresolved = []
+
+    # grid is the layout the game ended in, with pieces housekeeping hasn't buffered yet counted at their slots
+    # The moves run on driver (x328p_gantry_driver.GantryDriver). Returns the job future
+    def start(self, driver, grid, targetGrid):
+        self.stop()
+        self.startGrid = grid.copy()
+        self.targetGrid = targetGrid.copy()
+        return self.submit(driver)
+
+    # Stops the reset in progress and restarts it towards targetGrid from wherever it stops
+    # Returns the job future, or None if there is no reset to finish
+    def resume(self, driver, targetGrid):
+        if self.grid is None and self.startGrid is None:
+            return None
+        running = self.job is not None and not self.job.done()
+        self.stop()
+        self.targetGrid = targetGrid.copy()
+        if not running and self.startGrid is None and self.done():
+            return None
+        return self.submit(driver)
+
+    # Lets the drag in progress finish, then ends the job; returns at once
+    def stop(self):
+        self.stopEvent.set()
+        self.job = None
+
+    def submit(self, driver):
+        # an event per job, so the job being stopped keeps seeing its own set
+        self.stopEvent = threading.Event()
+        self.job = driver.submit(driver.run_reset(self, self.stopEvent))
+        return self.job
+
+    def done(self, targetGrid=None):
+        if targetGrid is None:
+            targetGrid = self.targetGrid
+        return sorted(self.grid.occupied()) == sorted(targetGrid.occupied())
+
+    # Called by the driver on its planning thread; returns [(startPos, endPos, waypoints), ...]
+    def plan(self, headPos):
+        if self.startGrid is not None:
+            # every job submitted before this one is done, so the housekeeping queue is settled: its pieces are
+            # taken from the intake cells
+            self.grid = housekeeping.physical_grid(self.startGrid)
+            housekeeping.discard()
+            self.startGrid = None
+        moves, seconds, self.unresolved = planner.plan_reconciliation(self.grid, self.targetGrid, headPos)
+        print("Board reset:", len(moves), "moves, est", round(seconds, 1), "s")
+        if len(self.unresolved) != 0:
+            print("Board reset can't place:", self.unresolved)
+        return moves
+
+    # Called by the driver after each drag; endPos is where the piece was dropped
+    def moved(self, startPos, endPos):
+        self.grid.move_piece(startPos, endPos)
+        self.moves += 1
+
+
+boardReset = BoardReset()
+
+
+# Edge-row cells next to each capture buffer where the user puts a piece they captured by hand, one piece each:
+# the far corner, then the near one while the far one still holds a piece waiting for the gantry
+INTAKE_CELLS = {'w': [[16, 1], [0, 1]], 'b': [[16, 23], [0, 23]]}
+
+
+# Low-priority gantry jobs deferred to the opponent's think time, i.e. dragging a piece the user captured by hand
+# from its intake cell to the buffer slot GameState recorded it in. start() runs them while the game waits on the
+# opponent; stop() preempts them at the next job boundary without waiting, and unfinished jobs stay queued
+class Housekeeping():
+    def __init__(self):
+        self.jobs = []              # [(startPos, endPos), ...]: the piece is at startPos, the gamestate has it at endPos
+        self.job = None
+        self.stopEvent = threading.Event()
+
+    def add(self, startPos, endPos):
+        self.jobs.append(([startPos[0], startPos[1]], [endPos[0], endPos[1]]))
+
+    def pending(self):
+        return len(self.jobs) != 0
+
+    # Intake cell for a hand-captured piece of color, or None while every one holds a piece still queued
+    def intake_cell(self, color):
+        queued = [startPos for startPos, _ in self.jobs]
+        for cell in INTAKE_CELLS[color]:
+            if cell not in queued:
+                return cell
+        return None
+
+    # posGrid has every queued piece at its endPos already; it is copied, as the gamestate keeps changing
+    # Returns the job future, or None if there is nothing to do or the jobs are already running
+    def start(self, driver, posGrid):
+        if not self.pending() or (self.job is not None and not self.job.done()):
+            return None
+        self.stopEvent.clear()
+        self.job = driver.submit(driver.run_housekeeping(self, self.physical_grid(posGrid)))
+        return self.job
+
+    def stop(self):
+        self.stopEvent.set()
+
+    # Drops every queued job (i.e a board reset takes the pieces from where they are); the job in progress ends
+    # after its current piece
+    def discard(self):
+        self.stop()
+        self.jobs = []
+
+    # posGrid with the queued pieces where they physically are
+    def physical_grid(self, posGrid):
+        grid = posGrid.copy()
+        for startPos, endPos in self.jobs:
+            grid.move_piece(endPos, startPos)
+        return grid
+
+    # Called by the driver on its planning thread with the physical grid; waypoint lists for job or -1
+    def plan(self, grid, job):
+        startPos, endPos = job
+        return plan_leg(grid, startPos, endPos, verbose=False)
+
+    # Called by the driver once job has run
+    def finished(self, grid, job):
+        if job in self.jobs:
+            self.jobs.remove(job)
+        grid.move_piece(job[0], job[1])
+
+
+housekeeping = Housekeeping()
+
+
+# Keep planned paths on disk so the first game after boot starts with a warm cache
+def enable_path_cache_persistence(cacheFile=PATH_CACHE_FILE):
+    pathCache.cacheFile = cacheFile
+    pathCache.load()
+    atexit.register(pathCache.save)
+
+
+# GO timings [(fromPos, toPos, seconds from GO sent to ARRIVED read), ...] for calibrating the motion model
+motionSamples = []
+
+
+def record_go(fromPos, toPos, seconds):
+    if fromPos[0] == toPos[0] and fromPos[1] == toPos[1]:
+        return
+    motionSamples.append(([fromPos[0], fromPos[1]], [toPos[0], toPos[1]], seconds))
+    del motionSamples[:-MOTION_SAMPLES_MAX]
+
+
+# Plans with the motion model saved by the last calibration, if there is one
+def load_motion_model(modelFile=MOTION_MODEL_FILE):
+    if not os.path.exists(modelFile):
+        return
+    try:
+        with open(modelFile, 'r') as f:
+            planner.motionModel = planner.MotionCostModel.from_dict(json.load(f))
+    except (ValueError, KeyError, OSError):
+        print("Ignoring unreadable motion model:", modelFile)
+
+
+# Refits the motion model to GO timings (default: the ones recorded so far), plans with it from now on and
+# saves it for the next boot. Returns the model, or None if there are too few samples
+def calibrate_motion_model(samples=None, modelFile=MOTION_MODEL_FILE):
+    if samples is None:
+        samples = motionSamples
+    if len(samples) < MOTION_SAMPLES_MIN:
+        print("Motion model needs", MOTION_SAMPLES_MIN, "GO timings, have", len(samples))
+        return None
+    model, rmsSeconds = planner.fit_motion_model(samples)
+    planner.motionModel = model
+    # cached paths are still collision free, but were picked for the old timings
+    pathCache.clear()
+    pathCache.save()
+
+    values = model.to_dict()
+    values['samples'] = len(samples)
+    values['rmsSeconds'] = rmsSeconds
+    tmpFile = modelFile + ".tmp"
+    with open(tmpFile, 'w') as f:
+        json.dump(values, f, indent=1)
+    os.replace(tmpFile, modelFile)
+    print("Motion model:", values)
+    return model
+
+
 def transmit_uart_sim():
     while True:
         time.sleep(.03)
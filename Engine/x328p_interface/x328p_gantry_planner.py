@@ -0,0 +1,1141 @@
+# Path planning helpers for the gantry 328P interface
+# Plans lane paths over the 17x25 position grid kept alongside GameState
+
+import math
+import heapq
+import itertools
+import numpy
+from collections import OrderedDict
+
+MAP_ROWS = 17
+MAP_COLUMNS = 25
+
+# Cost of one step along a lane; diagonal steps cover sqrt(2) of a half cell
+ORTHOGONAL_COST = 1
+DIAGONAL_COST = math.sqrt(2)
+
+# (row step, column step, direction) using the same compass labels as Node.successors
+STEPS = [(0, -1, 's'), (-1, 0, 'w'), (-1, -1, 'sw'), (0, 1, 'n'),
+         (1, 0, 'e'), (1, 1, 'ne'), (1, -1, 'nw'), (-1, 1, 'se')]
+
+letterToColumn = {'a':5, 'b':7, 'c':9, 'd':11, 'e':13, 'f':15, 'g':17, 'h':19}  # To translate cell to grid location
+
+# One byte per grid cell; 0 is an empty cell
+EMPTY = 0
+pieceCodes = {'wP':1, 'wR':2, 'wH':3, 'wB':4, 'wQ':5, 'wK':6,
+              'bP':7, 'bR':8, 'bH':9, 'bB':10, 'bQ':11, 'bK':12}
+codePieces = {code: piece for piece, code in pieceCodes.items()}
+
+
+# Compact occupancy/piece-code grid of the 17x25 position map, updated in place by GameState
+class PositionGrid():
+    def __init__(self, cells=None):
+        if cells is None:
+            self.cells = bytearray(MAP_ROWS * MAP_COLUMNS)
+        else:
+            self.cells = bytearray(cells)
+        # bumped on every change so cached plans can tell the grid has moved on
+        self.version = 0
+
+    def copy(self):
+        grid = PositionGrid(self.cells)
+        grid.version = self.version
+        return grid
+
+    def is_empty(self, row, column):
+        return self.cells[row * MAP_COLUMNS + column] == EMPTY
+
+    # Returns the piece at pos (i.e 'wP') or None for an empty cell
+    def piece_at(self, pos):
+        code = self.cells[pos[0] * MAP_COLUMNS + pos[1]]
+        if code == EMPTY:
+            return None
+        return codePieces[code]
+
+    # Places piece at pos; None or '--' clears the cell
+    def set_piece(self, pos, piece):
+        if piece is None or piece == '--':
+            code = EMPTY
+        else:
+            code = pieceCodes[piece]
+        self.cells[pos[0] * MAP_COLUMNS + pos[1]] = code
+        self.version += 1
+
+    def move_piece(self, startPos, endPos):
+        piece = self.piece_at(startPos)
+        self.set_piece(startPos, None)
+        self.set_piece(endPos, piece)
+
+    # Returns the first position holding piece, or None
+    def find(self, piece):
+        index = self.cells.find(bytes([pieceCodes[piece]]))
+        if index == -1:
+            return None
+        return [index // MAP_COLUMNS, index % MAP_COLUMNS]
+
+    # Yields (pos, piece) for every occupied cell
+    def occupied(self):
+        for index, code in enumerate(self.cells):
+            if code != EMPTY:
+                yield [index // MAP_COLUMNS, index % MAP_COLUMNS], codePieces[code]
+
+
+# GameState.board indices to grid position (matches the legacy gamestate_to_position_map)
+def board_to_grid(x, y):
+    return [15 - (x * 2), (y * 2) + 5]
+
+
+# Capture buffer slot to grid position; white buffer on the left, black on the right
+def buffer_to_grid(color, row, column):
+    if color == 'b':
+        return [15 - (row * 2), (column * 2) + 22]
+    return [15 - (row * 2), column * 2]
+
+
+# Chess square (i.e 'e2') to grid position for a user playing userColor ('w' or 'b'). The board is laid out
+# from the user's side, as board_to_grid lays out GameState.board: a black user's board is turned half way round
+def square_to_grid(square, userColor):
+    pos = [(int(square[1:]) * 2) - 1, letterToColumn[square[0]]]
+    if userColor == 'b':
+        pos = [MAP_ROWS - 1 - pos[0], MAP_COLUMNS - 1 - pos[1]]
+    return pos
+
+
+# Builds the grid once from a gamestate; afterwards GameState applies move deltas directly
+def position_grid_from_gamestate(gamestate):
+    grid = PositionGrid()
+    for x in range(8):
+        for y in range(8):
+            if gamestate.board[x][y] != "--":
+                grid.set_piece(board_to_grid(x, y), gamestate.board[x][y])
+    for color, buffer in (('w', gamestate.wBuffer), ('b', gamestate.bBuffer)):
+        for row in range(len(buffer)):
+            for column in range(len(buffer[row])):
+                if buffer[row][column] != '--':
+                    # a staged piece stands on its staging cell instead of its slot
+                    pos = gamestate.stagedSlots.get((color, row, column), buffer_to_grid(color, row, column))
+                    grid.set_piece(pos, buffer[row][column])
+    grid.version = 0
+    return grid
+
+
+# Octile distance between two map positions; admissible for 8-connected lanes
+def octile_distance(posA, posB):
+    dx = abs(posA[0] - posB[0])
+    dy = abs(posA[1] - posB[1])
+    return ORTHOGONAL_COST * max(dx, dy) + (DIAGONAL_COST - ORTHOGONAL_COST) * min(dx, dy)
+
+
+# Cells the gantry may drag a piece through, occupied or not: off the top/bottom edge rows
+def is_lane(row, column):
+    return 0 < row < MAP_ROWS - 1 and 0 <= column < MAP_COLUMNS
+
+
+# Cells the gantry may drag a piece through: empty and off the top/bottom edge rows
+def is_lane_free(grid, row, column):
+    if not is_lane(row, column):
+        return False
+    return grid.cells[row * MAP_COLUMNS + column] == EMPTY
+
+
+# Total lane cost of a planned solution [(pos, direction), ...]; also accepts straight/45 degree waypoints
+def path_cost(solution):
+    cost = 0
+    for i in range(1, len(solution)):
+        prev = solution[i - 1][0]
+        curr = solution[i][0]
+        units = max(abs(curr[0] - prev[0]), abs(curr[1] - prev[1]))
+        if prev[0] != curr[0] and prev[1] != curr[1]:
+            cost += DIAGONAL_COST * units
+        else:
+            cost += ORTHOGONAL_COST * units
+    return cost
+
+
+# Returns the shortest lane path from startPos to endPos as [(pos, direction), ...], or -1
+# Diagonal steps follow the Node.successors rule: both orthogonal neighbours must be empty
+# With blockerCost set, occupied cells may be crossed at that extra cost (see plan_with_blockers)
+def astar(grid, startPos, endPos, blockerCost=None):
+    start = (startPos[0], startPos[1])
+    goal = (endPos[0], endPos[1])
+
+    frontier = [(octile_distance(start, goal), 0, start)]
+    cameFrom = {start: (None, '')}
+    costSoFar = {start: 0}
+    explored = set()
+    pushCount = 1
+
+    while len(frontier) != 0:
+        _, _, cell = heapq.heappop(frontier)
+        if cell in explored:
+            continue
+        if cell == goal:
+            solution = []
+            while cell is not None:
+                parent, direction = cameFrom[cell]
+                solution.append(([cell[0], cell[1]], direction))
+                cell = parent
+            solution.reverse()
+            return solution
+
+        explored.add(cell)
+        cost = costSoFar[cell]
+        for rowStep, columnStep, direction in STEPS:
+            row = cell[0] + rowStep
+            column = cell[1] + columnStep
+            nextCell = (row, column)
+            if nextCell in explored:
+                continue
+            blocked = nextCell != goal and not is_lane_free(grid, row, column)
+            if blocked and (blockerCost is None or not is_lane(row, column)):
+                continue
+
+            if rowStep != 0 and columnStep != 0:
+                # corner cutting is only allowed when both orthogonal neighbours are empty
+                if not grid.is_empty(cell[0] + rowStep, cell[1]) or not grid.is_empty(cell[0], cell[1] + columnStep):
+                    continue
+                stepCost = DIAGONAL_COST
+            else:
+                stepCost = ORTHOGONAL_COST
+            if blocked:
+                stepCost += blockerCost
+
+            newCost = cost + stepCost
+            if newCost < costSoFar.get(nextCell, math.inf):
+                costSoFar[nextCell] = newCost
+                cameFrom[nextCell] = (cell, direction)
+                heapq.heappush(frontier, (newCost + octile_distance(nextCell, goal), pushCount, nextCell))
+                pushCount += 1
+
+    print("no solution")
+    print("frontier: " + str(pushCount))
+    print("expandCount: " + str(len(explored)))
+    return -1
+
+
+# ---------------------------------------------------------------------------
+#   INCREMENTAL REPLANNING (D* Lite)
+# ---------------------------------------------------------------------------
+
+# Searches an IncrementalPlanner keeps, least recently used dropped first
+INCREMENTAL_SEARCHES = 64
+# Changed cells beyond which a search restarts instead of being repaired
+INCREMENTAL_RESET_CELLS = 60
+
+# Integer step costs (sqrt(2) to 6 places) keep search keys exact: float sums of the same distance taken in
+# another order can differ in the last bit, and D* Lite relies on equal keys comparing equal
+ORTHOGONAL_UNITS = 1000000
+DIAGONAL_UNITS = 1414214
+
+stepDirections = {(rowStep, columnStep): direction for rowStep, columnStep, direction in STEPS}
+
+
+# Neighbouring cells inside the map
+def neighbours(cell):
+    for rowStep, columnStep, _ in STEPS:
+        row = cell[0] + rowStep
+        column = cell[1] + columnStep
+        if 0 <= row < MAP_ROWS and 0 <= column < MAP_COLUMNS:
+            yield (row, column)
+
+
+# Lifelong search (LPA*, the fixed-start case of D* Lite) from start to goal: a lane distance field rooted at the
+# goal, with the same costs and collision rules as astar, that is repaired instead of rebuilt when cells change
+# occupancy. Only the part of the field the changed cells lie on is searched again
+class IncrementalSearch():
+    def __init__(self, grid, start, goal):
+        self.grid = grid.copy()     # occupancy the field was computed on
+        self.start = start
+        self.goal = goal
+        self.g = {}
+        self.rhs = {goal: 0}
+        self.queue = []
+        self.queued = {}            # cell -> its key in queue; older heap entries are stale
+        self.expansions = 0
+        self.push(goal)
+
+    # Cost of the step from u into neighbour v, or inf if a dragged piece can't make it
+    def step_cost(self, u, v):
+        if v != self.goal and not is_lane_free(self.grid, v[0], v[1]):
+            return math.inf
+        if u[0] != v[0] and u[1] != v[1]:
+            if not self.grid.is_empty(v[0], u[1]) or not self.grid.is_empty(u[0], v[1]):
+                return math.inf
+            return DIAGONAL_UNITS
+        return ORTHOGONAL_UNITS
+
+    # Octile distance in step units; consistent with step_cost
+    @staticmethod
+    def heuristic(cellA, cellB):
+        rows = abs(cellA[0] - cellB[0])
+        columns = abs(cellA[1] - cellB[1])
+        return ORTHOGONAL_UNITS * max(rows, columns) + (DIAGONAL_UNITS - ORTHOGONAL_UNITS) * min(rows, columns)
+
+    def key(self, cell):
+        distance = min(self.g.get(cell, math.inf), self.rhs.get(cell, math.inf))
+        return (distance + self.heuristic(self.start, cell), distance)
+
+    def push(self, cell):
+        key = self.key(cell)
+        self.queued[cell] = key
+        heapq.heappush(self.queue, (key, cell))
+
+    def update_cell(self, cell):
+        if cell != self.goal:
+            best = math.inf
+            for successor in neighbours(cell):
+                cost = self.step_cost(cell, successor)
+                if cost != math.inf:
+                    best = min(best, cost + self.g.get(successor, math.inf))
+            self.rhs[cell] = best
+        if self.g.get(cell, math.inf) != self.rhs.get(cell, math.inf):
+            self.push(cell)
+        else:
+            self.queued.pop(cell, None)
+
+    # Indices of the cells whose occupancy differs in grid
+    def changed_cells(self, grid):
+        return [index for index in range(MAP_ROWS * MAP_COLUMNS) if self.grid.cells[index] != grid.cells[index]]
+
+    # Takes the occupancy of the changed cells from grid; only steps next to a changed cell can change cost
+    def apply_changes(self, grid, changed):
+        for index in changed:
+            self.grid.cells[index] = grid.cells[index]
+        for index in changed:
+            for cell in neighbours((index // MAP_COLUMNS, index % MAP_COLUMNS)):
+                self.update_cell(cell)
+
+    def compute(self):
+        start = self.start
+        while len(self.queue) != 0:
+            key, cell = self.queue[0]
+            if self.queued.get(cell) != key:
+                heapq.heappop(self.queue)
+                continue
+            if key >= self.key(start) and self.rhs.get(start, math.inf) == self.g.get(start, math.inf):
+                break
+            heapq.heappop(self.queue)
+            self.expansions += 1
+            newKey = self.key(cell)
+            if key < newKey:
+                self.queued[cell] = newKey
+                heapq.heappush(self.queue, (newKey, cell))
+            elif self.g.get(cell, math.inf) > self.rhs[cell]:
+                self.g[cell] = self.rhs[cell]
+                del self.queued[cell]
+                for predecessor in neighbours(cell):
+                    self.update_cell(predecessor)
+            else:
+                self.g[cell] = math.inf
+                self.update_cell(cell)
+                for predecessor in neighbours(cell):
+                    self.update_cell(predecessor)
+
+    # Descends the distance field from the start; [(pos, direction), ...] like astar, or -1
+    def solution(self):
+        if self.g.get(self.start, math.inf) == math.inf:
+            return -1
+        cell = self.start
+        solution = [([cell[0], cell[1]], '')]
+        while cell != self.goal:
+            best = None
+            bestCost = math.inf
+            for successor in neighbours(cell):
+                cost = self.step_cost(cell, successor) + self.g.get(successor, math.inf)
+                if cost < bestCost:
+                    best = successor
+                    bestCost = cost
+            if best is None or len(solution) > MAP_ROWS * MAP_COLUMNS:
+                return -1
+            solution.append(([best[0], best[1]], stepDirections[(best[0] - cell[0], best[1] - cell[1])]))
+            cell = best
+        return solution
+
+
+# Lane path planner for a series of legs on a changing grid: keeps the search of every (start, goal) pair, so
+# searching a leg again after other legs ran only repairs what they changed. Only blocker relocation uses it,
+# where the penalty scales search mostly the same parking, route and restore legs a blocker or two apart.
+# The legs of a move (capture, castling rook, promotion swap) are planned with fastest_path instead: they are
+# different (start, goal) pairs, so one leg's search can't be repaired into the next, and a changed cell alters
+# every GO ray through it rather than a few lane steps. Reconciliation lanes are mostly free, so a move there
+# is rarely searched twice either
+# With incremental=False every search starts from scratch (the baseline the benchmark compares against)
+class IncrementalPlanner():
+    def __init__(self, incremental=True):
+        self.incremental = incremental
+        self.searches = OrderedDict()
+        self.legs = []      # (expansions, changed cells) of every search, in order
+
+    # Same result as astar(grid, startPos, endPos): a shortest lane path, or -1
+    def astar(self, grid, startPos, endPos):
+        start = (startPos[0], startPos[1])
+        goal = (endPos[0], endPos[1])
+        search = self.searches.pop((start, goal), None) if self.incremental else None
+        changed = []
+        if search is not None:
+            changed = search.changed_cells(grid)
+            if len(changed) > INCREMENTAL_RESET_CELLS:
+                search = None
+        if search is None:
+            search = IncrementalSearch(grid, start, goal)
+        self.searches[(start, goal)] = search
+        while len(self.searches) > INCREMENTAL_SEARCHES:
+            self.searches.popitem(last=False)
+
+        expansions = search.expansions
+        search.apply_changes(grid, changed)
+        search.compute()
+        self.legs.append((search.expansions - expansions, len(changed)))
+        return search.solution()
+
+
+# ---------------------------------------------------------------------------
+#   CAPTURE BUFFER SLOTS
+# ---------------------------------------------------------------------------
+
+# Buffer rows for each piece type; pawns fill rows 0-3 and the king shares the queen row
+BUFFER_ROWS = {'P': [0, 1, 2, 3], 'B': [4], 'H': [5], 'R': [6], 'Q': [7]}
+BUFFER_COLUMNS = 2
+# Weight of the later promotion retrieval against the capture drag when choosing a slot for B/H/R/Q
+RETRIEVAL_WEIGHT = 0.5
+
+
+def buffer_slot_type(pieceType):
+    return 'Q' if pieceType == 'K' else pieceType
+
+
+# Free and filled capture buffer slots per (color, piece type); kept in step with GameState's buffers
+# userColor is the color the user plays, which decides the side of the grid each color promotes on
+# A staged slot's piece waits on a staging cell beside the promotion rank; the slot stays filled until it is used
+class BufferAllocator():
+    def __init__(self, userColor='w'):
+        self.userColor = userColor
+        self.free = {}
+        self.filled = {}
+        self.staged = {}        # (color, row, column) -> staging cell
+        for color in ('w', 'b'):
+            for pieceType, rows in BUFFER_ROWS.items():
+                self.free[(color, pieceType)] = [(row, column) for row in rows for column in range(BUFFER_COLUMNS)]
+                self.filled[(color, pieceType)] = []
+
+    def copy(self):
+        allocator = BufferAllocator(self.userColor)
+        allocator.free = {key: slots[:] for key, slots in self.free.items()}
+        allocator.filled = {key: slots[:] for key, slots in self.filled.items()}
+        allocator.staged = dict(self.staged)
+        return allocator
+
+    # Records a buffer write; piece is '--' when the slot is emptied
+    def set_slot(self, color, row, column, piece):
+        slot = (row, column)
+        for pieceType, rows in BUFFER_ROWS.items():
+            if row in rows:
+                key = (color, pieceType)
+        if piece == '--' or piece is None:
+            self.staged.pop((color, row, column), None)
+            if slot in self.filled[key]:
+                self.filled[key].remove(slot)
+                self.free[key].append(slot)
+        elif slot in self.free[key]:
+            self.free[key].remove(slot)
+            self.filled[key].append(slot)
+
+    # Free slot for a piece captured at grid position fromPos, or None if its buffer row is full
+    # Minimises the capture drag, plus the drag back to the promotion rank for pieces a pawn can promote to
+    def choose(self, color, pieceType, fromPos=None):
+        pieceType = buffer_slot_type(pieceType)
+        slots = self.free[(color, pieceType)]
+        if len(slots) == 0:
+            return None
+        # a white piece is only ever returned to the board for a white promotion on rank 8
+        promotionRow = square_to_grid('a8' if color == 'w' else 'a1', self.userColor)[0]
+
+        def travel(slot):
+            slotPos = buffer_to_grid(color, slot[0], slot[1])
+            cost = 0 if fromPos is None else octile_distance(fromPos, slotPos)
+            if pieceType != 'P':
+                boardEdge = 5 if color == 'w' else 19
+                cost += RETRIEVAL_WEIGHT * octile_distance(slotPos, [promotionRow, boardEdge])
+            return (cost, slot)
+        slot = min(slots, key=travel)
+        return [slot[0], slot[1]]
+
+    # Records the piece in a filled slot as moved out to the staging cell
+    def stage(self, color, row, column, cell):
+        self.staged[(color, row, column)] = [cell[0], cell[1]]
+
+    # Slot of the piece staged at cell, or None
+    def staged_slot(self, color, cell):
+        for (slotColor, row, column), stagedCell in self.staged.items():
+            if slotColor == color and stagedCell == [cell[0], cell[1]]:
+                return [row, column]
+        return None
+
+    # Filled slot of pieceType closest to grid position toPos (i.e the promotion square), or None
+    # Staged pieces are not in their slots, so they are left out
+    def retrieve(self, color, pieceType, toPos=None):
+        slots = [slot for slot in self.filled[(color, buffer_slot_type(pieceType))]
+                 if (color, slot[0], slot[1]) not in self.staged]
+        if len(slots) == 0:
+            return None
+
+        def travel(slot):
+            slotPos = buffer_to_grid(color, slot[0], slot[1])
+            return (0 if toPos is None else octile_distance(slotPos, toPos), slot)
+        slot = min(slots, key=travel)
+        return [slot[0], slot[1]]
+
+
+def buffer_allocator_from_gamestate(gamestate):
+    allocator = BufferAllocator(gamestate.userColor)
+    for color, buffer in (('w', gamestate.wBuffer), ('b', gamestate.bBuffer)):
+        for row in range(len(buffer)):
+            for column in range(len(buffer[row])):
+                if buffer[row][column] != '--':
+                    allocator.set_slot(color, row, column, buffer[row][column])
+    for (color, row, column), cell in gamestate.stagedSlots.items():
+        allocator.stage(color, row, column, cell)
+    return allocator
+
+
+# ---------------------------------------------------------------------------
+#   TRAVEL TIME ESTIMATES
+# ---------------------------------------------------------------------------
+
+# From the gantry firmware: 2001.875 steps per unit at a 112us cruise step period (28 ticks of 4us)
+SECONDS_PER_UNIT = 0.224
+# Accel/decel ramps in step_straightX/Y plus the X/Y/GO/ARRIVED exchange
+SECONDS_PER_GO = 0.8
+# transmit_path waits .5s after EM ON; the firmware pulses the EM for 1.25s when turning it OFF
+EM_ON_SECONDS = 0.5
+EM_OFF_SECONDS = 1.25
+
+
+# Motion primitives of the firmware GO: at most one diagonal move and one straight X or Y move, each with
+# its own speed ramp (step_Diagonal, step_straightX, step_straightY). X is the grid column, Y the grid row
+MOTION_PRIMITIVES = ('x', 'y', 'diagonal')
+# Starting point for fitting: the firmware ramps from a 236us to a 112us step period over 6000 steps (3 units)
+FIT_ACCELERATION = 2.5
+FIT_ITERATIONS = 50
+
+
+# Travel time model of the gantry: cruise velocity (units/s) and acceleration (units/s^2) per motion primitive,
+# plus a fixed cost per GO (UART exchange, settling). The defaults reproduce the fixed estimates above:
+# cruise speed everywhere, with the ramps folded into SECONDS_PER_GO
+class MotionCostModel():
+    def __init__(self, velocity=None, acceleration=None, goSeconds=SECONDS_PER_GO,
+                 emOnSeconds=EM_ON_SECONDS, emOffSeconds=EM_OFF_SECONDS):
+        self.velocity = dict(velocity) if velocity else {primitive: 1 / SECONDS_PER_UNIT
+                                                         for primitive in MOTION_PRIMITIVES}
+        self.acceleration = dict(acceleration) if acceleration else {primitive: math.inf
+                                                                     for primitive in MOTION_PRIMITIVES}
+        self.goSeconds = goSeconds
+        self.emOnSeconds = emOnSeconds
+        self.emOffSeconds = emOffSeconds
+
+    # Seconds for one primitive over units: trapezoidal speed profile, triangular when too short to reach cruise
+    def primitive_seconds(self, primitive, units):
+        if units == 0:
+            return 0
+        velocity = self.velocity[primitive]
+        acceleration = self.acceleration[primitive]
+        if units * acceleration >= velocity * velocity:
+            return units / velocity + velocity / acceleration
+        return 2 * math.sqrt(units / acceleration)
+
+    # Seconds for a straight or 45 degree GO of units in direction (rowStep, columnStep)
+    def ray_seconds(self, rowStep, columnStep, units):
+        if rowStep != 0 and columnStep != 0:
+            primitive = 'diagonal'
+        elif columnStep != 0:
+            primitive = 'x'
+        else:
+            primitive = 'y'
+        return self.goSeconds + self.primitive_seconds(primitive, units)
+
+    # Seconds for any GO; the firmware moves diagonally first, then straight along the longer axis
+    def go_seconds(self, fromPos, toPos):
+        rows = abs(fromPos[0] - toPos[0])
+        columns = abs(fromPos[1] - toPos[1])
+        if rows == 0 and columns == 0:
+            return 0
+        seconds = self.goSeconds + self.primitive_seconds('diagonal', min(rows, columns))
+        if columns > rows:
+            seconds += self.primitive_seconds('x', columns - rows)
+        else:
+            seconds += self.primitive_seconds('y', rows - columns)
+        return seconds
+
+    def to_dict(self):
+        return {'velocity': self.velocity, 'acceleration': self.acceleration, 'goSeconds': self.goSeconds,
+                'emOnSeconds': self.emOnSeconds, 'emOffSeconds': self.emOffSeconds}
+
+    @staticmethod
+    def from_dict(values):
+        return MotionCostModel(values['velocity'], values['acceleration'], values['goSeconds'],
+                               values.get('emOnSeconds', EM_ON_SECONDS), values.get('emOffSeconds', EM_OFF_SECONDS))
+
+
+# Model used by every estimate below; replaced by gantry_interface when a calibrated model is loaded
+motionModel = MotionCostModel()
+
+
+# Fits velocity, acceleration and GO overhead to GO timings [(fromPos, toPos, seconds), ...] with damped
+# Gauss-Newton steps (numpy least squares) on the log of each parameter, so they all stay positive.
+# Primitives that never occur in the samples keep their starting values. Returns (model, rms seconds)
+def fit_motion_model(samples, initial=None):
+    if initial is None:
+        initial = motionModel
+    names = [('velocity', primitive) for primitive in MOTION_PRIMITIVES] + \
+            [('acceleration', primitive) for primitive in MOTION_PRIMITIVES] + [('goSeconds', None)]
+
+    def model_from(params):
+        values = numpy.exp(params)
+        model = MotionCostModel(emOnSeconds=initial.emOnSeconds, emOffSeconds=initial.emOffSeconds)
+        for (field, primitive), value in zip(names, values):
+            if primitive is None:
+                model.goSeconds = float(value)
+            else:
+                getattr(model, field)[primitive] = float(value)
+        return model
+
+    def residuals(params):
+        model = model_from(params)
+        return numpy.array([model.go_seconds(fromPos, toPos) - seconds for fromPos, toPos, seconds in samples])
+
+    start = []
+    for field, primitive in names:
+        value = initial.goSeconds if primitive is None else getattr(initial, field)[primitive]
+        if field == 'acceleration' and not math.isfinite(value):
+            value = FIT_ACCELERATION
+        start.append(math.log(value))
+    params = numpy.array(start)
+    error = residuals(params)
+    damping = 1e-2
+    for _ in range(FIT_ITERATIONS):
+        jacobian = numpy.empty((len(samples), len(params)))
+        for i in range(len(params)):
+            shifted = params.copy()
+            shifted[i] += 1e-6
+            jacobian[:, i] = (residuals(shifted) - error) / 1e-6
+        # damped step: least squares of [J; sqrt(damping) I] step = [-error; 0]
+        system = numpy.vstack([jacobian, math.sqrt(damping) * numpy.eye(len(params))])
+        target = numpy.concatenate([-error, numpy.zeros(len(params))])
+        step = numpy.linalg.lstsq(system, target, rcond=None)[0]
+        newError = residuals(params + step)
+        if newError @ newError < error @ error:
+            params = params + step
+            error = newError
+            damping = max(damping / 3, 1e-9)
+        else:
+            damping *= 4
+        if numpy.abs(step).max() < 1e-6:
+            break
+    return model_from(params), math.sqrt(error @ error / max(len(samples), 1))
+
+
+# Seconds for an EM-off GO
+def estimate_transit_seconds(fromPos, toPos):
+    return motionModel.go_seconds(fromPos, toPos)
+
+
+def sign(value):
+    return (value > 0) - (value < 0)
+
+
+# Seconds to drag a piece along a solution or waypoint list [(pos, direction), ...]; one GO per straight run
+def estimate_path_seconds(solution):
+    seconds = motionModel.emOnSeconds + motionModel.emOffSeconds
+    runStart = 0
+    for i in range(1, len(solution)):
+        if i + 1 < len(solution):
+            prev, curr, following = solution[i - 1][0], solution[i][0], solution[i + 1][0]
+            step = (sign(curr[0] - prev[0]), sign(curr[1] - prev[1]))
+            if step == (sign(following[0] - curr[0]), sign(following[1] - curr[1])):
+                continue
+        seconds += motionModel.go_seconds(solution[runStart][0], solution[i][0])
+        runStart = i
+    return seconds
+
+
+# ---------------------------------------------------------------------------
+#   IDLE PARKING
+# ---------------------------------------------------------------------------
+
+# Cell that minimises the expected EM-off transit to the next pickup; pickups maps (row, column) to a weight
+# The head travels under the pieces with the EM off, so every cell is a candidate
+def parking_cell(pickups):
+    if len(pickups) == 0:
+        return None
+    best = None
+    bestSeconds = math.inf
+    for row in range(MAP_ROWS):
+        for column in range(MAP_COLUMNS):
+            seconds = 0
+            for pickup, weight in pickups.items():
+                seconds += weight * estimate_transit_seconds([row, column], pickup)
+            if seconds < bestSeconds:
+                best = [row, column]
+                bestSeconds = seconds
+    return best
+
+
+# ---------------------------------------------------------------------------
+#   SMOOTHING (fewer GO commands per move)
+# ---------------------------------------------------------------------------
+
+# Smooths an astar solution into the fewest straight/45 degree GO segments that stay collision free
+# Segments may leave the solution but not its bounding box, so a smoothed path never needs more room than
+# the lane path did. Segments are weighed by estimated seconds, so a GO is only saved when it isn't
+# paid back with a longer drag. Returns waypoints [(pos, direction), ...] ready for transmit_path
+def smooth_path(grid, solution):
+    if len(solution) < 3:
+        return solution
+    start = (solution[0][0][0], solution[0][0][1])
+    goal = (solution[-1][0][0], solution[-1][0][1])
+    rowLow = min(pos[0] for pos, _ in solution)
+    rowHigh = max(pos[0] for pos, _ in solution)
+    columnLow = min(pos[1] for pos, _ in solution)
+    columnHigh = max(pos[1] for pos, _ in solution)
+
+    # Dijkstra over cells where every edge is one GO; cost is (seconds, GO count)
+    frontier = [((0, 0), start)]
+    cameFrom = {start: (None, '')}
+    costSoFar = {start: (0, 0)}
+    explored = set()
+    while len(frontier) != 0:
+        cost, cell = heapq.heappop(frontier)
+        if cell in explored:
+            continue
+        if cell == goal:
+            break
+        explored.add(cell)
+        for rowStep, columnStep, direction in STEPS:
+            row, column = cell
+            units = 0
+            while True:
+                if not (rowLow <= row + rowStep <= rowHigh and columnLow <= column + columnStep <= columnHigh):
+                    break
+                if rowStep != 0 and columnStep != 0:
+                    if not grid.is_empty(row + rowStep, column) or not grid.is_empty(row, column + columnStep):
+                        break
+                row += rowStep
+                column += columnStep
+                atGoal = (row, column) == goal
+                if not atGoal and not is_lane_free(grid, row, column):
+                    break
+                units += 1
+                nextCell = (row, column)
+                newCost = (cost[0] + motionModel.ray_seconds(rowStep, columnStep, units), cost[1] + 1)
+                if nextCell not in explored and newCost < costSoFar.get(nextCell, (math.inf, math.inf)):
+                    costSoFar[nextCell] = newCost
+                    cameFrom[nextCell] = (cell, direction)
+                    heapq.heappush(frontier, (newCost, nextCell))
+                if atGoal:
+                    break
+
+    if goal not in cameFrom:
+        return solution
+    waypoints = []
+    cell = goal
+    while cell is not None:
+        parent, direction = cameFrom[cell]
+        waypoints.append(([cell[0], cell[1]], direction))
+        cell = parent
+    waypoints.reverse()
+    return waypoints
+
+
+# ---------------------------------------------------------------------------
+#   MINIMUM-TIME PLANNING
+# ---------------------------------------------------------------------------
+
+# Fastest lane path from startPos to endPos under the motion model, as waypoints [(pos, direction), ...]
+# ready for transmit_path, or -1. A* over cells where every edge is one straight or 45 degree GO, so a few long
+# runs that pay for their speed ramps once beat a shorter staircase of GOs. Same collision rules as astar
+def fastest_path(grid, startPos, endPos, model=None):
+    if model is None:
+        model = motionModel
+    start = (startPos[0], startPos[1])
+    goal = (endPos[0], endPos[1])
+    fastest = max(model.velocity.values())
+
+    # every GO costs goSeconds and no primitive beats cruise speed of the fastest axis
+    def heuristic(cell):
+        if cell == goal:
+            return 0
+        return model.goSeconds + max(abs(cell[0] - goal[0]), abs(cell[1] - goal[1])) / fastest
+
+    # cost is (seconds, GO count)
+    frontier = [(heuristic(start), 0, start)]
+    cameFrom = {start: (None, '')}
+    costSoFar = {start: (0, 0)}
+    explored = set()
+    while len(frontier) != 0:
+        _, _, cell = heapq.heappop(frontier)
+        if cell in explored:
+            continue
+        if cell == goal:
+            waypoints = []
+            while cell is not None:
+                parent, direction = cameFrom[cell]
+                waypoints.append(([cell[0], cell[1]], direction))
+                cell = parent
+            waypoints.reverse()
+            return waypoints
+
+        explored.add(cell)
+        cost = costSoFar[cell]
+        for rowStep, columnStep, direction in STEPS:
+            row, column = cell
+            units = 0
+            while True:
+                if not (0 <= row + rowStep < MAP_ROWS and 0 <= column + columnStep < MAP_COLUMNS):
+                    break
+                if rowStep != 0 and columnStep != 0:
+                    if not grid.is_empty(row + rowStep, column) or not grid.is_empty(row, column + columnStep):
+                        break
+                row += rowStep
+                column += columnStep
+                atGoal = (row, column) == goal
+                if not atGoal and not is_lane_free(grid, row, column):
+                    break
+                units += 1
+                nextCell = (row, column)
+                newCost = (cost[0] + model.ray_seconds(rowStep, columnStep, units), cost[1] + 1)
+                if nextCell not in explored and newCost < costSoFar.get(nextCell, (math.inf, math.inf)):
+                    costSoFar[nextCell] = newCost
+                    cameFrom[nextCell] = (cell, direction)
+                    heapq.heappush(frontier, (newCost[0] + heuristic(nextCell), newCost[1], nextCell))
+                if atGoal:
+                    break
+    return -1
+
+
+# ---------------------------------------------------------------------------
+#   RECONCILIATION (make one grid match another)
+# ---------------------------------------------------------------------------
+
+# Hungarian algorithm; cost is an n x m matrix with n <= m. Returns the column assigned to each row
+def min_cost_assignment(cost):
+    n = len(cost)
+    if n == 0:
+        return []
+    m = len(cost[0])
+    u = [0] * (n + 1)
+    v = [0] * (m + 1)
+    p = [0] * (m + 1)
+    way = [0] * (m + 1)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = [math.inf] * (m + 1)
+        used = [False] * (m + 1)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            delta = math.inf
+            j1 = 0
+            for j in range(1, m + 1):
+                if not used[j]:
+                    cur = cost[i0 - 1][j - 1] - u[i0] - v[j]
+                    if cur < minv[j]:
+                        minv[j] = cur
+                        way[j] = j0
+                    if minv[j] < delta:
+                        delta = minv[j]
+                        j1 = j
+            for j in range(m + 1):
+                if used[j]:
+                    u[p[j]] += delta
+                    v[j] -= delta
+                else:
+                    minv[j] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while True:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+            if j0 == 0:
+                break
+    assignment = [-1] * n
+    for j in range(1, m + 1):
+        if p[j] != 0:
+            assignment[p[j] - 1] = j - 1
+    return assignment
+
+
+# Minimum total travel matching of misplaced pieces to the squares they should occupy, per piece type
+# Returns ([(startPos, endPos), ...], unmatchedSources, unmatchedTargets)
+def match_pieces(grid, targetGrid):
+    sources = {}
+    targets = {}
+    for pos, piece in grid.occupied():
+        if targetGrid.piece_at(pos) != piece:
+            sources.setdefault(piece, []).append(pos)
+    for pos, piece in targetGrid.occupied():
+        if grid.piece_at(pos) != piece:
+            targets.setdefault(piece, []).append(pos)
+
+    matches = []
+    unmatchedSources = []
+    unmatchedTargets = []
+    for piece in pieceCodes:
+        pieceSources = sources.get(piece, [])
+        pieceTargets = targets.get(piece, [])
+        if len(pieceSources) <= len(pieceTargets):
+            cost = [[octile_distance(s, t) for t in pieceTargets] for s in pieceSources]
+            assignment = min_cost_assignment(cost)
+            pairs = [(pieceSources[i], pieceTargets[j]) for i, j in enumerate(assignment)]
+        else:
+            cost = [[octile_distance(s, t) for s in pieceSources] for t in pieceTargets]
+            assignment = min_cost_assignment(cost)
+            pairs = [(pieceSources[j], pieceTargets[i]) for i, j in enumerate(assignment)]
+        matches.extend(pairs)
+        matchedSources = [pair[0] for pair in pairs]
+        matchedTargets = [pair[1] for pair in pairs]
+        unmatchedSources.extend([(pos, piece) for pos in pieceSources if pos not in matchedSources])
+        unmatchedTargets.extend([(pos, piece) for pos in pieceTargets if pos not in matchedTargets])
+    return matches, unmatchedSources, unmatchedTargets
+
+
+# Empty squares and buffer slots that neither grid needs, closest to pos first; where pieces are parked
+def parking_candidates(grid, targetGrid, pos, reserved):
+    candidates = []
+    for row in range(1, MAP_ROWS - 1, 2):
+        for column in list(range(0, 4, 2)) + list(range(5, 20, 2)) + list(range(22, 25, 2)):
+            cell = [row, column]
+            if not grid.is_empty(row, column) or not targetGrid.is_empty(row, column) or cell in reserved:
+                continue
+            candidates.append(cell)
+    candidates.sort(key=lambda cell: octile_distance(pos, cell))
+    return candidates
+
+
+def nearest_parking_cell(grid, targetGrid, pos, reserved):
+    candidates = parking_candidates(grid, targetGrid, pos, reserved)
+    if len(candidates) == 0:
+        return None
+    return candidates[0]
+
+
+# Plans the moves that turn grid into targetGrid, starting with the gantry head at headPos
+# Moves are ordered so each destination is empty and has a lane path when it runs, picking the
+# nearest runnable move each time to keep empty transit short. Cycles are broken through a parking cell.
+# Returns (moves [(startPos, endPos, waypoints), ...], estimated seconds, unresolved [(pos, piece), ...])
+def plan_reconciliation(grid, targetGrid, headPos):
+    workGrid = grid.copy()
+    matches, unmatchedSources, unmatchedTargets = match_pieces(workGrid, targetGrid)
+
+    # pieces with no home in the target (i.e an extra promoted queen) only move if they sit on a needed square
+    pending = [[startPos, endPos] for startPos, endPos in matches]
+    unresolved = list(unmatchedTargets)
+    reserved = [endPos for _, endPos in pending]
+    for pos, piece in unmatchedSources:
+        if targetGrid.piece_at(pos) is not None:
+            parking = nearest_parking_cell(workGrid, targetGrid, pos, reserved)
+            if parking is None:
+                unresolved.append((pos, piece))
+                continue
+            pending.append([pos, parking])
+            reserved.append(parking)
+
+    moves = []
+    seconds = 0
+    head = headPos
+    while len(pending) != 0:
+        ready = [move for move in pending if workGrid.is_empty(move[1][0], move[1][1])]
+        ready.sort(key=lambda move: octile_distance(head, move[0]))
+        chosen = None
+        for move in ready:
+            solution = astar(workGrid, move[0], move[1])
+            if solution != -1:
+                chosen = (move, solution)
+                break
+
+        if chosen is None:
+            # every destination is occupied by a piece that still has to move (or blocked); park one of them
+            blocked = [move for move in pending if not workGrid.is_empty(move[1][0], move[1][1])]
+            parked = False
+            for move in sorted(blocked, key=lambda move: octile_distance(head, move[1])):
+                occupant = [other for other in pending if other[0] == move[1]]
+                if len(occupant) == 0:
+                    continue
+                parking = nearest_parking_cell(workGrid, targetGrid, move[1], reserved)
+                if parking is None:
+                    continue
+                solution = astar(workGrid, move[1], parking)
+                if solution == -1:
+                    continue
+                waypoints = smooth_path(workGrid, solution)
+                seconds += estimate_transit_seconds(head, move[1]) + estimate_path_seconds(waypoints)
+                moves.append((move[1], parking, waypoints))
+                workGrid.move_piece(move[1], parking)
+                occupant[0][0] = parking
+                head = parking
+                parked = True
+                break
+            if not parked:
+                for startPos, endPos in pending:
+                    unresolved.append((startPos, workGrid.piece_at(startPos)))
+                break
+            continue
+
+        move, solution = chosen
+        waypoints = smooth_path(workGrid, solution)
+        seconds += estimate_transit_seconds(head, move[0]) + estimate_path_seconds(waypoints)
+        moves.append((move[0], move[1], waypoints))
+        workGrid.move_piece(move[0], move[1])
+        head = move[1]
+        pending.remove(move)
+
+    return moves, seconds, unresolved
+
+
+# ---------------------------------------------------------------------------
+#   BLOCKER RELOCATION (when no lane path exists)
+# ---------------------------------------------------------------------------
+
+# Seconds to move one blocker aside and back: two short drags and the empty transits to them
+BLOCKER_SECONDS = 2 * (EM_ON_SECONDS + EM_OFF_SECONDS + 2 * SECONDS_PER_GO + 2 * SECONDS_PER_UNIT)
+# Blocker penalties tried, as multiples of BLOCKER_SECONDS; the plan with the lowest total time wins
+BLOCKER_PENALTY_SCALES = (0.5, 1, 2)
+# Parking cells tried per blocker before a plan is given up
+PARKING_TRIES = 4
+
+
+# Estimated seconds for moves [(startPos, endPos, waypoints), ...], including empty transits from headPos
+def estimate_moves_seconds(moves, headPos):
+    seconds = 0
+    for startPos, endPos, waypoints in moves:
+        if headPos is not None:
+            seconds += estimate_transit_seconds(headPos, startPos)
+        seconds += estimate_path_seconds(waypoints)
+        headPos = endPos
+    return seconds
+
+
+# Moves the blockers on a penalty route aside, routes the piece, then puts the blockers back in reverse order
+def plan_blocker_relocation(grid, startPos, endPos, blockerCost, replanner=None):
+    if replanner is None:
+        replanner = IncrementalPlanner()
+    route = astar(grid, startPos, endPos, blockerCost)
+    if route == -1:
+        return -1
+    blockers = [pos for pos, _ in route[1:-1] if not grid.is_empty(pos[0], pos[1])]
+    workGrid = grid.copy()
+    reserved = [pos for pos, _ in route]
+    moves = []
+    parked = []
+    for blocker in blockers:
+        for parking in parking_candidates(workGrid, workGrid, blocker, reserved)[:PARKING_TRIES]:
+            solution = replanner.astar(workGrid, blocker, parking)
+            if solution != -1:
+                break
+        else:
+            return -1
+        moves.append((blocker, parking, smooth_path(workGrid, solution)))
+        workGrid.move_piece(blocker, parking)
+        reserved.append(parking)
+        parked.append((blocker, parking))
+
+    solution = replanner.astar(workGrid, startPos, endPos)
+    if solution == -1:
+        return -1
+    moves.append((startPos, endPos, smooth_path(workGrid, solution)))
+    workGrid.move_piece(startPos, endPos)
+
+    for blocker, parking in reversed(parked):
+        solution = replanner.astar(workGrid, parking, blocker)
+        if solution == -1:
+            return -1
+        moves.append((parking, blocker, smooth_path(workGrid, solution)))
+        workGrid.move_piece(parking, blocker)
+    return moves
+
+
+# Plan for a move that has no lane path: the cheapest (by total estimated seconds) sequence of blocker moves,
+# the piece's own move and the blocker restores. Returns (moves [(startPos, endPos, waypoints), ...], seconds)
+# or -1. Blockers end up back on their own cells, so the grid only changes by the moved piece
+def plan_with_blockers(grid, startPos, endPos, headPos=None, replanner=None):
+    best = -1
+    bestSeconds = math.inf
+    # the penalty scales mostly pick the same blockers, so their parking and restore searches are shared
+    if replanner is None:
+        replanner = IncrementalPlanner()
+    for scale in BLOCKER_PENALTY_SCALES:
+        moves = plan_blocker_relocation(grid, startPos, endPos, scale * BLOCKER_SECONDS / SECONDS_PER_UNIT, replanner)
+        if moves == -1:
+            continue
+        seconds = estimate_moves_seconds(moves, headPos)
+        if seconds < bestSeconds:
+            best = (moves, seconds)
+            bestSeconds = seconds
+    return best
+
+
+# ---------------------------------------------------------------------------
+#   MULTI-LEG SCHEDULING (captures, en passant, castling, promotion)
+# ---------------------------------------------------------------------------
+
+# Runs the legs [(startPos, endPos), ...] of one chess move in the order with the lowest estimated total time,
+# empty transits from headPos included. A leg can only run once its end cell is empty and while its start cell
+# still holds the piece, so a captured piece always leaves before the capturing piece arrives.
+# route(grid, startPos, endPos) returns the waypoint lists for one leg on grid, or -1.
+# Returns (waypoint lists in execution order, seconds) or -1 if no order can be routed
+def schedule_legs(grid, legs, headPos, route):
+    # every leg moves a different piece, so the grid a leg is routed on only depends on which legs ran before it
+    routes = {}
+    best = -1
+    bestSeconds = math.inf
+    for order in itertools.permutations(range(len(legs))):
+        workGrid = grid.copy()
+        done = frozenset()
+        plan = []
+        seconds = 0
+        pos = headPos
+        for index in order:
+            startPos, endPos = legs[index]
+            if workGrid.is_empty(startPos[0], startPos[1]) or not workGrid.is_empty(endPos[0], endPos[1]):
+                break
+            if (done, index) not in routes:
+                routes[(done, index)] = route(workGrid, startPos, endPos)
+            waypointLists = routes[(done, index)]
+            if waypointLists == -1:
+                break
+            for waypoints in waypointLists:
+                if pos is not None:
+                    seconds += estimate_transit_seconds(pos, waypoints[0][0])
+                seconds += estimate_path_seconds(waypoints)
+                pos = waypoints[-1][0]
+            if seconds >= bestSeconds:
+                break
+            plan.extend(waypointLists)
+            workGrid.move_piece(startPos, endPos)
+            done = done | {index}
+        else:
+            best = (plan, seconds)
+            bestSeconds = seconds
+    return best
+
+
+# ---------------------------------------------------------------------------
+#   CORRECTIVE NUDGES (piece left off-centre by a move)
+# ---------------------------------------------------------------------------
+
+# Picks the piece at pos up and drags it one lane cell out and back, so the magnet pulls it over the centre of
+# its square again. Orthogonal lane cells first; returns the waypoints, or -1 if every neighbour is taken
+def nudge_path(grid, pos):
+    for rowStep, columnStep, direction in sorted(STEPS, key=lambda step: abs(step[0]) + abs(step[1])):
+        row = pos[0] + rowStep
+        column = pos[1] + columnStep
+        if not is_lane(row, column) or not grid.is_empty(row, column):
+            continue
+        if rowStep != 0 and columnStep != 0 and \
+                (not grid.is_empty(row, pos[1]) or not grid.is_empty(pos[0], column)):
+            continue
+        return [([pos[0], pos[1]], ''), ([row, column], direction),
+                ([pos[0], pos[1]], stepDirections[(-rowStep, -columnStep)])]
+    return -1
@@ -12,13 +12,14 @@ currentGamestate = gs()  # Instantiate test gamestate
 
 # print(currentGamestate.board)
 # Reset the board to no pieces (as Sam has no pieces)
+# (through set_board_cell, which keeps the occupancy bitboards the scans are compared with in step)
 for indexR, row in enumerate(currentGamestate.board):
     for indexC, item in enumerate(row):
-        currentGamestate.board[indexR][indexC] = '--'
+        currentGamestate.set_board_cell(indexR, indexC, '--')
         if indexR == 5 and indexC == 4:
-            currentGamestate.board[indexR][indexC] = 'bP'
+            currentGamestate.set_board_cell(indexR, indexC, 'bP')
         if indexR == 6 and indexC == 5:
-            currentGamestate.board[indexR][indexC] = 'wP'
+            currentGamestate.set_board_cell(indexR, indexC, 'wP')
         #if indexR == 6 and indexC == 2:
         #    currentGamestate.board[indexR][indexC] = 'wP'
 print("Initial State:")
@@ -0,0 +1,127 @@
+# Times fs_interface.MoveResolver on the scripted hand moves of x328p_fs_resolver_test, which checks what they
+# resolve to. Then plays the scripts back in real scan timing with sensor glitches, with and without
+# fs_interface.ScanFilter
+# Runs without the boards attached (same mocks as x328p_fs_scan_benchmark)
+# Usage: python x328p_fs_resolver_benchmark.py [repeats] [noisy trials] [seed]
+import sys
+import time
+import random
+
+import x328p_fs_scan_benchmark
+from x328p_fs_resolver_test import SCRIPTS, ScriptGame, script_scans
+from Engine.x328p_interface import x328p_fs_interface as fs
+
+# Noisy playback: each hand action held for ACTION_SECONDS and scanned every SCAN_PERIOD, with cell readings
+# flipped for GLITCH_SECONDS at GLITCH_RATE per second (a piece carried over a cell, a flickering sensor)
+SCAN_PERIOD = 0.0008
+ACTION_SECONDS = 0.3
+GLITCH_RATE = 6.0
+GLITCH_SECONDS = (0.001, 0.04)
+
+
+# (move, seconds after the last action it resolved at, resolver state changes, suppressed cell changes)
+def play_noisy(rng, game, scans, filtered):
+    states = [game.wOccupancy | game.bOccupancy] + scans
+    duration = len(states) * ACTION_SECONDS
+    glitches = []
+    t = rng.expovariate(GLITCH_RATE)
+    while t < duration:
+        glitches.append((t, t + rng.uniform(*GLITCH_SECONDS), 1 << rng.randrange(64)))
+        t += rng.expovariate(GLITCH_RATE)
+
+    resolver = fs.MoveResolver(game)
+    scanFilter = fs.ScanFilter(resolver.start)
+    stateChanges = 0
+    state = resolver.state
+    frame = 0
+    while frame * SCAN_PERIOD < duration:
+        now = frame * SCAN_PERIOD
+        occupancy = states[int(now / ACTION_SECONDS)]
+        for start, end, bit in glitches:
+            if start <= now < end:
+                occupancy ^= bit
+        if filtered:
+            occupancy = scanFilter.update(occupancy, now)
+        move = resolver.update(occupancy)
+        if resolver.state != state:
+            state = resolver.state
+            stateChanges += 1
+        if move is not None:
+            return move, now - (len(states) - 1) * ACTION_SECONDS, stateChanges, scanFilter.suppressed()
+        frame += 1
+    return None, None, stateChanges, scanFilter.suppressed()
+
+
+def run_noisy(cases, trials, seed):
+    print("Noisy playback: {} scripts x {} trials, scans every {} ms, {} glitches/s of {}-{} ms".format(
+        len(cases), trials, 1000 * SCAN_PERIOD, GLITCH_RATE, 1000 * GLITCH_SECONDS[0], 1000 * GLITCH_SECONDS[1]))
+    print("{:<12}{:>8}{:>8}{:>10}{:>16}{:>20}{:>12}".format("scan filter", "right", "wrong", "unsolved",
+                                                              "state changes", "latency ms (mean)", "suppressed"))
+    for filtered in (False, True):
+        rng = random.Random(seed)
+        right = wrong = unsolved = stateChanges = suppressed = 0
+        latencies = []
+        for expected, game, scans in cases:
+            for _ in range(trials):
+                move, latency, changes, dropped = play_noisy(rng, game, scans, filtered)
+                stateChanges += changes
+                suppressed += dropped
+                if move is None:
+                    unsolved += 1
+                elif move == expected and latency >= 0:
+                    right += 1
+                    latencies.append(latency)
+                else:
+                    wrong += 1
+        runs = len(cases) * trials
+        print("{:<12}{:>8}{:>8}{:>10}{:>16.1f}{:>20.1f}{:>12.1f}".format(
+            "on" if filtered else "off", right, wrong, unsolved, stateChanges / runs,
+            1000 * sum(latencies) / max(len(latencies), 1), suppressed / runs))
+
+
+def run(repeats, trials, seed):
+    cases = []
+    for name, color, pieces, actions, expected in SCRIPTS:
+        game = ScriptGame(color, pieces)
+        cases.append((game, script_scans(game, actions)))
+
+    updates = 0
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        for game, scans in cases:
+            resolver = fs.MoveResolver(game)
+            for scan in scans:
+                resolver.update(scan)
+            updates += len(scans)
+    elapsed = time.perf_counter() - t0
+    # updates only: the resolver for a move is made once, before its scans
+    resolvers = [fs.MoveResolver(game) for game, _ in cases]
+    t1 = time.perf_counter()
+    for _ in range(repeats):
+        for resolver, (_, scans) in zip(resolvers, cases):
+            resolver.everLifted = 0
+            for scan in scans:
+                resolver.update(scan)
+    updateSeconds = time.perf_counter() - t1
+    print("Scripts:", len(cases), "repeats:", repeats)
+    print("  {:.2f} us per update, {:.1f} us per resolver made".format(
+        1e6 * updateSeconds / updates, 1e6 * (elapsed - updateSeconds) / (repeats * len(cases))))
+
+    filterUpdates = 0
+    scanFilter = fs.ScanFilter(0)
+    t2 = time.perf_counter()
+    for i in range(repeats):
+        for _, scans in cases:
+            for scan in scans:
+                scanFilter.update(scan, i)
+            filterUpdates += len(scans)
+    print("  {:.2f} us per scan filter update".format(1e6 * (time.perf_counter() - t2) / filterUpdates))
+    print()
+    run_noisy([(SCRIPTS[i][4], game, scans) for i, (game, scans) in enumerate(cases)], trials, seed)
+
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    trials = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    run(repeats, trials, seed)
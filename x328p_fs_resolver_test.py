@@ -0,0 +1,117 @@
+# Testing module for x328p_fs_interface.py MoveResolver: scripted hand moves (quiet, captures in either order,
+# en passant, castling both ways, a piece put back, promotion) for a user playing white and one playing black;
+# every scan of a script must leave the resolver undecided except the last, which must give the move
+# Runs without the boards attached (same mocks as x328p_fs_scan_benchmark)
+import sys
+
+import x328p_fs_scan_benchmark
+from Engine.x328p_interface import x328p_fs_interface as fs
+
+START_ROWS = [['bR', 'bH', 'bB', 'bQ', 'bK', 'bB', 'bH', 'bR'], ['bP'] * 8] + [["--"] * 8 for _ in range(4)] + \
+             [['wP'] * 8, ['wR', 'wH', 'wB', 'wQ', 'wK', 'wB', 'wH', 'wR']]
+
+
+# The parts of GameState a MoveResolver reads; pieces are given by square (i.e {'e2': 'wP'})
+class ScriptGame():
+    def __init__(self, userColor, pieces):
+        self.userColor = userColor
+        if userColor == 'w':
+            self.letter_to_y = {letter: y for y, letter in enumerate("abcdefgh")}
+            self.number_to_x = {str(8 - x): x for x in range(8)}
+        else:
+            self.letter_to_y = {letter: 7 - y for y, letter in enumerate("abcdefgh")}
+            self.number_to_x = {str(x + 1): x for x in range(8)}
+        self.board = [["--"] * 8 for _ in range(8)]
+        for square, piece in pieces.items():
+            x, y = self.cell(square)
+            self.board[x][y] = piece
+        self.wOccupancy = fs.board_occupancy(self.board, 'w')
+        self.bOccupancy = fs.board_occupancy(self.board, 'b')
+
+    def cell(self, square):
+        return self.number_to_x[square[1]], self.letter_to_y[square[0]]
+
+    def bit(self, square):
+        return fs.board_bit(*self.cell(square))
+
+
+def start_pieces():
+    pieces = {}
+    for x, row in enumerate(START_ROWS):
+        for y, piece in enumerate(row):
+            if piece != "--":
+                pieces["abcdefgh"[y] + str(8 - x)] = piece
+    return pieces
+
+
+def position(*placed, removed=()):
+    pieces = start_pieces()
+    for square in removed:
+        del pieces[square]
+    for square, piece in placed:
+        pieces[square] = piece
+    return pieces
+
+
+# (name, user color, pieces by square, hand actions ('-' lifts a square, '+' puts a piece down), move)
+SCRIPTS = [
+    ("quiet move", 'w', start_pieces(), ["-e2", "+e4"], "e2e4"),
+    ("knight, black user", 'b', start_pieces(), ["-g8", "+f6"], "g8f6"),
+    ("capture, own piece first", 'w', position(('e4', 'wP'), ('d5', 'bP'), removed=('e2', 'd7')),
+     ["-e4", "-d5", "+d5"], "e4d5"),
+    ("capture, victim first", 'w', position(('e4', 'wP'), ('d5', 'bP'), removed=('e2', 'd7')),
+     ["-d5", "-e4", "+d5"], "e4d5"),
+    ("capture, black user", 'b', position(('e4', 'wP'), ('d5', 'bP'), removed=('e2', 'd7')),
+     ["-e4", "-d5", "+e4"], "d5e4"),
+    ("en passant", 'w', position(('e5', 'wP'), ('d5', 'bP'), removed=('e2', 'd7')),
+     ["-e5", "+d6", "-d5"], "e5d6"),
+    ("en passant, victim first", 'b', position(('d4', 'bP'), ('e4', 'wP'), removed=('d7', 'e2')),
+     ["-e4", "-d4", "+e3"], "d4e3"),
+    ("castling short", 'w', position(removed=('f1', 'g1')), ["-e1", "+g1", "-h1", "+f1"], "e1g1"),
+    ("castling long", 'w', position(removed=('b1', 'c1', 'd1')), ["-e1", "+c1", "-a1", "+d1"], "e1c1"),
+    ("castling, black user", 'b', position(removed=('f8', 'g8')), ["-e8", "-h8", "+f8", "+g8"], "e8g8"),
+    ("piece put back", 'w', start_pieces(), ["-b1", "+b1", "-g1", "+f3"], "g1f3"),
+    ("promotion", 'w', position(('b7', 'wP'), removed=('b2', 'b7', 'b8')), ["-b7", "+b8"], "b7b8"),
+]
+
+
+# Scans of a script, one after each hand action
+def script_scans(game, actions):
+    occupancy = game.wOccupancy | game.bOccupancy
+    scans = []
+    for action in actions:
+        if action[0] == '-':
+            occupancy &= ~game.bit(action[1:])
+        else:
+            occupancy |= game.bit(action[1:])
+        scans.append(occupancy)
+    return scans
+
+
+# Feeds the scans of a script to a new resolver; returns (move, resolver state after each scan, passed)
+def check_script(game, scans, expected):
+    resolver = fs.MoveResolver(game)
+    states = []
+    passed = True
+    move = None
+    for i, scan in enumerate(scans):
+        move = resolver.update(scan)
+        states.append(resolver.state)
+        # undecided until the last scan
+        if (move is None) != (i != len(scans) - 1):
+            passed = False
+    return move, states, passed and move == expected
+
+
+if __name__ == '__main__':
+    failed = 0
+    for name, color, pieces, actions, expected in SCRIPTS:
+        game = ScriptGame(color, pieces)
+        move, states, passed = check_script(game, script_scans(game, actions), expected)
+        if not passed:
+            failed += 1
+        print("{:<28}{:<6}{:<8}{:<8}{}".format(name, color, str(move), "ok" if passed else "FAILED",
+                                                " > ".join(states)))
+    print(len(SCRIPTS) - failed, "of", len(SCRIPTS), "scripts resolved")
+    if failed != 0:
+        sys.exit(1)
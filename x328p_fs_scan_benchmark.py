@@ -0,0 +1,122 @@
+# Benchmark for fast-scan board reads: eight single-column SPI exchanges (receive_chess_column) vs one burst
+# transfer (receive_occupancy), against a mock 328P that answers like the HallSensor firmware and takes as long
+# on the bus as the clock rate and byte gaps of each transfer would
+# Runs without the boards attached; spidev and the UART are replaced with mocks before import
+# Usage: python x328p_fs_scan_benchmark.py [seconds per mode] [seed]
+import sys
+import time
+import types
+import random
+import serial
+
+
+class MockSerial():
+    def __init__(self, *args, **kwargs):
+        self.timeout = None
+
+    def flush(self):
+        return
+
+    def write(self, data):
+        return len(data)
+
+    def read(self, size=1):
+        return b''
+
+
+# Mock HallSensor 328P: columns are the raw sensor bytes (row 0 in bit 0). Every call spins for the time its
+# bytes take on the bus unless wire is False
+class MockSpiDev():
+    def __init__(self):
+        self.max_speed_hz = 5000
+        self.mode = 0
+        self.columns = [0] * 8
+        self.pending = 0
+        self.wire = True
+        self.busSeconds = 0.0
+
+    def open(self, bus, device):
+        return
+
+    def bus(self, byteCount, speed, delayUs=0):
+        seconds = byteCount * (8 / speed + delayUs / 1e6)
+        self.busSeconds += seconds
+        if self.wire:
+            end = time.perf_counter() + seconds
+            while time.perf_counter() < end:
+                pass
+
+    def writebytes(self, values):
+        self.bus(len(values), self.max_speed_hz)
+        if values[-1] < 8:
+            self.pending = self.columns[values[-1]]
+
+    def readbytes(self, count):
+        self.bus(count, self.max_speed_hz)
+        return [self.pending] * count
+
+    def xfer(self, values, speed_hz=0, delay_usecs=0):
+        self.bus(len(values), speed_hz or self.max_speed_hz, delay_usecs)
+        if values[0] == 8:
+            return [self.pending] + self.columns[:len(values) - 1]
+        return [self.pending] * len(values)
+
+
+serial.Serial = MockSerial
+spidevModule = types.ModuleType('spidev')
+spidevModule.SpiDev = MockSpiDev
+sys.modules['spidev'] = spidevModule
+
+from Engine.x328p_interface import x328p_fs_interface as fs
+
+
+def legacy_scan():
+    return [fs.receive_chess_column(i) for i in range(8)]
+
+
+def burst_scan():
+    return fs.receive_occupancy()
+
+
+def full_state():
+    return fs.receive_chess_state()
+
+
+def pack(messages):
+    return sum(message.data << (8 * message.col) for message in messages)
+
+
+# Scans per second of scan over at least seconds, and the mean bus time of one scan
+def rate(scan, seconds):
+    fs.spi.busSeconds = 0.0
+    count = 0
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < seconds:
+        scan()
+        count += 1
+    return count / (time.perf_counter() - t0), fs.spi.busSeconds / count
+
+
+def run(seconds, seed):
+    rng = random.Random(seed)
+    # both reads return the same occupancy on random boards
+    for _ in range(200):
+        fs.spi.columns = [rng.randrange(256) for _ in range(8)]
+        fs.spi.wire = False
+        assert pack(legacy_scan()) == burst_scan() == pack(full_state())
+    print("Legacy SPI clock:", fs.spi.max_speed_hz, "Hz; burst clock:", fs.BURST_SPEED_HZ, "Hz with",
+          fs.BURST_BYTE_DELAY_US, "us byte gaps")
+    print("{:<26}{:>16}{:>16}{:>20}".format("mode", "scans/s (bus)", "bus ms/scan", "scans/s (host only)"))
+    for name, scan in (("8 column exchanges", legacy_scan), ("burst", burst_scan),
+                       ("burst + column messages", full_state)):
+        fs.spi.wire = True
+        wired, busSeconds = rate(scan, seconds)
+        fs.spi.wire = False
+        host, _ = rate(scan, seconds)
+        print("{:<26}{:>16.1f}{:>16.2f}{:>20.0f}".format(name, wired, 1000 * busSeconds, host))
+
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    run(seconds, seed)
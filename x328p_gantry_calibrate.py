@@ -0,0 +1,46 @@
+# Gantry motion model calibration: times EM-off GOs of several lengths along X, Y and the diagonal, fits
+# velocity, acceleration and GO overhead per axis, and saves the model path planning loads at startup
+# Run with the gantry attached; the EM stays off, so pieces can stay on the board
+# Usage: python x328p_gantry_calibrate.py [repeats]
+import sys
+from Engine.x328p_interface import x328p_gantry_interface as interface
+from Engine.x328p_interface import x328p_gantry_driver as gantry_driver
+from Engine.x328p_interface import x328p_gantry_planner as planner
+
+CENTER = [8, 12]                    # every GO starts or ends here
+LENGTHS = [1, 2, 3, 4, 6, 8]        # units; covers moves too short to reach cruise speed and ones that do
+
+
+# Out from CENTER and back along each primitive in both directions, for every length
+def sweep_targets(repeats):
+    targets = [CENTER]
+    for _ in range(repeats):
+        for units in LENGTHS:
+            for rowStep, columnStep in ((0, 1), (1, 0), (1, 1)):
+                for direction in (1, -1):
+                    targets.append([CENTER[0] + direction * rowStep * units, CENTER[1] + direction * columnStep * units])
+                    targets.append(CENTER)
+    return targets
+
+
+def run(repeats):
+    interface.load_motion_model()
+    driver = gantry_driver.GantryDriver(interface.ser)
+    targets = sweep_targets(repeats)
+    print("Timing", len(targets), "GOs")
+    if driver.submit(driver.calibration_sweep(targets)).result() == -1:
+        print("Gantry stopped answering; fitting the GOs timed so far")
+
+    model = interface.calibrate_motion_model()
+    if model is None:
+        return
+    print("{:<10}{:>12}{:>14}".format("axis", "units/s", "units/s^2"))
+    for primitive in planner.MOTION_PRIMITIVES:
+        print("{:<10}{:>12.2f}{:>14.2f}".format(primitive, model.velocity[primitive], model.acceleration[primitive]))
+    print("GO overhead:", round(model.goSeconds, 3), "s")
+    print("Saved to", interface.MOTION_MODEL_FILE)
+
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    run(repeats)
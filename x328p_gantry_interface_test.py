@@ -6,6 +6,7 @@ from Engine.gameState import GameState as gs
 import numpy as np
 #from Engine.x328p_interface import *
 interface = importlib.import_module('.x328p_interface.x328p_gantry_interface', 'Engine')
+planner = importlib.import_module('.x328p_interface.x328p_gantry_planner', 'Engine')
 
 currentGamestate = gs()  # Instantiate test gamestate
 # move = 'h8a1'
@@ -45,6 +46,8 @@ currentGamestate.board[7-2][7-1] = "wP"
 currentGamestate.board[7-3] = ["wP", "--","--","wP","wP","bP","--","--"]
 currentGamestate.board[7-4][7-4] = "bP"
 currentGamestate.board[7-4][7-2] = "wP"
+# board was edited directly, so rebuild the gantry grid once
+currentGamestate.posGrid = planner.position_grid_from_gamestate(currentGamestate)
 
 #print(currentGamestate)
 #print(currentGamestate.wBuffer)
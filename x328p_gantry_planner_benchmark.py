@@ -0,0 +1,164 @@
+# Benchmark for gantry path planning: legacy greedy walker vs planner.astar, with and without smoothing,
+# and the minimum-time planner.fastest_path
+# Runs without the gantry attached; the UART is replaced with a mock port before import
+# Usage: python x328p_gantry_planner_benchmark.py [positions] [seed]
+import io
+import sys
+import time
+import random
+import contextlib
+import serial
+
+
+class MockSerial():
+    def __init__(self, *args, **kwargs):
+        self.timeout = None
+
+    def flush(self):
+        return
+
+    def write(self, data):
+        return len(data)
+
+    def read(self, size=1):
+        return b''
+
+
+serial.Serial = MockSerial
+
+from Engine.x328p_interface import x328p_gantry_interface as interface
+from Engine.x328p_interface import x328p_gantry_planner as planner
+
+PIECES = ['wP'] * 8 + ['bP'] * 8 + ['wR', 'wH', 'wB', 'wQ', 'wK', 'wB', 'wH', 'wR',
+                                    'bR', 'bH', 'bB', 'bQ', 'bK', 'bB', 'bH', 'bR']
+
+
+class BenchmarkState():
+    def __init__(self, board, wBuffer, bBuffer):
+        self.board = board
+        self.wBuffer = wBuffer
+        self.bBuffer = bBuffer
+        self.stagedSlots = {}
+        self.bufferMap = {'B': 4, 'H': 5, 'R': 6, 'Q': 7, 'K': 7}
+        self.bufferAllocator = planner.BufferAllocator()
+
+
+# Random mid-game position: 16-28 pieces left on the board, the rest in the capture buffers
+def random_midgame_state(rng):
+    pieces = PIECES[:]
+    rng.shuffle(pieces)
+    onBoard = rng.randint(16, 28)
+    board = [["--"] * 8 for _ in range(8)]
+    squares = rng.sample(range(64), onBoard)
+    for piece, square in zip(pieces[:onBoard], squares):
+        board[square // 8][square % 8] = piece
+
+    state = BenchmarkState(board, [["--", "--"] for _ in range(8)], [["--", "--"] for _ in range(8)])
+    for piece in pieces[onBoard:]:
+        if piece[1] == 'K':
+            continue
+        bufferPos = interface.next_buffer_pos(state, piece)
+        if bufferPos is None:
+            continue
+        buffer = state.wBuffer if piece[0] == 'w' else state.bBuffer
+        buffer[bufferPos[0]][bufferPos[1]] = piece
+        state.bufferAllocator.set_slot(piece[0], bufferPos[0], bufferPos[1], piece)
+    return state
+
+
+def random_move(rng, state):
+    occupied = [(i, j) for i in range(8) for j in range(8) if state.board[i][j] != "--"]
+    empty = [(i, j) for i in range(8) for j in range(8) if state.board[i][j] == "--"]
+    start = rng.choice(occupied)
+    end = rng.choice(empty)
+    return [15 - (start[0] * 2), (start[1] * 2) + 5], [15 - (end[0] * 2), (end[1] * 2) + 5]
+
+
+# Greedy returns a walk that can contain placeholder nodes; only count walks that are connected
+def greedy_walk_valid(solution, startPos, endPos):
+    if solution == -1 or len(solution) == 0:
+        return False
+    if solution[0][0].pos != startPos or solution[-1][0].pos != endPos:
+        return False
+    for i in range(1, len(solution)):
+        prev = solution[i - 1][0].pos
+        curr = solution[i][0].pos
+        if max(abs(prev[0] - curr[0]), abs(prev[1] - curr[1])) != 1:
+            return False
+    return True
+
+
+def run(positions, seed):
+    rng = random.Random(seed)
+    greedyTime = astarTime = 0
+    greedySolved = astarSolved = bothSolved = 0
+    greedyCost = astarCost = 0
+    greedyNodes = astarNodes = 0
+    greedySeconds = astarSeconds = 0
+    smoothTime = smoothCost = smoothNodes = smoothSeconds = 0
+    fastestTime = fastestCost = fastestNodes = fastestSeconds = 0
+
+    for _ in range(positions):
+        state = random_midgame_state(rng)
+        startPos, endPos = random_move(rng, state)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            heurMap = interface.create_heuristic_map(interface.gamestate_to_position_map(state), endPos)
+            t0 = time.perf_counter()
+            greedySolution = interface.greedy(heurMap, heurMap[startPos[0]][startPos[1]])
+            greedyTime += time.perf_counter() - t0
+
+            posGrid = planner.position_grid_from_gamestate(state)
+            t0 = time.perf_counter()
+            astarSolution = planner.astar(posGrid, startPos, endPos)
+            astarTime += time.perf_counter() - t0
+
+            if astarSolution != -1:
+                t0 = time.perf_counter()
+                smoothSolution = planner.smooth_path(posGrid, astarSolution)
+                smoothTime += time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            fastestSolution = planner.fastest_path(posGrid, startPos, endPos)
+            fastestTime += time.perf_counter() - t0
+
+        greedyOk = greedy_walk_valid(greedySolution, startPos, endPos)
+        astarOk = astarSolution != -1
+        greedySolved += greedyOk
+        astarSolved += astarOk
+        if greedyOk and astarOk:
+            bothSolved += 1
+            greedyCost += planner.path_cost([(node.pos, direction) for node, direction in greedySolution])
+            astarCost += planner.path_cost(astarSolution)
+            greedyPath = [(node.pos, direction) for node, direction in interface.sl_compression(greedySolution)]
+            astarPath = interface.sl_compression(astarSolution)
+            greedyNodes += len(greedyPath)
+            astarNodes += len(astarPath)
+            smoothNodes += len(smoothSolution)
+            greedySeconds += planner.estimate_path_seconds(greedyPath)
+            astarSeconds += planner.estimate_path_seconds(astarPath)
+            smoothSeconds += planner.estimate_path_seconds(smoothSolution)
+            smoothCost += planner.path_cost(smoothSolution)
+            fastestNodes += len(fastestSolution)
+            fastestSeconds += planner.estimate_path_seconds(fastestSolution)
+            fastestCost += planner.path_cost(fastestSolution)
+
+    print("Positions:", positions, "seed:", seed)
+    print("{:<14}{:>10}{:>14}{:>16}{:>14}{:>14}".format("planner", "solved", "mean cost", "mean waypoints",
+                                                         "mean est s", "mean ms"))
+    rows = (("greedy", greedySolved, greedyCost, greedyNodes, greedySeconds, greedyTime),
+            ("astar", astarSolved, astarCost, astarNodes, astarSeconds, astarTime),
+            ("astar+smooth", astarSolved, smoothCost, smoothNodes, smoothSeconds, astarTime + smoothTime),
+            ("fastest", astarSolved, fastestCost, fastestNodes, fastestSeconds, fastestTime))
+    for name, solved, cost, nodes, seconds, elapsed in rows:
+        print("{:<14}{:>10}{:>14.2f}{:>16.2f}{:>14.2f}{:>14.3f}".format(name, solved, cost / max(bothSolved, 1),
+                                                                    nodes / max(bothSolved, 1),
+                                                                    seconds / max(bothSolved, 1),
+                                                                    1000 * elapsed / positions))
+    print("Cost, waypoint and time means are over the", bothSolved, "positions both planners solved")
+
+
+if __name__ == '__main__':
+    positions = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    run(positions, seed)
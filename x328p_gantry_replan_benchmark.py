@@ -0,0 +1,66 @@
+# Benchmark for incremental replanning: planner.IncrementalPlanner repairing its searches between legs vs
+# searching every leg from scratch, over blocker relocations: a piece staged on the edge row behind an occupied
+# rank 8 square, walled in until the blockers are moved (plan_with_blockers, three penalty scales), the only
+# planning that uses IncrementalPlanner
+# Usage: python x328p_gantry_replan_benchmark.py [positions] [seed]
+import io
+import sys
+import time
+import random
+import contextlib
+
+from x328p_gantry_planner_benchmark import random_midgame_state
+from Engine.x328p_interface import x328p_gantry_planner as planner
+
+
+# Routes a piece staged at row 16 under an occupied rank 8 square to a random empty board square
+def relocation(rng, replanner):
+    state = random_midgame_state(rng)
+    grid = planner.position_grid_from_gamestate(state)
+    column = rng.choice(range(5, 20, 2))
+    if grid.is_empty(15, column):
+        grid.set_piece([15, column], 'bP')
+    grid.set_piece([16, column], 'wQ')
+    empty = [[row, col] for row in range(1, 16, 2) for col in range(5, 20, 2) if grid.is_empty(row, col)]
+    plan = planner.plan_with_blockers(grid, [16, column], rng.choice(empty), [0, 0], replanner)
+    return 0 if plan == -1 else len(plan[0])
+
+
+def run(positions, seed):
+    print("Positions:", positions, "seed:", seed)
+    print("{:<16}{:<14}{:>10}{:>10}{:>18}{:>10}{:>12}".format("scenario", "searches", "moves", "legs",
+                                                             "mean expansions", "repairs", "mean ms"))
+    for scenario in (relocation,):
+        results = {}
+        for incremental in (True, False):
+            rng = random.Random(seed)
+            legs = []
+            elapsed = 0
+            moveCount = 0
+            for _ in range(positions):
+                # a planner per plan, as plan_with_blockers uses it
+                replanner = planner.IncrementalPlanner(incremental)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    t0 = time.perf_counter()
+                    moveCount += scenario(rng, replanner)
+                    elapsed += time.perf_counter() - t0
+                legs += replanner.legs
+            results[incremental] = legs
+            repairs = sum(1 for _, changed in legs if changed != 0)
+            print("{:<16}{:<14}{:>10}{:>10}{:>18.1f}{:>10}{:>12.2f}".format(
+                scenario.__name__, "incremental" if incremental else "from scratch", moveCount, len(legs),
+                sum(expansions for expansions, _ in legs) / max(len(legs), 1), repairs, 1000 * elapsed / positions))
+
+        # searches run again on a grid other legs had changed, against the same search from scratch
+        repeated = [(leg, full) for leg, full in zip(results[True], results[False]) if leg[1] != 0]
+        if len(repeated) != 0:
+            print("  repaired searches:", len(repeated), "; mean expansions",
+                  round(sum(leg[0] for leg, _ in repeated) / len(repeated), 1), "vs",
+                  round(sum(full[0] for _, full in repeated) / len(repeated), 1), "from scratch; mean changed cells",
+                  round(sum(leg[1] for leg, _ in repeated) / len(repeated), 1))
+
+
+if __name__ == '__main__':
+    positions = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    run(positions, seed)